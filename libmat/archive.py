@@ -1,47 +1,511 @@
 """ Take care of archives formats
 """
 
+import atexit
+import collections
+import contextlib
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
 import shutil
 import stat
+import struct
 import tarfile
 import tempfile
+import threading
+import xml.sax
 import zipfile
+import zlib
 
+import compression
 import mat
 import parser
+import workspace
+import xmlscrub
 
 # Zip files do not support dates older than 01/01/1980
 ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
 
+# Number of members cleaned concurrently
+JOBS = 1
+
+# Size of the chunks in which members are copied and compressed
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+# Compression level of the deflated zip members (None means zlib's default)
+ZIP_COMPRESSION_LEVEL = None
+
+# Formats that are already compressed: deflating them again
+# costs a lot of CPU for almost no gain, so they are stored.
+COMPRESSED_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',   # images
+    '.mp3', '.ogg', '.oga', '.opus', '.flac', '.m4a', '.aac',   # audio
+    '.mp4', '.m4v', '.mkv', '.webm', '.avi', '.mov', '.ogv',    # video
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.7z', '.rar',   # archives
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.odg', '.epub', '.jar',   # zipped documents
+))
+
+
+def get_compress_type(name, original=None):
+    """ Return how the member $name should be compressed
+
+        :param str name: Name of the member
+        :param int original: Its compression method in the original archive, if any
+    """
+    if os.path.basename(name) == 'mimetype':
+        return zipfile.ZIP_STORED  # opendocument requires it
+    elif original == zipfile.ZIP_STORED:
+        return zipfile.ZIP_STORED
+    elif os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def clean_date_time(item):
+    """ Return the date of the zip member $item once cleaned: the epoch,
+        except for the encrypted members with a data descriptor, whose
+        password check byte is the high byte of their DOS time. Their
+        hour and 8-minutes slot are kept, since they are already part of
+        the encrypted data, to still be decrypted.
+
+        :param zipfile.ZipInfo item: The member
+    """
+    if item.flag_bits & 0x9 == 0x9:
+        return ZIP_EPOCH[:3] + (item.date_time[3], item.date_time[4] & ~7, 0)
+    return ZIP_EPOCH
+
+
+class ZipRewriter(zipfile.ZipFile):
+    """ A ZipFile, opened for writing, which can also copy the
+        compressed data of members from another zip file as is,
+        without inflating and deflating them again.
+    """
+
+    def __init__(self, filename, level=None):
+        super(ZipRewriter, self).__init__(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.level = ZIP_COMPRESSION_LEVEL if level is None else level
+        if self.level is None:
+            self.level = zlib.Z_DEFAULT_COMPRESSION
+
+    @staticmethod
+    def clean_zipinfo(filename):
+        """ Return a ZipInfo for $filename, without any
+            of the metadata added by zip itself
+        """
+        zinfo = zipfile.ZipInfo(filename, date_time=ZIP_EPOCH)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.create_system = 3  # Linux
+        zinfo.comment = ''
+        return zinfo
+
+    def write_file(self, path, zinfo):
+        """ Write the file $path in the archive, described by $zinfo.
+            The file is read and compressed chunk by chunk, then its
+            header is patched with the final sizes and CRC: the memory
+            used doesn't depend on the size of the file.
+
+            :param str path: Path of the file to add
+            :param zipfile.ZipInfo zinfo: Header of the member
+        """
+        zinfo.file_size = os.stat(path).st_size
+        zinfo.flag_bits = 0x00
+        zinfo.CRC = zinfo.compress_size = 0
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        # The header is written before the compressed size is known,
+        # so leave some margin to decide if ZIP64 extensions are needed.
+        zip64 = self._allowZip64 and zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        self.fp.write(zinfo.FileHeader(zip64))
+
+        compressor = None
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        crc, file_size, compress_size = 0, 0, 0
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                file_size += len(data)
+                crc = zlib.crc32(data, crc) & 0xffffffff
+                if compressor is not None:
+                    data = compressor.compress(data)
+                compress_size += len(data)
+                self.fp.write(data)
+        if compressor is not None:
+            data = compressor.flush()
+            compress_size += len(data)
+            self.fp.write(data)
+
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        if not zip64 and (file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT):
+            raise zipfile.LargeZipFile('Filesize would require ZIP64 extensions')
+        position = self.fp.tell()
+        self.fp.seek(zinfo.header_offset)
+        self.fp.write(zinfo.FileHeader(zip64))
+        self.fp.seek(position)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+    def write_raw(self, zipin, item):
+        """ Copy the member $item of the opened zip file $zipin,
+            with clean headers but its original compressed data and CRC.
+
+            :param zipfile.ZipFile zipin: Archive containing the member
+            :param zipfile.ZipInfo item: The member to copy
+        """
+        zinfo = self.clean_zipinfo(item.filename)
+        zinfo.compress_type = item.compress_type
+        zinfo.date_time = clean_date_time(item)
+        zinfo.flag_bits = item.flag_bits & 0x1  # only keep the encryption flag
+        if zinfo.flag_bits and item.flag_bits & 0x8:
+            zinfo.flag_bits |= 0x8  # its password check byte comes from the time
+        zinfo.CRC = item.CRC
+        zinfo.compress_size = item.compress_size
+        zinfo.file_size = item.file_size
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or \
+            zinfo.compress_size > zipfile.ZIP64_LIMIT
+        if zip64 and not self._allowZip64:
+            raise zipfile.LargeZipFile('Filesize would require ZIP64 extensions')
+        self.fp.write(zinfo.FileHeader(zip64))
+
+        zipin.fp.seek(item.header_offset)
+        header = struct.unpack(zipfile.structFileHeader,
+                               zipin.fp.read(zipfile.sizeFileHeader))
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile('Bad magic number for file header')
+        zipin.fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                      header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        remaining = item.compress_size
+        while remaining > 0:
+            data = zipin.fp.read(min(remaining, COPY_BUFFER_SIZE))
+            if not data:
+                raise zipfile.BadZipfile('Truncated data for %s' % item.filename)
+            self.fp.write(data)
+            remaining -= len(data)
+        if zinfo.flag_bits & 0x8:
+            self.fp.write(struct.pack('<4sLQQ' if zip64 else '<4sLLL', 'PK\x07\x08',
+                                      zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+
+        self.fp.flush()
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+
+# What the analysis of an archive found out about one of its members,
+# along with the stripper of a nested archive, kept open with its own plan
+PlannedMember = collections.namedtuple('PlannedMember', ('path', 'stripper_class', 'clean', 'stripper'))
+
+
+class ArchivePlan(object):
+    """ Result of the single analysis of an archive, shared by
+        is_clean, get_meta, list_unsupported and remove_all:
+        whether the archive is clean, its harmful metadata, its
+        unsupported members, and where each supported member
+        was extracted along with its own verdict, the xml parts
+        that have to be scrubbed, and the ones that can't be parsed.
+        The strippers of the nested archives are kept open, so
+        that they are cleaned without being analysed again.
+        An analysis stopped at the first harmful header is not
+        complete: it only tells that the archive is not clean.
+    """
+
+    def __init__(self):
+        self.clean = True
+        self.complete = True
+        self.unsupported = []
+        self.meta = {}
+        self.members = {}
+        self.scrubbed = set()
+        self.unparsed = set()
+
+    def add_member(self, name, path, stripper_class, clean, stripper=None):
+        """ Record the verdict of a supported member, extracted at $path
+        """
+        self.members[name] = PlannedMember(path, stripper_class, clean, stripper)
+
+    def extracted(self, name):
+        """ Return the PlannedMember of $name, if it is still extracted
+        """
+        member = self.members.get(name)
+        if member is not None and os.path.isfile(member.path):
+            return member
+        return None
+
+    def close(self):
+        """ Close the strippers of the nested archives
+        """
+        for member in self.members.values():
+            if member.stripper is not None:
+                member.stripper.close()
+
+
+def _clean_member(path, kwargs, cfile=None):
+    """ Remove the metadata of the extracted member $path, with
+        its stripper $cfile if it was kept from the analysis.
+        This runs in the workers of MemberCleaner.
+    """
+    if cfile is None:
+        cfile = mat.create_class_file(path, False, **kwargs)
+    if cfile is None:
+        return False
+    # Handle read-only files inside archive
+    old_stat = os.stat(path).st_mode
+    os.chmod(path, old_stat | stat.S_IWUSR)
+    try:
+        cfile.remove_all()
+    finally:
+        cfile.close()
+        os.chmod(path, old_stat)
+    return True
+
+
+def _analyse_member(path, kwargs, keep=False):
+    """ Return the metadata of the extracted member $path, whether
+        it is clean, and its stripper if $keep is set (else None),
+        or None if it is not supported.
+        This runs in the workers of MemberCleaner.
+    """
+    cfile = mat.create_class_file(path, False, **kwargs)
+    if cfile is None:
+        return None
+    try:
+        # get_meta comes first: it scans the whole member, once
+        result = cfile.get_meta(), cfile.is_clean(), cfile if keep else None
+    except:
+        cfile.close()
+        raise
+    if not keep:
+        cfile.close()
+    return result
+
+
+_PROCESSES = None
+_PROCESSES_LOCK = threading.Lock()
+
+
+def start_processes(jobs=None):
+    """ Fork the processes cleaning the members of archives, shared by
+        every archive of the run, and return their pool. Call it before
+        starting any thread: a process forked while another thread holds
+        a lock would inherit it, locked forever. Otherwise, the pool is
+        created on first use.
+
+        :param int jobs: Number of processes (defaults to JOBS)
+    """
+    global _PROCESSES
+    with _PROCESSES_LOCK:
+        if _PROCESSES is None:
+            _PROCESSES = multiprocessing.Pool(jobs or JOBS)
+        return _PROCESSES
+
+
+def get_processes(jobs=None):
+    """ Return the pool of start_processes, or None if it can't be used
+        from here: in its own workers, or, before it was forked, from
+        another thread than the main one.
+
+        :param int jobs: Number of processes, if the pool has to be started
+    """
+    if multiprocessing.current_process().daemon:
+        return None
+    with _PROCESSES_LOCK:
+        if _PROCESSES is not None:
+            return _PROCESSES
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        return None
+    return start_processes(jobs)
+
+
+@atexit.register
+def close_processes():
+    """ Stop the processes of the shared pool
+    """
+    global _PROCESSES
+    with _PROCESSES_LOCK:
+        pool, _PROCESSES = _PROCESSES, None
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+class _Done(object):
+    """ Result of a member cleaned right away
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class MemberCleaner(object):
+    """ Analyse and clean the extracted members of an archive. With more
+        than one job, members are handled concurrently with the extraction
+        of the next ones: in threads when their stripper is io_bound
+        or when they are nested archives, otherwise in the processes
+        shared by every archive (see start_processes).
+        Results are fetched by the caller, in the order it needs them.
+        The strippers of nested archives are kept from the analysis.
+    """
+
+    def __init__(self, jobs, kwargs):
+        self.jobs = jobs
+        # Workers must not start pools of their own
+        self.kwargs = dict(kwargs, jobs=1)
+        self.threads = None
+
+    def __apply(self, function, path, stripper_class, *args):
+        """ Start running $function on $path, and return an object
+            whose get() method waits for the result.
+        """
+        if self.jobs <= 1:
+            return _Done(function(path, self.kwargs, *args))
+        # The processes must be forked before this cleaner starts its threads
+        processes = start_processes(self.jobs)
+        # Nested archives stay in this process, to share its workspace
+        if stripper_class.io_bound or issubclass(stripper_class, GenericArchiveStripper):
+            if self.threads is None:
+                self.threads = multiprocessing.pool.ThreadPool(self.jobs)
+            return self.threads.apply_async(function, (path, self.kwargs) + args)
+        kwargs = dict(self.kwargs)
+        kwargs.pop('workspace', None)
+        return processes.apply_async(function, (path, kwargs) + args)
+
+    def submit(self, path, stripper_class, stripper=None):
+        """ Start cleaning $path, and return an object whose get()
+            method waits for the result.
+
+            :param str path: Path of the extracted member
+            :param stripper_class: Class of the stripper handling it
+            :param stripper: Its stripper, if it was kept from the analysis
+        """
+        return self.__apply(_clean_member, path, stripper_class, stripper)
+
+    def analyse(self, path, stripper_class):
+        """ Start analysing $path, and return an object whose get() method
+            waits for its metadata, whether it is clean, and its stripper
+            if it's a nested archive (None if the member is not supported).
+
+            :param str path: Path of the extracted member
+            :param stripper_class: Class of the stripper handling it
+        """
+        keep = issubclass(stripper_class, GenericArchiveStripper)
+        return self.__apply(_analyse_member, path, stripper_class, keep)
+
+    def close(self):
+        """ Stop the threads; the processes are kept for the next archives
+        """
+        if self.threads is not None:
+            self.threads.close()
+            self.threads.join()
+        self.threads = None
+
 
 class GenericArchiveStripper(parser.GenericParser):
     """ Represent a generic archive
     """
 
     def __init__(self, filename, mime, backup, is_writable, **kwargs):
+        self.workspace = None
         super(GenericArchiveStripper, self).__init__(filename, mime, backup, is_writable, **kwargs)
         self.compression = ''
         self.add2archive = kwargs['add2archive']
-        self.tempdir = tempfile.mkdtemp()
+        self.scratch_root = kwargs.get('scratch_root')
+        self.jobs = kwargs.get('jobs') or JOBS
+        self.compression_level = kwargs.get('compression_level')
+        self.low_pdf_quality = kwargs.get('low_pdf_quality', False)
+        self.structural_pdf = kwargs.get('structural_pdf', False)
+        parent = kwargs.get('workspace')
+        if parent is None:
+            self.workspace = workspace.Workspace(self.scratch_root)
+        else:  # nested archive
+            self.workspace = parent.child()
 
-    def __del__(self):
-        """ Remove the files inside the temp dir,
-            then remove the temp dir
+    def close(self):
+        """ Close the nested archives, remove the extracted
+            members, then the scratch directories
         """
-        for root, _, files in os.walk(self.tempdir):
-            for item in files:
-                path_file = os.path.join(root, item)
-                mat.secure_remove(path_file)
-        shutil.rmtree(self.tempdir)
+        super(GenericArchiveStripper, self).close()
+        plan = self._peek_scan() if os.path.exists(self.filename) else None
+        if plan is not None:
+            plan.close()
+        if self.workspace is not None:
+            self.workspace.cleanup()
 
-    def is_clean(self, list_unsupported=False):
-        """ Virtual method to check for harmul metadata
-        :param bool list_unsupported:
+    def _extract(self, archive, item, name, size):
+        """ Extract a member of the archive in the workspace,
+            and return its path.
+
+            :param archive: Opened ZipFile or TarFile
+            :param item: ZipInfo or TarInfo of the member
+            :param str name: Name of the member
+            :param int size: Size of the member
+        """
+        self.workspace.charge(size)
+        directory = self.workspace.directory_for(size)
+        archive.extract(item, directory)
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):  # don't trust the announced size
+            self.workspace.charge(os.path.getsize(path) - size, members=0)
+        return path
+
+    def _create_member_class_file(self, path):
+        """ Return the stripper of an extracted member, if it's supported
+        """
+        return mat.create_class_file(path, False, **self._member_kwargs())
+
+    def _member_kwargs(self):
+        """ Return the arguments given to the strippers of the members
+        """
+        return {'add2archive': self.add2archive, 'scratch_root': self.scratch_root,
+                'jobs': self.jobs, 'compression_level': self.compression_level,
+                'low_pdf_quality': self.low_pdf_quality, 'structural_pdf': self.structural_pdf,
+                'workspace': self.workspace, 'in_workspace': True}
+
+    def _scan(self, stop_early=False):
+        """ Virtual method to analyse the whole archive.
+            It must return an ArchivePlan. With $stop_early, it returns
+            an incomplete plan as soon as a header, or the name of a
+            member, tells that the archive is not clean.
         """
         raise NotImplementedError
 
+    def is_clean(self, list_unsupported=False):
+        """ Check if the given file is clean from harmful metadata
+            When list_unsupported is True, the method returns a list
+            of all non-supported/archives files contained in the
+            archive.
+
+            :param bool list_unsupported: Should the list of unsupported files be returned
+        """
+        if not list_unsupported and self._peek_scan() is None:
+            # Stop at the first harmful header, without extracting the
+            # members after it, but keep the analysis if it went through
+            plan = self._scan(stop_early=True)
+            if not plan.complete:
+                plan.close()
+                return False
+            self._set_scan(plan)
+        scan = self._get_scan()
+        if list_unsupported:
+            return list(scan.unsupported)
+        return scan.clean
+
+    def get_meta(self):
+        """ Return all the metadata of the archive
+        """
+        return dict(self._get_scan().meta)
+
     def list_unsupported(self):
         """ Get a list of every non-supported files present in the archive
         """
@@ -57,6 +521,33 @@ class ZipStripper(GenericArchiveStripper):
     """ Represent a zip file
     """
 
+    def __init__(self, filename, mime, backup, is_writable, **kwargs):
+        self.index = None
+        self.index_key = None
+        super(ZipStripper, self).__init__(filename, mime, backup, is_writable, **kwargs)
+
+    def close(self):
+        """ Close the index, then remove the extracted members
+        """
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        super(ZipStripper, self).close()
+
+    def _get_index(self):
+        """ Return the archive opened as a ZipFile, which maps the names
+            of the members to their ZipInfo and offsets. Its central
+            directory is only parsed once for each version of the file,
+            and shared by every check and by the cleaning.
+        """
+        key = self._stat_key()
+        if self.index is None or self.index_key != key:
+            if self.index is not None:
+                self.index.close()
+            self.index = zipfile.ZipFile(self.filename, 'r')
+            self.index_key = key
+        return self.index
+
     @staticmethod
     def __is_zipfile_clean(fileinfo):
         """ Check if a ZipInfo object is clean of metadata added
@@ -64,73 +555,144 @@ class ZipStripper(GenericArchiveStripper):
         """
         if fileinfo.comment != '':
             return False
-        elif fileinfo.date_time != ZIP_EPOCH:
+        elif fileinfo.date_time != clean_date_time(fileinfo):
             return False
         elif fileinfo.create_system != 3:  # 3 is UNIX
             return False
         return True
 
-    def is_clean(self, list_unsupported=False):
-        """ Check if the given file is clean from harmful metadata
-            When list_unsupported is True, the method returns a list
-            of all non-supported/archives files contained in the
-            archive.
-
-            :param bool list_unsupported: Should the list of unsupported files be returned
+    def _check_headers(self, zipin, plan):
+        """ Record in $plan the zip metadata of the archive and of its
+            members, and the members that are not supported.
         """
-        ret_list = []
-        zipin = zipfile.ZipFile(self.filename, 'r')
-        if zipin.comment != '' and not list_unsupported:
+        if zipin.comment != '':
             logging.debug('%s has a comment', self.filename)
-            return False
+            plan.meta['comment'] = zipin.comment
+            plan.clean = False
         for item in zipin.infolist():
-            zipin.extract(item, self.tempdir)
-            path = os.path.join(self.tempdir, item.filename)
-            if not self.__is_zipfile_clean(item) and not list_unsupported:
+            if not self.__is_zipfile_clean(item):
                 logging.debug('%s from %s has compromising zipinfo', item.filename, self.filename)
-                return False
-            if os.path.isfile(path):
-                cfile = mat.create_class_file(path, False, add2archive=self.add2archive)
-                if cfile is not None:
-                    if not cfile.is_clean():
-                        logging.debug('%s from %s has metadata', item.filename, self.filename)
-                        if not list_unsupported:
-                            return False
-                else:
-                    logging.info('%s\'s fileformat is not supported or harmless.', item.filename)
-                    _, ext = os.path.splitext(path)
-                    if os.path.basename(item.filename) not in ('mimetype', '.rels'):
-                        if ext not in parser.NOMETA:
-                            if not list_unsupported:
-                                return False
-                            ret_list.append(item.filename)
-        zipin.close()
-        if list_unsupported:
-            return ret_list
-        return True
+                plan.meta[item.filename + "'s zipinfo"] = str(self.__get_zipinfo_meta(item))
+                plan.clean = False
+            if item.filename.endswith('/'):
+                continue
+            if mat.get_stripper_class(item.filename)[1] is None:
+                logging.info('%s\'s fileformat is not supported or harmless.', item.filename)
+                _, ext = os.path.splitext(item.filename)
+                if os.path.basename(item.filename) not in ('mimetype', '.rels'):
+                    if ext not in parser.NOMETA:
+                        plan.unsupported.append(item.filename)
+                        plan.clean = False
 
-    def get_meta(self):
-        """ Return all the metadata of a zip archive"""
-        zipin = zipfile.ZipFile(self.filename, 'r')
-        metadata = {}
-        if zipin.comment != '':
-            metadata['comment'] = zipin.comment
-        for item in zipin.infolist():
-            zipinfo_meta = self.__get_zipinfo_meta(item)
-            if zipinfo_meta != {}:  # zipinfo metadata
-                metadata[item.filename + "'s zipinfo"] = str(zipinfo_meta)
-            zipin.extract(item, self.tempdir)
-            path = os.path.join(self.tempdir, item.filename)
-            if os.path.isfile(path):
-                cfile = mat.create_class_file(path, False, add2archive=self.add2archive)
-                if cfile is not None:
-                    cfile_meta = cfile.get_meta()
-                    if cfile_meta != {}:
-                        metadata[item.filename] = str(cfile_meta)
-                else:
-                    logging.info('%s\'s fileformat is not supported or harmless', item.filename)
-        zipin.close()
-        return metadata
+    def _is_scrubbed(self, name):
+        """ Check if the member $name is an xml part that may contain
+            authors, dates or revision identifiers, to be removed by xmlscrub
+        """
+        return False
+
+    def __scan_xml(self, zipin, item, plan):
+        """ Record in $plan what xmlscrub would remove from the
+            xml part $item, without extracting it
+        """
+        try:
+            found = xmlscrub.scan(zipin.open(item))
+        except xml.sax.SAXException:
+            logging.error('Unable to parse %s from %s', item.filename, self.filename)
+            # It can be neither checked nor scrubbed
+            plan.unsupported.append(item.filename)
+            plan.unparsed.add(item.filename)
+            plan.clean = False
+            return
+        if found:
+            logging.debug('%s from %s has metadata', item.filename, self.filename)
+            plan.meta[item.filename] = str(xmlscrub.describe(found))
+            plan.scrubbed.add(item.filename)
+            plan.clean = False
+
+    def __scrub_xml(self, zipin, item):
+        """ Stream the xml part $item through xmlscrub,
+            into the workspace, and return the path of the result
+        """
+        self.workspace.charge(0)
+        member = self.workspace.create(item.file_size)
+        try:
+            xmlscrub.scrub(zipin.open(item), member)
+        except:
+            member.discard()
+            raise
+        member.close()
+        return member.path
+
+    def _extract(self, archive, item, name, size):
+        """ Copy the member $item out of the archive, chunk by chunk,
+            and account for each of them: the size written in the
+            headers can't be trusted, and a zip bomb must be stopped
+            before it fills up the workspace, or the RAM.
+        """
+        self.workspace.charge(0)
+        # Like ZipFile.extract, never write outside of the workspace
+        parts = [part for part in name.split('/') if part not in ('', os.curdir, os.pardir)]
+        if not parts or name.endswith('/'):
+            return os.path.join(self.workspace.directory_for(0), *parts)
+        member = self.workspace.create(size, os.path.join(*parts))
+        source = archive.open(item)
+        try:
+            while True:
+                data = source.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                member.write(data)
+        except:
+            member.discard()  # don't leave a partial member behind
+            raise
+        finally:
+            source.close()
+        member.close()
+        return member.path
+
+    def _scan(self, stop_early=False):
+        """ Analyse the zip metadata of the archive, and the ones of every
+            supported file it contains.
+        """
+        plan = ArchivePlan()
+        zipin = self._get_index()
+        self._check_headers(zipin, plan)
+        if stop_early and not plan.clean:
+            plan.complete = False
+            return plan
+        # The media are analysed by the workers while the xml parts are scanned
+        cleaner = MemberCleaner(self.jobs, self._member_kwargs())
+        try:
+            pending = []
+            for item in zipin.infolist():
+                if self._is_scrubbed(item.filename):
+                    self.__scan_xml(zipin, item, plan)
+                    continue
+                stripper_class = mat.get_stripper_class(item.filename)[1]
+                if item.filename.endswith('/') or stripper_class is None:
+                    continue
+                path = self._extract(zipin, item, item.filename, item.file_size)
+                if not os.path.isfile(path):
+                    continue
+                pending.append((item, path, stripper_class, cleaner.analyse(path, stripper_class)))
+
+            for item, path, stripper_class, result in pending:
+                analysis = result.get()
+                if analysis is None:
+                    continue
+                cfile_meta, is_clean, cfile = analysis
+                if cfile_meta != {}:
+                    plan.meta[item.filename] = str(cfile_meta)
+                if not is_clean:
+                    logging.debug('%s from %s has metadata', item.filename, self.filename)
+                    plan.clean = False
+                plan.add_member(item.filename, path, stripper_class, is_clean, cfile)
+        except:
+            plan.close()
+            raise
+        finally:
+            cleaner.close()
+        return plan
 
     @staticmethod
     def __get_zipinfo_meta(zipinfo):
@@ -139,7 +701,7 @@ class ZipStripper(GenericArchiveStripper):
         metadata = {}
         if zipinfo.comment != '':
             metadata['comment'] = zipinfo.comment
-        if zipinfo.date_time != ZIP_EPOCH:
+        if zipinfo.date_time != clean_date_time(zipinfo):
             metadata['modified'] = zipinfo.date_time
         if zipinfo.create_system != 3:  # 3 is UNIX
             metadata['system'] = "windows" if zipinfo.create_system == 2 else "unknown"
@@ -162,39 +724,80 @@ class ZipStripper(GenericArchiveStripper):
             beginning_blacklist = []
         if not whitelist:
             whitelist = []
-        zipin = zipfile.ZipFile(self.filename, 'r')
-        zipout = zipfile.ZipFile(self.output, 'w', allowZip64=True)
+        plan = self._get_scan()
+        zipin = self._get_index()
+
+        def is_blacklisted(name):
+            beginning = any((True for f in beginning_blacklist if name.startswith(f)))
+            ending = any((True for f in ending_blacklist if name.endswith(f)))
+            return beginning or ending or name.endswith('/')
+
+        # The document can't be cleaned without its parts that can't be parsed
+        unscrubbable = sorted(name for name in plan.unparsed if name not in whitelist and not is_blacklisted(name))
+        for name in unscrubbable:
+            logging.error('Unable to scrub %s from %s', name, self.filename)
+        if unscrubbable:
+            return False
+
+        cleaner = MemberCleaner(self.jobs, self._member_kwargs())
+        members = []
         for item in zipin.infolist():
-            zipin.extract(item, self.tempdir)
-            path = os.path.join(self.tempdir, item.filename)
-
-            beginning = any((True for f in beginning_blacklist if item.filename.startswith(f)))
-            ending = any((True for f in ending_blacklist if item.filename.endswith(f)))
-
-            if os.path.isfile(path) and not beginning and not ending:
-                cfile = mat.create_class_file(path, False, add2archive=self.add2archive)
-                if cfile is not None:
-                    # Handle read-only files inside archive
-                    old_stat = os.stat(path).st_mode
-                    os.chmod(path, old_stat | stat.S_IWUSR)
-                    cfile.remove_all()
-                    os.chmod(path, old_stat)
-                    logging.debug('Processing %s from %s', item.filename, self.filename)
-                elif item.filename not in whitelist:
+            if is_blacklisted(item.filename):
+                continue
+
+            # Members that don't need cleaning keep their compressed data as is,
+            # unless the compression policy disagrees with their original method.
+            passthrough = get_compress_type(item.filename, item.compress_type) == item.compress_type
+            if item.filename in plan.scrubbed:
+                logging.debug('Scrubbing %s from %s', item.filename, self.filename)
+                members.append((item, self.__scrub_xml(zipin, item), None))
+                continue
+            stripper_class = mat.get_stripper_class(item.filename)[1]
+            if stripper_class is None:
+                if item.filename not in whitelist:
                     logging.info("%s's format is not supported or harmless", item.filename)
-                    _, ext = os.path.splitext(path)
-                    if not (self.add2archive or ext in parser.NOMETA):
+                    _, ext = os.path.splitext(item.filename)
+                    harmless = ext in parser.NOMETA or os.path.basename(item.filename) in ('mimetype', '.rels')
+                    if not (self.add2archive or harmless):
                         continue
-                zinfo = zipfile.ZipInfo(item.filename, date_time=ZIP_EPOCH)
-                zinfo.compress_type = zipfile.ZIP_DEFLATED
-                zinfo.create_system = 3  # Linux
-                zinfo.comment = ''
-                with open(path, 'r') as f:
-                    zipout.writestr(zinfo, f.read())
-                # os.utime(path, (ZIP_EPOCH_SECONDS, ZIP_EPOCH_SECONDS))
-                # zipout.write(path, item.filename)
-        zipin.close()
+                if passthrough:
+                    members.append((item, None, None))
+                else:
+                    members.append((item, self._extract(zipin, item, item.filename, item.file_size), None))
+                continue
+
+            member = plan.extracted(item.filename)
+            if member is None:
+                path = self._extract(zipin, item, item.filename, item.file_size)
+                if not os.path.isfile(path):
+                    continue
+            elif member.clean:
+                members.append((item, None if passthrough else member.path, None))
+                continue
+            else:
+                path = member.path
+            logging.debug('Processing %s from %s', item.filename, self.filename)
+            stripper = member.stripper if member is not None else None
+            members.append((item, path, cleaner.submit(path, stripper_class, stripper)))
+
+        # Write the members in their original order
+        zipout = ZipRewriter(self.output, self.compression_level)
+        try:
+            for item, path, result in members:
+                if path is None:
+                    zipout.write_raw(zipin, item)
+                    continue
+                if result is not None:
+                    result.get()
+                zinfo = zipout.clean_zipinfo(item.filename)
+                zinfo.compress_type = get_compress_type(item.filename, item.compress_type)
+                zipout.write_file(path, zinfo)
+        finally:
+            cleaner.close()
+            plan.close()
         zipout.close()
+        self.index.close()  # the file is about to be replaced
+        self.index = None
 
         logging.info('%s processed', self.filename)
         self.do_backup()
@@ -216,6 +819,18 @@ class TarStripper(GenericArchiveStripper):
         current_file.gname = ''
         return current_file
 
+    def _keep_unsupported(self, name, whitelist):
+        """ Should the member $name, that no stripper handles, be added to the produced archive?
+        """
+        if self.add2archive or os.path.splitext(name)[1] in parser.NOMETA:
+            logging.debug("%s' format is either not supported or harmless", name)
+        elif name in whitelist:
+            logging.debug('%s is not supported, but MAT was told to add it anyway.', name)
+        else:  # Don't add the file to the archive
+            logging.debug('%s will not be added', name)
+            return False
+        return True
+
     def remove_all(self, whitelist=None):
         """ Remove all harmful metadata from the tarfile.
             The method will also add every files matching
@@ -225,34 +840,147 @@ class TarStripper(GenericArchiveStripper):
         """
         if not whitelist:
             whitelist = []
-        tarin = tarfile.open(self.filename, 'r' + self.compression, encoding='utf-8')
-        tarout = tarfile.open(self.output, 'w' + self.compression, encoding='utf-8')
-        for item in tarin.getmembers():
-            tarin.extract(item, self.tempdir)
-            if item.isfile():
-                path = os.path.join(self.tempdir, item.name)
-                cfile = mat.create_class_file(path, False, add2archive=self.add2archive)
-                if cfile is not None:
-                    # Handle read-only files inside archive
-                    old_stat = os.stat(path).st_mode
-                    os.chmod(path, old_stat | stat.S_IWUSR)
-                    cfile.remove_all()
-                    os.chmod(path, old_stat)
-                elif self.add2archive or os.path.splitext(item.name)[1] in parser.NOMETA:
-                    logging.debug("%s' format is either not supported or harmless", item.name)
-                elif item.name in whitelist:
-                    logging.debug('%s is not supported, but MAT was told to add it anyway.', item.name)
-                else:  # Don't add the file to the archive
-                    logging.debug('%s will not be added', item.name)
-                    continue
-                tarout.add(unicode(path.decode('utf-8')),
-                           unicode(item.name.decode('utf-8')),
-                           filter=self._remove_tar_added)
-        tarin.close()
-        tarout.close()
+        plan = self._peek_scan()
+        if plan is None and self.jobs <= 1:
+            # Nothing was extracted yet, and nothing will run concurrently:
+            # clean the archive in a single pass.
+            with open(self.filename, 'rb') as fileobj_in:
+                with open(self.output, 'wb') as fileobj_out:
+                    self._stream_clean(fileobj_in, fileobj_out, whitelist)
+            self.do_backup()
+            return True
+
+        plan = self._get_scan()
+        cleaner = MemberCleaner(self.jobs, self._member_kwargs())
+        try:
+            members = []
+            with contextlib.closing(self._members()) as items:
+                for tarin, item in items:
+                    if not item.isfile():
+                        continue
+                    member = plan.extracted(item.name)
+                    if member is not None:
+                        result = None
+                        if not member.clean:
+                            result = cleaner.submit(member.path, member.stripper_class, member.stripper)
+                        members.append((item, member.path, result))
+                        continue
+                    path = self._extract(tarin, item, item.name, item.size)
+                    stripper_class = mat.get_stripper_class(path)[1]
+                    if stripper_class is not None:
+                        members.append((item, path, cleaner.submit(path, stripper_class)))
+                    elif self._keep_unsupported(item.name, whitelist):
+                        members.append((item, path, None))
+
+            # Write the members in their original order
+            with open(self.output, 'wb') as fileobj_out:
+                tarout, writer = self._open_output(fileobj_out)
+                try:
+                    for item, path, result in members:
+                        if result is not None:
+                            result.get()
+                        tarout.add(unicode(path.decode('utf-8')),
+                                   unicode(item.name.decode('utf-8')),
+                                   filter=self._remove_tar_added)
+                    tarout.close()
+                except:
+                    if writer is not None:
+                        writer.abort()
+                    raise
+                if writer is not None:
+                    writer.close()
+        finally:
+            cleaner.close()
+            plan.close()
         self.do_backup()
         return True
 
+    def _members(self):
+        """ Read the archive in a single pass, and yield
+            the opened TarFile along with each of its members.
+        """
+        with open(self.filename, 'rb') as fileobj_in:
+            tarin, reader = self._open_input(fileobj_in)
+            try:
+                for item in tarin:
+                    yield tarin, item
+            except:  # stopped early, or on an error: don't wait for the decompressor
+                if reader is not None:
+                    reader.abort()
+                raise
+            finally:
+                tarin.close()
+                if reader is not None:
+                    reader.close()
+
+    def _open_input(self, fileobj_in):
+        """ Open a tar stream reading $fileobj_in, decompressed with
+            up to self.jobs cores when possible. Return the TarFile, and the
+            decompressor to close after it (or None).
+        """
+        stream = self.compression.lstrip(':')
+        reader = compression.open_reader(fileobj_in, stream, self.jobs)
+        if reader is None:
+            return tarfile.open(fileobj=fileobj_in, mode='r|*', encoding='utf-8'), None
+        return tarfile.open(fileobj=reader, mode='r|', encoding='utf-8'), reader
+
+    def _open_output(self, fileobj_out):
+        """ Open a tar stream writing to $fileobj_out, compressed with
+            up to self.jobs cores when possible, at the configured level.
+            Return the TarFile, and the compressor to close after it
+            (or None).
+        """
+        stream = self.compression.lstrip(':')
+        if not stream:
+            return tarfile.open(fileobj=fileobj_out, mode='w|', encoding='utf-8'), None
+        writer = compression.open_writer(fileobj_out, stream, self.compression_level, self.jobs)
+        return tarfile.open(fileobj=writer, mode='w|', encoding='utf-8'), writer
+
+    def _stream_clean(self, fileobj_in, fileobj_out, whitelist):
+        """ Read the tar stream $fileobj_in member by member, and write
+            the cleaned members to $fileobj_out as they come. They don't
+            have to be seekable: pipes are fine. Members that need
+            cleaning are spooled one at a time in the workspace.
+        """
+        tarin, reader = self._open_input(fileobj_in)
+        writer = None
+        try:
+            tarout, writer = self._open_output(fileobj_out)
+            for item in tarin:
+                if not item.isfile():
+                    continue
+                tarinfo = self._remove_tar_added(tarfile.TarInfo(item.name))
+                tarinfo.mode = item.mode
+                stripper_class = mat.get_stripper_class(item.name)[1]
+                if stripper_class is None:
+                    if self._keep_unsupported(item.name, whitelist):
+                        tarinfo.size = item.size
+                        tarout.addfile(tarinfo, tarin.extractfile(item))
+                    continue
+                self.workspace.charge(item.size)
+                fd, path = tempfile.mkstemp(suffix=os.path.basename(item.name),
+                                            dir=self.workspace.directory_for(item.size))
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        shutil.copyfileobj(tarin.extractfile(item), f, COPY_BUFFER_SIZE)
+                    _clean_member(path, self._member_kwargs())
+                    tarinfo.size = os.path.getsize(path)
+                    with open(path, 'rb') as f:
+                        tarout.addfile(tarinfo, f)
+                finally:
+                    self.workspace.release(path)
+            tarin.close()
+            tarout.close()
+        except:  # don't leave the (de)compressors running
+            for pipe in (reader, writer):
+                if pipe is not None:
+                    pipe.abort()
+            raise
+        if reader is not None:
+            reader.close()
+        if writer is not None:
+            writer.close()
+
     @staticmethod
     def is_file_clean(current_file):
         """ Check metadatas added by tarfile
@@ -270,69 +998,95 @@ class TarStripper(GenericArchiveStripper):
             return False
         return True
 
-    def is_clean(self, list_unsupported=False):
-        """ Check if the file is clean from harmful metadatas
-            When list_unsupported is True, the method returns a list
-            of all non-supported/archives files contained in the
-            archive.
-            :param bool list_unsupported:
+    @staticmethod
+    def __get_tarinfo_meta(item):
+        """ Return the metadata added by tar to a member, if any
         """
-        ret_list = []
-        tarin = tarfile.open(self.filename, 'r' + self.compression)
-        for item in tarin.getmembers():
-            if not self.is_file_clean(item) and not list_unsupported:
-                logging.debug('%s from %s has compromising tarinfo', item.name, self.filename)
-                return False
-            tarin.extract(item, self.tempdir)
-            path = os.path.join(self.tempdir, item.name)
-            if item.isfile():
-                cfile = mat.create_class_file(path, False, add2archive=self.add2archive)
-                if cfile is not None:
-                    if not cfile.is_clean():
-                        logging.debug('%s from %s has metadata', item.name.decode("utf8"), self.filename)
-                        if not list_unsupported:
-                            return False
-                        # Nested archives are treated like unsupported files
-                        elif isinstance(cfile, GenericArchiveStripper):
-                            ret_list.append(item.name)
-                else:
-                    logging.info("%s's format is not supported or harmless", item.name)
-                    if os.path.splitext(path)[1] not in parser.NOMETA:
-                        if not list_unsupported:
-                            return False
-                        ret_list.append(item.name)
-        tarin.close()
-        if list_unsupported:
-            return ret_list
-        return True
+        if TarStripper.is_file_clean(item):
+            return {}
+        return {'mtime': item.mtime, 'uid': item.uid, 'gid': item.gid,
+                'uname': item.uname, 'gname': item.gname}
 
-    def get_meta(self):
-        """ Return a dict with all the meta of the tarfile
+    def _check_headers(self, item, plan):
+        """ Record in $plan the tar metadata of the member $item,
+            and whether it is supported.
         """
-        tarin = tarfile.open(self.filename, 'r' + self.compression)
-        metadata = {}
-        for item in tarin.getmembers():
-            current_meta = {}
-            if item.isfile():
-                tarin.extract(item, self.tempdir)
-                path = os.path.join(self.tempdir, item.name)
-                class_file = mat.create_class_file(path, False, add2archive=self.add2archive)
-                if class_file is not None:
-                    meta = class_file.get_meta()
-                    if meta:
-                        current_meta['file'] = str(meta)
-                else:
-                    logging.info("%s's format is not supported or harmless", item.name)
-
-                if not self.is_file_clean(item):  # if there is meta
-                    current_meta['mtime'] = item.mtime
-                    current_meta['uid'] = item.uid
-                    current_meta['gid'] = item.gid
-                    current_meta['uname'] = item.uname
-                    current_meta['gname'] = item.gname
-                    metadata[item.name] = str(current_meta)
-        tarin.close()
-        return metadata
+        tarinfo_meta = self.__get_tarinfo_meta(item)
+        if tarinfo_meta:
+            logging.debug('%s from %s has compromising tarinfo', item.name, self.filename)
+            plan.meta[item.name] = str(tarinfo_meta)
+            plan.clean = False
+        if item.isfile() and mat.get_stripper_class(item.name)[1] is None:
+            logging.info("%s's format is not supported or harmless", item.name)
+            if os.path.splitext(item.name)[1] not in parser.NOMETA:
+                plan.unsupported.append(item.name)
+                plan.clean = False
+
+    def _scan_headers(self):
+        """ Analyse the tar metadata of every member of the archive,
+            and whether it is supported, without extracting anything.
+            Return None if the archive contains nested archives,
+            whose own content has to be analysed.
+        """
+        plan = ArchivePlan()
+        with contextlib.closing(self._members()) as items:
+            for tarin, item in items:
+                self._check_headers(item, plan)
+                stripper_class = mat.get_stripper_class(item.name)[1] if item.isfile() else None
+                if stripper_class is not None and issubclass(stripper_class, GenericArchiveStripper):
+                    return None
+        return plan
+
+    def list_unsupported(self):
+        """ Get a list of every non-supported files present in the archive.
+            Unless it contains nested archives, only the headers are read,
+            so that remove_all can still clean the archive in a single pass.
+        """
+        if self._peek_scan() is None:
+            plan = self._scan_headers()
+            if plan is not None:
+                return list(plan.unsupported)
+        return super(TarStripper, self).list_unsupported()
+
+    def _scan(self, stop_early=False):
+        """ Analyse the tar metadata of every member of the archive,
+            and the metadata of the supported files it contains,
+            in a single pass.
+        """
+        plan = ArchivePlan()
+        try:
+            with contextlib.closing(self._members()) as items:
+                for tarin, item in items:
+                    self._check_headers(item, plan)
+                    if stop_early and not plan.clean:
+                        plan.complete = False
+                        return plan
+                    if not item.isfile() or mat.get_stripper_class(item.name)[1] is None:
+                        continue
+                    path = self._extract(tarin, item, item.name, item.size)
+                    cfile = self._create_member_class_file(path)
+                    if cfile is not None:
+                        nested = isinstance(cfile, GenericArchiveStripper)
+                        current_meta = self.__get_tarinfo_meta(item)
+                        meta = cfile.get_meta()
+                        if meta:
+                            current_meta['file'] = str(meta)
+                            plan.meta[item.name] = str(current_meta)
+                        is_clean = cfile.is_clean()
+                        if not is_clean:
+                            logging.debug('%s from %s has metadata', item.name.decode("utf8"), self.filename)
+                            plan.clean = False
+                            # Nested archives are treated like unsupported files
+                            if nested:
+                                plan.unsupported.append(item.name)
+                        # Nested archives stay open, to be cleaned with their own plan
+                        plan.add_member(item.name, path, type(cfile), is_clean, cfile if nested else None)
+                        if not nested:
+                            cfile.close()
+        except:
+            plan.close()
+            raise
+        return plan
 
 
 class TerminalZipStripper(ZipStripper):
@@ -360,3 +1114,21 @@ class Bzip2Stripper(TarStripper):
     def __init__(self, filename, mime, backup, is_writable, **kwargs):
         super(Bzip2Stripper, self).__init__(filename, mime, backup, is_writable, **kwargs)
         self.compression = ':bz2'
+
+
+class XzStripper(TarStripper):
+    """ Represent a tar.xz archive
+    """
+
+    def __init__(self, filename, mime, backup, is_writable, **kwargs):
+        super(XzStripper, self).__init__(filename, mime, backup, is_writable, **kwargs)
+        self.compression = ':xz'
+
+
+class ZstdStripper(TarStripper):
+    """ Represent a tar.zst archive
+    """
+
+    def __init__(self, filename, mime, backup, is_writable, **kwargs):
+        super(ZstdStripper, self).__init__(filename, mime, backup, is_writable, **kwargs)
+        self.compression = ':zst'
@@ -0,0 +1,298 @@
+""" Multi-core compression and decompression of tar streams
+"""
+
+import bz2
+import collections
+import distutils.spawn
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+import struct
+import subprocess
+import zlib
+
+# Size of the blocks compressed independently by ParallelGzipWriter
+GZIP_BLOCK_SIZE = 128 * 1024
+
+# Compression level used when none is given
+DEFAULT_LEVELS = {'gz': 6, 'bz2': 9, 'xz': 6, 'zst': 3}
+
+# Gzip header without any name, comment, or modification time,
+# and with an "unknown" operating system.
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+# Magic numbers of the compressed streams
+MAGIC = {'gz': '\x1f\x8b', 'bz2': 'BZh'}
+
+# External multi-core (de)compressors, by order of preference.
+# pbzip2 is not used to compress, since it produces multi-stream
+# files that Python 2's bz2 module can not read back.
+COMPRESSORS = {'bz2': ('lbzip2',), 'xz': ('xz',), 'zst': ('zstd',)}
+DECOMPRESSORS = {'bz2': ('lbzip2', 'pbzip2'), 'xz': ('xz',), 'zst': ('zstd',)}
+
+# How to give the number of threads to each external program
+THREADS_OPTIONS = {'lbzip2': '-n%d', 'pbzip2': '-p%d', 'xz': '-T%d', 'zstd': '-T%d'}
+
+# Formats that can only be handled by external programs
+EXTERNAL_ONLY = frozenset(('xz', 'zst'))
+
+
+def get_jobs(jobs=None):
+    """ Return the number of cores to use: $jobs, or all of them if None
+    """
+    if jobs is None:
+        try:
+            jobs = multiprocessing.cpu_count()
+        except NotImplementedError:
+            jobs = 1
+    return max(1, jobs)
+
+
+def _find_program(names):
+    """ Return the path of the first available program of $names
+    """
+    for name in names:
+        path = distutils.spawn.find_executable(name)
+        if path is not None:
+            return path
+    return None
+
+
+def is_available(compression):
+    """ Check if tarballs compressed with $compression can be handled
+    """
+    if compression not in EXTERNAL_ONLY:
+        return True
+    return _find_program(COMPRESSORS[compression]) is not None and \
+        _find_program(DECOMPRESSORS[compression]) is not None
+
+
+def _command(program, jobs, *args):
+    """ Return the command line running $program on $jobs threads
+    """
+    name = os.path.basename(program)
+    return [program] + list(args) + [THREADS_OPTIONS[name] % jobs]
+
+
+def _deflate_block(data, level, last):
+    """ Compress $data as raw deflate, independently of the other blocks.
+        Every block but the last one ends with a sync flush, so that the
+        compressed blocks can simply be concatenated.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+    """ Write-only file object producing a gzip stream, like pigz does:
+        the input is cut in blocks, deflated concurrently in threads
+        (zlib releases the GIL), and written in order.
+        The header doesn't contain any name nor date.
+    """
+
+    def __init__(self, fileobj, level=None, jobs=None, block_size=None):
+        self.fileobj = fileobj
+        self.level = DEFAULT_LEVELS['gz'] if level is None else level
+        self.jobs = get_jobs(jobs)
+        self.block_size = block_size or GZIP_BLOCK_SIZE
+        self.pool = multiprocessing.pool.ThreadPool(self.jobs) if self.jobs > 1 else None
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+        self.crc = 0
+        self.size = 0
+        self.fileobj.write(GZIP_HEADER)
+
+    def __submit(self, block, last):
+        """ Compress $block, and write the blocks that are ready
+        """
+        if self.pool is None:
+            self.fileobj.write(_deflate_block(block, self.level, last))
+            return
+        self.pending.append(self.pool.apply_async(_deflate_block, (block, self.level, last)))
+        # Bound the memory used by the blocks in flight
+        while len(self.pending) > 2 * self.jobs:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            data = ''.join(self.buffer)
+            end = len(data) - len(data) % self.block_size
+            for start in xrange(0, end, self.block_size):
+                self.__submit(data[start:start + self.block_size], False)
+            self.buffer = [data[end:]]
+            self.buffered = len(data) - end
+
+    def close(self):
+        """ Compress the remaining data, and write the gzip trailer.
+            The underlying file object is not closed.
+        """
+        if self.fileobj is None:
+            return
+        self.__submit(''.join(self.buffer), True)
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.fileobj.write(struct.pack('<LL', self.crc & 0xffffffff, self.size & 0xffffffff))
+        self.fileobj = None
+
+    def abort(self):
+        """ Stop compressing right away, after an error
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+        self.fileobj = None
+
+
+class CompressorWriter(object):
+    """ Write-only file object compressing in-process, on a single core
+    """
+
+    def __init__(self, compressor, fileobj):
+        self.compressor = compressor
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def close(self):
+        if self.compressor is None:
+            return
+        self.fileobj.write(self.compressor.flush())
+        self.compressor = None
+
+    def abort(self):
+        """ Stop compressing, after an error
+        """
+        self.compressor = None
+
+
+def _kill(process, pipe):
+    """ Kill $process if it's still running, close its $pipe, and reap it
+    """
+    if process.poll() is None:
+        process.kill()
+    try:
+        pipe.close()
+    except IOError:  # the data still buffered can't be written anymore
+        pass
+    process.wait()
+
+
+class PipeWriter(object):
+    """ Write-only file object compressing through an external program
+    """
+
+    def __init__(self, command, fileobj):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=fileobj)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.process = None
+        if returncode != 0:
+            raise IOError('Compression failed with exit code %d' % returncode)
+
+    def abort(self):
+        """ Kill the program, and reap it, after an error
+        """
+        if self.process is None:
+            return
+        _kill(self.process, self.process.stdin)
+        self.process = None
+
+
+class PipeReader(object):
+    """ Read-only file object decompressing through an external program
+    """
+
+    def __init__(self, command, fileobj):
+        self.process = subprocess.Popen(command, stdin=fileobj, stdout=subprocess.PIPE)
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        self.process = None
+        if returncode not in (0, -13):  # -13 is SIGPIPE, when we stopped reading early
+            raise IOError('Decompression failed with exit code %d' % returncode)
+
+    def abort(self):
+        """ Kill the program, and reap it, when stopping early or after an error
+        """
+        if self.process is None:
+            return
+        _kill(self.process, self.process.stdout)
+        self.process = None
+
+
+def open_writer(fileobj, compression, level=None, jobs=None):
+    """ Return a file object compressing what is written into
+        $fileobj, with several cores when possible.
+
+        :param fileobj: Where the compressed data is written
+        :param str compression: 'gz', 'bz2', 'xz' or 'zst'
+        :param int level: Compression level
+        :param int jobs: Number of cores to use
+    """
+    jobs = get_jobs(jobs)
+    level = DEFAULT_LEVELS[compression] if level is None else level
+    if compression == 'gz':
+        return ParallelGzipWriter(fileobj, level, jobs)
+    program = _find_program(COMPRESSORS[compression])
+    if compression in EXTERNAL_ONLY or (program is not None and jobs > 1 and hasattr(fileobj, 'fileno')):
+        if program is None:
+            raise IOError('No program to compress %s' % compression)
+        logging.debug('Compressing with %s', program)
+        fileobj.flush()
+        return PipeWriter(_command(program, jobs, '-c', '-%d' % level), fileobj)
+    return CompressorWriter(bz2.BZ2Compressor(level), fileobj)
+
+
+def open_reader(fileobj, compression, jobs=None):
+    """ Return a file object of the data decompressed from $fileobj
+        with several cores, or None when there is no better way than
+        tarfile's own decompression.
+
+        :param fileobj: Where the compressed data is read, from its start
+        :param str compression: 'gz', 'bz2', 'xz', 'zst', or '' if unknown
+        :param int jobs: Number of cores to use
+    """
+    jobs = get_jobs(jobs)
+    program = _find_program(DECOMPRESSORS.get(compression, ()))
+    if compression in EXTERNAL_ONLY:
+        if program is None:
+            raise IOError('No program to decompress %s' % compression)
+    else:
+        if program is None or jobs == 1 or not hasattr(fileobj, 'fileno'):
+            return None
+        try:
+            position = fileobj.tell()
+        except IOError:  # pipes can't be peeked at
+            return None
+        # Don't trust the extension
+        magic = fileobj.read(len(MAGIC[compression]))
+        fileobj.seek(position)
+        if magic != MAGIC[compression]:
+            return None
+    logging.debug('Decompressing with %s', program)
+    return PipeReader(_command(program, jobs, '-d', '-c'), fileobj)
@@ -13,3 +13,10 @@ class UnableToWriteFile(Exception):
         can could not be chmod +w
     """
     pass
+
+
+class ArchiveLimitExceeded(Exception):
+    """This exception is raised when an archive, with the ones
+        nested in it, is too deep, too big, or has too many members
+    """
+    pass
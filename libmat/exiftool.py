@@ -1,13 +1,279 @@
 """ Care about images with help of the amazing (perl) library Exiftool.
 """
 
+import atexit
+import distutils.spawn
+import json
+import logging
+import multiprocessing.pool
+import os
+import Queue
 import subprocess
+import threading
+
 import parser
 
+# Number of long-lived exiftool processes shared by every ExiftoolStripper
+POOL_SIZE = 2
+
+# Maximum number of files passed to a single exiftool call by get_meta_batch
+BATCH_SIZE = 64
+
+# Exiftool tag names of the human-readable fields of `ExiftoolStripper.allowed`,
+# when they are not simply the same words without spaces
+TAG_NAMES = {
+    'ExifTool Version Number': 'ExifToolVersion',
+    'File Modification Date/Time': 'FileModifyDate',
+    'File Access Date/Time': 'FileAccessDate',
+    'File Inode Change Date/Time': 'FileInodeChangeDate',
+}
+
+
+def is_available():
+    """ Check if exiftool is installed
+    """
+    return distutils.spawn.find_executable('exiftool') is not None
+
+
+def _fits_argfile(arg):
+    """ Check if $arg can be passed as a line of an argfile: exiftool
+        strips the leading whitespace of each line, and skips the lines
+        starting with '#'.
+    """
+    return '\n' not in arg and arg == arg.lstrip() and not arg.startswith('#')
+
+
+class ExiftoolProcess(object):
+    """ A long-lived exiftool process, started with `-stay_open True`
+        and fed with commands through an argfile read on its stdin.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.counter = 0
+        self.start()
+
+    def start(self):
+        """ (Re)start the underlying exiftool process
+        """
+        self.close()
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(['exiftool', '-stay_open', 'True', '-@', '-'],
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=devnull)
+
+    def is_alive(self):
+        """ Check if the underlying exiftool process is still running
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def execute(self, args):
+        """ Run a single exiftool command, and return its output.
+            Each command is terminated by a numbered `-execute`,
+            which makes exiftool print a matching `{ready}` line
+            once it's done.
+
+            :param list args: Arguments of the command, one per line
+        """
+        self.counter += 1
+        ready = '{ready%d}' % self.counter
+        self.process.stdin.write('\n'.join(args + ['-execute%d' % self.counter]) + '\n')
+        self.process.stdin.flush()
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:  # exiftool died in the middle of the command
+                raise IOError('exiftool exited unexpectedly')
+            elif line.rstrip('\r\n') == ready:
+                return ''.join(output)
+            output.append(line)
+
+    def close(self):
+        """ Ask exiftool to exit, or kill it if it doesn't want to.
+        """
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write('-stay_open\nFalse\n')
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+
+class ExiftoolPool(object):
+    """ A pool of long-lived exiftool processes, to avoid paying
+        the (expensive) perl startup for every single image.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = max(1, size)
+        self.idle = Queue.Queue()
+        self.spawned = 0
+        self.lock = threading.Lock()
+
+    def __acquire(self):
+        """ Get an idle process, spawning a new one if the pool isn't full yet
+        """
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            if self.spawned < self.size:
+                self.spawned += 1
+                return None  # the caller will start it
+        return self.idle.get()
+
+    def execute(self, args):
+        """ Run an exiftool command on one of the processes of the pool,
+            and return its output. A process that crashed is restarted,
+            and the command is tried one more time.
+
+            :param list args: Arguments of the command
+        """
+        if not all(_fits_argfile(arg) for arg in args):
+            return subprocess.Popen(['exiftool'] + args, stdout=subprocess.PIPE).communicate()[0]
+
+        worker = self.__acquire()
+        try:
+            if worker is None:
+                worker = ExiftoolProcess()
+            elif not worker.is_alive():
+                worker.start()
+            try:
+                return worker.execute(args)
+            except IOError:
+                logging.info('An exiftool process crashed, restarting it')
+                worker.start()
+                return worker.execute(args)
+        finally:
+            if worker is None:  # unable to spawn exiftool
+                with self.lock:
+                    self.spawned -= 1
+            else:
+                self.idle.put(worker)
+
+    def close(self):
+        """ Stop every process of the pool
+        """
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                break
+            with self.lock:
+                self.spawned -= 1
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """ Return the exiftool pool shared by every ExiftoolStripper,
+        creating it on first use.
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ExiftoolPool(POOL_SIZE)
+        return _POOL
+
+
+def set_pool_size(size):
+    """ Change the number of exiftool processes that can run concurrently.
+        The current pool (if any) is shut down.
+
+        :param int size: Maximum number of exiftool processes
+    """
+    global POOL_SIZE
+    POOL_SIZE = size
+    close_pool()
+
+
+@atexit.register
+def close_pool():
+    """ Stop the exiftool processes of the shared pool
+    """
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.close()
+
+
+def get_meta_batch(strippers):
+    """ Fetch the metadata of several files at once, with a single
+        exiftool call per batch of at most BATCH_SIZE files. The files
+        are split between the processes of the pool, whose batches
+        run concurrently. The harmful metadata of each file is then
+        cached by its stripper, for `is_clean` and `get_meta`.
+
+        :param list strippers: ExiftoolStripper instances
+    """
+    if not strippers:
+        return
+    pool = get_pool()
+    size = min(BATCH_SIZE, -(-len(strippers) // pool.size))
+    batches = [strippers[i:i + size] for i in range(0, len(strippers), size)]
+    if len(batches) == 1:
+        _get_meta_batch(pool, batches[0])
+        return
+    threads = multiprocessing.pool.ThreadPool(min(pool.size, len(batches)))
+    try:
+        threads.map(lambda batch: _get_meta_batch(pool, batch), batches)
+    finally:
+        threads.close()
+        threads.join()
+
+
+def _get_meta_batch(pool, batch):
+    """ Fetch the metadata of the files of $batch with a single exiftool call
+    """
+    try:
+        output = pool.execute(['-j', '-G'] + [stripper.filename for stripper in batch])
+        files = json.loads(output) if output.strip() else []
+    except (IOError, OSError, ValueError):
+        logging.error('Unable to get the metadata of %d files with exiftool', len(batch))
+        return
+    by_name = dict((item.get('SourceFile'), item) for item in files if isinstance(item, dict))
+    for stripper in batch:
+        fields = by_name.get(stripper.filename.decode('utf-8', 'replace'))
+        if fields is None:  # skipped by exiftool, or with a name it mangled: scanned on its own later
+            continue
+        stripper._set_scan(stripper.filter_meta(fields))
+
+
+def parse_json(output):
+    """ Return the fields of the single file described
+        by the json output $output of `exiftool -j -G`
+
+        :raise ValueError: If the output isn't valid, or doesn't describe exactly one file
+    """
+    files = json.loads(output) if output.strip() else []
+    if not isinstance(files, list) or len(files) != 1 or not isinstance(files[0], dict):
+        raise ValueError('exiftool described %d files instead of one' % len(files))
+    return files[0]
+
+
+def _to_str(value):
+    """ Convert a value decoded from exiftool's json to an utf-8 string
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return ', '.join(_to_str(i) for i in value)
+    return str(value)
+
 
 class ExiftoolStripper(parser.GenericParser):
     """ A generic stripper class using exiftool as backend
     """
+    io_bound = True
 
     def __init__(self, filename, mime, backup, is_writable, **kwargs):
         super(ExiftoolStripper, self).__init__(filename, mime, backup, is_writable, **kwargs)
@@ -15,6 +281,8 @@ class ExiftoolStripper(parser.GenericParser):
                         'File Access Date/Time', 'File Permissions', 'File Type', 'File Type Extension', 'MIME Type',
                         'Image Width', 'Image Height', 'Image Size', 'File Inode Change Date/Time', 'Megapixels'}
         self._set_allowed()
+        self.allowed_tags = set(TAG_NAMES.get(field, field.replace(' ', '')) for field in self.allowed)
+        self.allowed_tags.add('SourceFile')
 
     def _set_allowed(self):
         """ Virtual method. Set the allowed/harmless list of metadata
@@ -29,31 +297,28 @@ class ExiftoolStripper(parser.GenericParser):
                 self.create_backup_copy()
             # Note: '-All=' must be followed by a known exiftool option.
             # Also, '-CommonIFD0' is needed for .tiff files
-            subprocess.call(['exiftool', '-all=', '-adobe=', '-exif:all=', '-Time:All=', '-m',
-                             '-CommonIFD0=', '-overwrite_original', self.filename],
-                            stdout=open('/dev/null'), stderr=open('/dev/null'))
+            get_pool().execute(['-all=', '-adobe=', '-exif:all=', '-Time:All=', '-m',
+                                '-CommonIFD0=', '-overwrite_original', self.filename])
+            self._invalidate_scan()
             return True
-        except OSError:
+        except (IOError, OSError):
             return False
 
-    def is_clean(self):
-        """ Check if the file is clean with the help of exiftool
+    def _scan(self):
+        """ Return every harmful meta with help of exiftool.
         """
-        return not self.get_meta()
+        return self.filter_meta(parse_json(get_pool().execute(['-j', '-G', self.filename])))
 
-    def get_meta(self):
-        """ Return every harmful meta with help of exiftool.
-            Exiftool output looks like this:
-            field name : value
-            field name : value
+    def filter_meta(self, fields):
+        """ Only keep the harmful fields of exiftool's json output,
+            whose keys look like this: "group:TagName"
+
+            :param dict fields: Decoded json object of a single file
         """
-        output = subprocess.Popen(['exiftool', self.filename],
-                                  stdout=subprocess.PIPE).communicate()[0]
         meta = {}
-        for i in output.split('\n')[:-1]:  # chop last char ('\n')
-            key = i.split(':')[0].strip()
-            if key not in self.allowed:
-                meta[key] = i.split(':')[1].strip()  # add the field name to the metadata set
+        for key, value in fields.items():
+            if key.split(':')[-1] not in self.allowed_tags:
+                meta[_to_str(key)] = _to_str(value)
         return meta
 
 
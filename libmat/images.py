@@ -0,0 +1,634 @@
+""" Care about images formats natively,
+    without spawning any external tool.
+"""
+
+import logging
+import mmap
+import struct
+import sys
+import zlib
+
+import exiftool
+import parser
+
+# Errors raised on images that can't be parsed natively
+PARSE_ERRORS = (EnvironmentError, ValueError, struct.error)  # mmap.error is an EnvironmentError
+
+# Size of the reads done while streaming an image
+BUFFER_SIZE = 64 * 1024
+
+# Jpeg markers
+JPEG_SOI = 0xd8
+JPEG_EOI = 0xd9
+JPEG_SOS = 0xda
+JPEG_APP0 = 0xe0
+JPEG_APP15 = 0xef
+JPEG_COM = 0xfe
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# Ancillary png chunks that are needed to correctly display the image,
+# and can't contain metadata. Critical chunks are always kept.
+PNG_HARMLESS_CHUNKS = frozenset((
+    'tRNS', 'cHRM', 'gAMA', 'sBIT', 'sRGB', 'bKGD', 'hIST', 'pHYs', 'sPLT',
+    'acTL', 'fcTL', 'fdAT',  # animated png
+))
+
+# Size of each tiff field type
+TIFF_TYPES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+
+# Tiff tags pointing to image data, and the tag holding the size of each chunk
+TIFF_DATA_TAGS = {
+    273: 279,  # StripOffsets, StripByteCounts
+    324: 325,  # TileOffsets, TileByteCounts
+    513: 514,  # JPEGInterchangeFormat, JPEGInterchangeFormatLength
+}
+
+# Tiff tags describing the image itself, that can't contain metadata
+TIFF_HARMLESS_TAGS = frozenset((
+    254, 255, 256, 257, 258, 259, 262, 263, 266, 273, 274, 277, 278, 279, 280, 281,
+    282, 283, 284, 290, 291, 296, 301, 317, 318, 319, 320, 322, 323, 324, 325, 338,
+    339, 340, 341, 347, 513, 514, 529, 530, 531, 532,
+))
+
+# Human-readable names of the most common harmful tiff tags
+TIFF_TAG_NAMES = {
+    269: 'Document Name', 270: 'Image Description', 271: 'Make', 272: 'Model',
+    285: 'Page Name', 305: 'Software', 306: 'Date Time', 315: 'Artist',
+    316: 'Host Computer', 330: 'Sub IFDs', 700: 'XMP', 33432: 'Copyright',
+    33723: 'IPTC', 34377: 'Photoshop', 34665: 'Exif', 34675: 'ICC Profile',
+    34853: 'GPS', 36867: 'Date Time Original', 36868: 'Date Time Digitized',
+    37510: 'User Comment', 42016: 'Image Unique ID', 42033: 'Serial Number',
+    42036: 'Lens Model', 50341: 'Print IM',
+}
+
+# Tags pointing to a sub-IFD
+TIFF_SUB_IFDS = (34665, 34853)  # Exif, GPS
+
+
+def _fill(fd, buf, size):
+    """ Read from `fd` until `buf` is at least `size` bytes long,
+        or the end of the file is reached.
+    """
+    while len(buf) < size:
+        chunk = fd.read(max(size - len(buf), BUFFER_SIZE))
+        if not chunk:
+            break
+        buf += chunk
+    return buf
+
+
+def walk_jpeg(fd):
+    """ Stream the segments of a jpeg file, without decoding it.
+        Yield (marker, data) tuples, where `data` is the raw segment,
+        marker and length included. The entropy-coded data following
+        a SOS segment is yielded by chunks, with None as marker.
+        Anything after the EOI marker is ignored.
+
+        :param file fd: Jpeg file, opened in binary mode
+    """
+    buf = _fill(fd, '', 2)
+    if buf[:2] != '\xff\xd8':
+        raise ValueError('Not a jpeg file')
+    yield JPEG_SOI, buf[:2]
+    buf = buf[2:]
+
+    while True:
+        buf = _fill(fd, buf, 2)
+        if len(buf) < 2:  # truncated file
+            return
+        elif buf[0] != '\xff':
+            raise ValueError('Invalid jpeg marker')
+
+        marker = ord(buf[1])
+        if marker == 0xff:  # fill byte
+            buf = buf[1:]
+            continue
+        elif marker == JPEG_EOI:
+            yield marker, buf[:2]
+            return
+        elif 0xd0 <= marker <= 0xd7 or marker == 0x01:  # standalone markers
+            yield marker, buf[:2]
+            buf = buf[2:]
+            continue
+
+        buf = _fill(fd, buf, 4)
+        length = struct.unpack('>H', buf[2:4])[0]
+        buf = _fill(fd, buf, 2 + length)
+        if len(buf) < 2 + length or length < 2:
+            raise ValueError('Truncated jpeg segment')
+        yield marker, buf[:2 + length]
+        buf = buf[2 + length:]
+
+        if marker != JPEG_SOS:
+            continue
+
+        # Entropy-coded data: everything until the next marker,
+        # ignoring stuffed bytes (0xff00) and restart markers.
+        pos = 0
+        while True:
+            pos = buf.find('\xff', pos)
+            if pos == -1 or pos == len(buf) - 1:
+                keep = buf[pos:] if pos != -1 else ''
+                if len(buf) > len(keep):
+                    yield None, buf[:len(buf) - len(keep)]
+                chunk = fd.read(BUFFER_SIZE)
+                if not chunk:  # truncated file
+                    if keep:
+                        yield None, keep
+                    return
+                buf, pos = keep + chunk, 0
+                continue
+
+            following = ord(buf[pos + 1])
+            if following == 0 or 0xd0 <= following <= 0xd7:
+                pos += 2
+            elif following == 0xff:
+                pos += 1
+            else:  # a real marker
+                if pos:
+                    yield None, buf[:pos]
+                buf = buf[pos:]
+                break
+
+
+class Unparseable(dict):
+    """ Result of the scan of an image that couldn't be parsed natively:
+        the metadata found by exiftool, or an error if it isn't available.
+    """
+    pass
+
+
+class NativeImageStripper(parser.GenericParser):
+    """ Parent of the strippers handling images without any external tool.
+        The files they can't parse are handed to the exiftool stripper
+        `fallback_class`, when exiftool is installed. Otherwise, they are
+        reported as harmful, and aren't cleaned.
+    """
+    fallback_class = None
+
+    def _create_fallback(self):
+        """ Return the exiftool stripper of the file, or None
+        """
+        if self.fallback_class is None or not exiftool.is_available():
+            return None
+        return self.fallback_class(self.filename, self.mime, self.backup, self.is_writable)
+
+    def _scan_native(self):
+        """ Virtual method. Analyse the file, raising one of
+            PARSE_ERRORS if it can't be parsed.
+        """
+        raise NotImplementedError
+
+    def _describe(self, scan):
+        """ Virtual method. Return a dict with the harmful metadata
+            of a successful `_scan_native`.
+        """
+        raise NotImplementedError
+
+    def _remove_native(self):
+        """ Virtual method. Write the cleaned file in the output,
+            raising one of PARSE_ERRORS if it can't be parsed.
+        """
+        raise NotImplementedError
+
+    def _scan(self):
+        try:
+            return self._scan_native()
+        except PARSE_ERRORS as e:
+            logging.info('Unable to parse %s natively: %s', self.filename, e)
+        return self._scan_fallback(self._create_fallback())
+
+    @staticmethod
+    def _scan_fallback(fallback):
+        """ Return the Unparseable result of the exiftool stripper $fallback
+            (or None), and close it.
+        """
+        if fallback is None:
+            return Unparseable(error='unparseable')
+        try:
+            return Unparseable(fallback.get_meta())
+        except (IOError, OSError, ValueError):
+            return Unparseable(error='unparseable')
+        finally:
+            fallback.close()
+
+    def get_meta(self):
+        """ Return a dict with all the harmful metadata of the file
+        """
+        scan = self._get_scan()
+        if isinstance(scan, Unparseable):
+            return dict(scan)
+        try:
+            return self._describe(scan)
+        except PARSE_ERRORS:
+            return {'error': 'unparseable'}
+
+    def remove_all(self):
+        """ Clean the file natively, or with exiftool
+            if it can't be parsed.
+        """
+        try:
+            self._remove_native()
+        except PARSE_ERRORS as e:
+            fallback = self._create_fallback()
+            if fallback is None:
+                logging.error('Unable to clean %s: %s', self.filename, e)
+                return False
+            logging.info('Cleaning %s with exiftool: %s', self.filename, e)
+            try:
+                return fallback.remove_all()
+            finally:
+                fallback.close()
+        self.do_backup()
+        return True
+
+
+def scan_batch(strippers):
+    """ Analyse several images at once: the ones that can't be parsed
+        natively are handed to exiftool together, with get_meta_batch.
+        The result of each file is then cached by its stripper.
+
+        :param list strippers: NativeImageStripper instances
+    """
+    pending = []
+    for stripper in strippers:
+        if stripper._peek_scan() is not None:
+            continue
+        try:
+            stripper._set_scan(stripper._scan_native())
+        except PARSE_ERRORS as e:
+            logging.info('Unable to parse %s natively: %s', stripper.filename, e)
+            pending.append((stripper, stripper._create_fallback()))
+    exiftool.get_meta_batch([fallback for _, fallback in pending if fallback is not None])
+    for stripper, fallback in pending:
+        stripper._set_scan(stripper._scan_fallback(fallback))
+
+
+class JpegStripper(NativeImageStripper):
+    """ Represent a jpeg file. Its marker segments are streamed once:
+        APP1 to APP15 (exif, xmp, iptc/photoshop, icc, adobe, ...) and
+        COM segments are dropped, and the JFIF thumbnail is removed.
+        The image itself is copied as-is, without being decoded.
+    """
+    fallback_class = exiftool.JpegStripper
+
+    @staticmethod
+    def __is_harmful(marker, data):
+        """ Check if a segment contains metadata
+        """
+        if marker == JPEG_COM or JPEG_APP0 < marker <= JPEG_APP15:
+            return True
+        elif marker == JPEG_APP0:  # only keep a JFIF header without thumbnail
+            return data[4:9] != 'JFIF\x00' or len(data) != 18 or data[16:18] != '\x00\x00'
+        return False
+
+    @staticmethod
+    def __describe(marker, data):
+        """ Return a (name, value) description of a harmful segment
+        """
+        if marker == JPEG_COM:
+            return 'Comment', data[4:].rstrip('\x00')
+        name = 'APP%d' % (marker - JPEG_APP0)
+        identifier = data[4:].split('\x00', 1)[0][:32]
+        return name, identifier or 'unknown'
+
+    def _scan_native(self):
+        """ Return the list of (marker, data) of the harmful segments of the file
+        """
+        with open(self.filename, 'rb') as f:
+            return [(marker, data) for marker, data in walk_jpeg(f)
+                    if marker is not None and self.__is_harmful(marker, data)]
+
+    def _describe(self, scan):
+        """ Return a dict with all the harmful segments of the file
+        """
+        metadata = {}
+        for marker, data in scan:
+            key, value = self.__describe(marker, data)
+            if key in metadata:
+                metadata[key] += ', ' + value
+            else:
+                metadata[key] = value
+        return metadata
+
+    def _remove_native(self):
+        """ Copy every harmless segment of the file in the output
+        """
+        with open(self.filename, 'rb') as fin, open(self.output, 'wb') as fout:
+            for marker, data in walk_jpeg(fin):
+                if marker is None or not self.__is_harmful(marker, data):
+                    fout.write(data)
+                elif marker == JPEG_APP0 and data[4:9] == 'JFIF\x00' and len(data) >= 16:
+                    # keep the JFIF header, without its thumbnail
+                    fout.write('\xff\xe0\x00\x10' + data[4:16] + '\x00\x00')
+
+
+def _mmap_view(mapping, offset, size):
+    """ Return a zero-copy view over `size` bytes of `mapping`,
+        starting at `offset`.
+    """
+    if sys.version_info[0] >= 3:
+        return memoryview(mapping)[offset:offset + size]
+    return buffer(mapping, offset, size)  # python2's mmap has no memoryview support
+
+
+def walk_png(mapping):
+    """ Walk the chunks of a mmaped png file, by only reading their headers.
+        Yield (type, start, end) tuples, where `start` and `end` are the
+        offsets of the whole chunk, length and crc included.
+
+        :param mmap.mmap mapping: Content of the png file
+    """
+    if mapping[:8] != PNG_SIGNATURE:
+        raise ValueError('Not a png file')
+    offset = 8
+    while offset + 8 <= len(mapping):
+        length, chunk_type = struct.unpack('>I4s', mapping[offset:offset + 8])
+        end = offset + 12 + length
+        if end > len(mapping):
+            raise ValueError('Truncated png chunk')
+        yield chunk_type, offset, end
+        if chunk_type == 'IEND':
+            return
+        offset = end
+
+
+class PngStripper(NativeImageStripper):
+    """ Represent a png file. Its chunks are filtered: the textual ones
+        (tEXt, zTXt, iTXt), dates (tIME), exif (eXIf), the icc profile
+        (iCCP) and unknown ancillary chunks are dropped. The other ones,
+        including the image data, are copied without recompression.
+    """
+    fallback_class = exiftool.PngStripper
+
+    @staticmethod
+    def __is_harmful(chunk_type):
+        """ Check if a chunk may contain metadata
+        """
+        is_critical = chunk_type[0].isupper()
+        return not is_critical and chunk_type not in PNG_HARMLESS_CHUNKS
+
+    @staticmethod
+    def __describe(chunk_type, data):
+        """ Return a (name, value) description of a harmful chunk
+        """
+        if chunk_type in ('tEXt', 'zTXt', 'iTXt'):
+            keyword, _, text = data.partition('\x00')
+            if chunk_type == 'zTXt':
+                text = zlib.decompressobj().decompress(text[1:], 4096)
+            elif chunk_type == 'iTXt':
+                compressed, text = text[0:1] == '\x01', text[2:]
+                text = text.split('\x00', 2)[-1]  # skip the language and the translated keyword
+                if compressed:
+                    text = zlib.decompressobj().decompress(text, 4096)
+            return keyword, text
+        elif chunk_type == 'tIME' and len(data) == 7:
+            return 'date', '%04d-%02d-%02d %02d:%02d:%02d' % struct.unpack('>HBBBBB', data)
+        elif chunk_type == 'iCCP':
+            return 'icc profile', data.split('\x00', 1)[0]
+        return chunk_type, '%d bytes' % len(data)
+
+    def __open(self):
+        """ Return a read-only mmap of the file
+        """
+        with open(self.filename, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _scan_native(self):
+        """ Return the (type, start, end) of the harmful chunks of the file,
+            by only reading the chunks headers.
+        """
+        mapping = self.__open()
+        try:
+            return [chunk for chunk in walk_png(mapping) if self.__is_harmful(chunk[0])]
+        finally:
+            mapping.close()
+
+    def _describe(self, scan):
+        """ Return a dict with the content of all the harmful chunks of the file
+        """
+        metadata = {}
+        with open(self.filename, 'rb') as f:
+            for chunk_type, start, end in scan:
+                f.seek(start + 8)
+                try:
+                    key, value = self.__describe(chunk_type, f.read(end - start - 12))
+                except zlib.error:
+                    key, value = chunk_type, 'invalid compressed text'
+                metadata[key] = value
+        return metadata
+
+    def _remove_native(self):
+        """ Copy every harmless chunk of the file in the output,
+            straight from a mmap of the file.
+        """
+        mapping = self.__open()
+        try:
+            with open(self.output, 'wb') as fout:
+                fout.write(PNG_SIGNATURE)
+                for chunk_type, start, end in walk_png(mapping):
+                    if not self.__is_harmful(chunk_type):
+                        fout.write(_mmap_view(mapping, start, end - start))
+        finally:
+            mapping.close()
+
+
+class TiffEntry(object):
+    """ A directory entry of a tiff file
+    """
+
+    def __init__(self, tag, field_type, count, value, endian):
+        self.tag = tag
+        self.type = field_type
+        self.count = count
+        self.value = value  # the raw 4 bytes of the entry's value field
+        self.size = TIFF_TYPES.get(field_type, 1) * count
+        self.endian = endian
+
+    def read(self, fd):
+        """ Return the raw data of the entry
+        """
+        if self.size <= 4:
+            return self.value[:self.size]
+        fd.seek(struct.unpack(self.endian + 'I', self.value)[0])
+        data = fd.read(self.size)
+        if len(data) != self.size:
+            raise ValueError('Truncated tiff entry')
+        return data
+
+    def integers(self, fd):
+        """ Return the values of a SHORT or LONG entry
+        """
+        if self.type not in (3, 4, 13):
+            raise ValueError('Unexpected tiff entry type')
+        fmt = 'H' if self.type == 3 else 'I'
+        return struct.unpack('%s%d%s' % (self.endian, self.count, fmt), self.read(fd))
+
+
+def read_tiff_header(fd):
+    """ Return the byte order and the offset of the first IFD of a tiff file
+    """
+    fd.seek(0)
+    header = fd.read(8)
+    if header[:4] == 'II*\x00':
+        endian = '<'
+    elif header[:4] == 'MM\x00*':
+        endian = '>'
+    else:  # BigTIFF isn't supported
+        raise ValueError('Not a (classic) tiff file')
+    return endian, struct.unpack(endian + 'I', header[4:])[0]
+
+
+def read_tiff_ifd(fd, offset, endian):
+    """ Return the entries of the IFD at `offset`,
+        and the offset of the next one.
+    """
+    fd.seek(offset)
+    count_data = fd.read(2)
+    if len(count_data) != 2:
+        raise ValueError('Truncated tiff IFD')
+    count = struct.unpack(endian + 'H', count_data)[0]
+    data = fd.read(12 * count + 4)
+    if len(data) != 12 * count + 4:
+        raise ValueError('Truncated tiff IFD')
+    entries = []
+    for i in range(count):
+        tag, field_type, field_count = struct.unpack(endian + 'HHI', data[12 * i:12 * i + 8])
+        entries.append(TiffEntry(tag, field_type, field_count, data[12 * i + 8:12 * i + 12], endian))
+    return entries, struct.unpack(endian + 'I', data[-4:])[0]
+
+
+def walk_tiff(fd):
+    """ Yield the entries of every IFD (that is, every page) of a tiff file
+
+        :param file fd: Tiff file, opened in binary mode
+    """
+    endian, offset = read_tiff_header(fd)
+    seen = set()
+    while offset and offset not in seen:  # don't loop on circular IFDs
+        seen.add(offset)
+        entries, offset = read_tiff_ifd(fd, offset, endian)
+        yield entries
+
+
+class TiffStripper(NativeImageStripper):
+    """ Represent a tiff file. Its IFDs are rewritten to only keep the
+        entries describing the image, dropping the textual tags and the
+        Exif, GPS, XMP and IPTC ones; the strips/tiles are copied as-is.
+    """
+    fallback_class = exiftool.TiffStripper
+
+    @staticmethod
+    def __describe(fd, entry):
+        """ Return a human-readable value of a harmful entry
+        """
+        if entry.type == 2:  # ASCII
+            return entry.read(fd).rstrip('\x00')
+        return '%d bytes' % entry.size
+
+    def _scan_native(self):
+        """ Return a dict with all the harmful tags of the file, and the
+            content of its Exif and GPS sub-IFDs.
+        """
+        metadata = {}
+        with open(self.filename, 'rb') as f:
+            endian = read_tiff_header(f)[0]
+            for entries in walk_tiff(f):
+                for entry in entries:
+                    if entry.tag in TIFF_HARMLESS_TAGS:
+                        continue
+                    name = TIFF_TAG_NAMES.get(entry.tag, 'Tag %d' % entry.tag)
+                    if entry.tag in TIFF_SUB_IFDS and entry.type in (4, 13):
+                        try:
+                            sub_entries = read_tiff_ifd(f, entry.integers(f)[0], endian)[0]
+                        except ValueError:
+                            metadata[name] = 'invalid'
+                            continue
+                        for sub_entry in sub_entries:
+                            sub_name = TIFF_TAG_NAMES.get(sub_entry.tag, 'Tag %d' % sub_entry.tag)
+                            metadata['%s %s' % (name, sub_name)] = self.__describe(f, sub_entry)
+                    else:
+                        metadata[name] = self.__describe(f, entry)
+        return metadata
+
+    def _describe(self, scan):
+        return dict(scan)
+
+    @staticmethod
+    def __align(fout):
+        """ Tiff offsets must be on a word boundary
+        """
+        if fout.tell() % 2:
+            fout.write('\x00')
+
+    @staticmethod
+    def __copy(fin, fout, offset, size):
+        """ Copy `size` bytes at `offset` from `fin` to the end of `fout`
+        """
+        fin.seek(offset)
+        while size > 0:
+            chunk = fin.read(min(size, BUFFER_SIZE))
+            if not chunk:
+                raise ValueError('Truncated tiff data')
+            fout.write(chunk)
+            size -= len(chunk)
+
+    def __write_ifd(self, fin, fout, entries, endian):
+        """ Write the image data and the harmless entries of an IFD,
+            then the IFD itself. Return the offset of the IFD, and the one
+            of its (blank) next IFD pointer.
+        """
+        kept = dict((entry.tag, entry) for entry in entries if entry.tag in TIFF_HARMLESS_TAGS)
+        fields = {}  # tag -> (type, count, data)
+
+        for offsets_tag, sizes_tag in TIFF_DATA_TAGS.items():
+            if offsets_tag not in kept:
+                continue
+            elif sizes_tag not in kept:
+                raise ValueError('Tiff image data without size')
+            offsets = kept[offsets_tag].integers(fin)
+            sizes = kept[sizes_tag].integers(fin)
+            new_offsets = []
+            for offset, size in zip(offsets, sizes):
+                self.__align(fout)
+                new_offsets.append(fout.tell())
+                self.__copy(fin, fout, offset, size)
+            fields[offsets_tag] = (4, len(new_offsets), struct.pack('%s%dI' % (endian, len(new_offsets)), *new_offsets))
+
+        for tag, entry in kept.items():
+            if tag not in fields:
+                fields[tag] = (entry.type, entry.count, entry.read(fin))
+
+        values = {}
+        for tag, (_, _, data) in sorted(fields.items()):
+            if len(data) > 4:
+                self.__align(fout)
+                values[tag] = struct.pack(endian + 'I', fout.tell())
+                fout.write(data)
+            else:
+                values[tag] = data.ljust(4, '\x00')
+
+        self.__align(fout)
+        ifd_offset = fout.tell()
+        fout.write(struct.pack(endian + 'H', len(fields)))
+        for tag, (field_type, count, _) in sorted(fields.items()):
+            fout.write(struct.pack(endian + 'HHI', tag, field_type, count) + values[tag])
+        next_pointer = fout.tell()
+        fout.write('\x00' * 4)
+        return ifd_offset, next_pointer
+
+    def _remove_native(self):
+        """ Rewrite the file, keeping only the harmless entries of its IFDs,
+            and copying the strips/tiles without re-encoding them.
+        """
+        with open(self.filename, 'rb') as fin, open(self.output, 'wb') as fout:
+            endian = read_tiff_header(fin)[0]
+            fout.write(('II*\x00' if endian == '<' else 'MM\x00*') + '\x00' * 4)
+            pointer = 4  # where to write the offset of the next IFD
+            for entries in list(walk_tiff(fin)):
+                ifd_offset, next_pointer = self.__write_ifd(fin, fout, entries, endian)
+                fout.seek(pointer)
+                fout.write(struct.pack(endian + 'I', ifd_offset))
+                fout.seek(0, 2)
+                pointer = next_pointer
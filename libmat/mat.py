@@ -3,11 +3,12 @@
 """ Metadata anonymisation toolkit library
 """
 
+import binascii
 import logging
 import mimetypes
 import os
-import platform
-import subprocess
+import Queue
+import threading
 import xml.sax
 
 import libmat.exceptions
@@ -21,6 +22,24 @@ logging.basicConfig(filename='', level=LOGGING_LEVEL)
 
 import strippers  # this is loaded here because we need LOGGING_LEVEL
 
+# Secure removal: number of overwriting passes, and the pattern
+# used to overwrite files (None means random data).
+SHRED_PASSES = 3
+SHRED_PATTERN = None
+SHRED_BLOCK_SIZE = 1024 * 1024
+
+# Mimetypes of the tarballs, according to their compression
+COMPRESSED_TARS = {
+    'gzip': 'application/x-gzip',
+    'bzip2': 'application/x-bzip2',
+    'xz': 'application/x-xz',
+    'zstd': 'application/x-zstd-compressed-tar',
+}
+
+# Python 2's mimetypes doesn't know about zstd
+mimetypes.encodings_map.setdefault('.zst', 'zstd')
+mimetypes.suffix_map.setdefault('.tzst', '.tar.zst')
+
 
 def get_logo():  # pragma: no cover
     """ Return the path to the logo
@@ -105,9 +124,55 @@ class XMLParser(xml.sax.handler.ContentHandler):  # pragma: no cover
             self.content += characters
 
 
-def secure_remove(filename):
-    """ Securely remove $filename
+def _overwrite(filename, passes, pattern):
+    """ Overwrite the content of $filename in place, by large aligned
+        writes, synchronising the data to the disk after every pass.
+
+    :param str filename: File to be overwritten
+    :param int passes: Number of passes
+    :param str pattern: Overwriting pattern, random data if None
+    """
+    fd = os.open(filename, os.O_WRONLY)
+    try:
+        stat = os.fstat(fd)
+        blocksize = getattr(stat, 'st_blksize', 0) or 4096
+        size = -(-stat.st_size // blocksize) * blocksize  # up to the last (partial) block
+        for _ in range(passes):
+            if pattern is None:
+                block = os.urandom(min(size, SHRED_BLOCK_SIZE))
+            else:
+                block = (pattern * (SHRED_BLOCK_SIZE // len(pattern) + 1))[:SHRED_BLOCK_SIZE]
+            os.lseek(fd, 0, os.SEEK_SET)
+            remaining = size
+            while remaining > 0:
+                remaining -= os.write(fd, block[:remaining])
+            if hasattr(os, 'fdatasync'):
+                os.fdatasync(fd)
+            else:  # pragma: no cover
+                os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _anonymous_rename(filename):
+    """ Rename $filename to a random name, to hide its original one.
+        Return the new path.
+    """
+    dirname = os.path.dirname(filename)
+    while True:
+        newname = os.path.join(dirname, binascii.hexlify(os.urandom(8)))
+        if not os.path.lexists(newname):
+            os.rename(filename, newname)
+            return newname
+
+
+def secure_remove(filename, passes=None, pattern=None):
+    """ Securely remove $filename: overwrite its content,
+        rename it, then unlink it.
+
     :param str filename: File to be removed
+    :param int passes: Number of overwriting passes (SHRED_PASSES by default)
+    :param str pattern: Overwriting pattern (SHRED_PATTERN by default)
     """
     try:  # I want the file removed, even if it's read-only
         os.chmod(filename, 220)
@@ -116,14 +181,10 @@ def secure_remove(filename):
         raise libmat.exceptions.UnableToWriteFile
 
     try:
-        shred = 'shred'
-        if platform.system() == 'MacOS':
-            shred = 'gshred'
-        if not subprocess.call([shred, '--remove', filename]):
-            return True
-        else:
-            raise OSError
-    except OSError:
+        _overwrite(filename, SHRED_PASSES if passes is None else passes,
+                   SHRED_PATTERN if pattern is None else pattern)
+        filename = _anonymous_rename(filename)
+    except (IOError, OSError):
         logging.error('Unable to securely remove %s', filename)
 
     try:
@@ -135,6 +196,61 @@ def secure_remove(filename):
     return True
 
 
+class SecureRemover(object):
+    """ Securely remove files from a worker thread,
+        while the caller does something else.
+    """
+
+    def __init__(self, passes=None, pattern=None):
+        self.passes = passes
+        self.pattern = pattern
+        self.failed = []
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __run(self):
+        """ Remove the queued files, until None is queued
+        """
+        while True:
+            filename = self.queue.get()
+            if filename is None:
+                return
+            try:
+                secure_remove(filename, self.passes, self.pattern)
+            except (libmat.exceptions.UnableToWriteFile, libmat.exceptions.UnableToRemoveFile):
+                self.failed.append(filename)
+
+    def remove(self, filename):
+        """ Queue $filename for secure removal
+
+        :param str filename: File to be removed
+        """
+        self.queue.put(filename)
+
+    def wait(self):
+        """ Wait until every queued file is removed.
+            Return False if some of them couldn't be removed.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        return not self.failed
+
+
+def secure_remove_batch(filenames, passes=None, pattern=None):
+    """ Securely remove several files at once, from a worker thread
+
+    :param list filenames: Files to be removed
+    :param int passes: Number of overwriting passes (SHRED_PASSES by default)
+    :param str pattern: Overwriting pattern (SHRED_PATTERN by default)
+    """
+    remover = SecureRemover(passes, pattern)
+    for filename in filenames:
+        remover.remove(filename)
+    return remover.wait()
+
+
 def create_class_file(name, backup, **kwargs):
     """ Return a $FILETYPEStripper() class,
         corresponding to the filetype of the given file
@@ -149,22 +265,37 @@ def create_class_file(name, backup, **kwargs):
         logging.error('%s is is not readable', name)
         return None
 
-    mime = mimetypes.guess_type(name)[0]
+    mime, stripper_class = get_stripper_class(name)
+    if stripper_class is None:
+        return None
+
+    is_writable = os.access(name, os.W_OK)
+
+    return stripper_class(name, mime, backup, is_writable, **kwargs)
+
+
+def get_stripper_class(name):
+    """ Return the mimetype of the given filename, and the
+        $FILETYPEStripper class that would handle it (or None).
+        Only the name is looked at: the file doesn't need to exist.
+
+        :param str name: name of the file
+    """
+    mime, encoding = mimetypes.guess_type(name)
     if not mime:
         logging.info('Unable to find mimetype of %s', name)
-        return None
+        return None, None
+
+    if mime == 'application/x-tar' and encoding in COMPRESSED_TARS:
+        mime = COMPRESSED_TARS[encoding]  # compressed tarball
 
     if mime.startswith('application/vnd.oasis.opendocument'):
         mime = 'application/opendocument'  # opendocument fileformat
     elif mime.startswith('application/vnd.openxmlformats-officedocument'):
         mime = 'application/officeopenxml'  # office openxml
 
-    is_writable = os.access(name, os.W_OK)
-
     try:
-        stripper_class = strippers.STRIPPERS[mime]
+        return mime, strippers.STRIPPERS[mime]
     except KeyError:
         logging.info('Don\'t have stripper for %s format', mime)
-        return None
-
-    return stripper_class(name, mime, backup, is_writable, **kwargs)
+        return mime, None
@@ -16,22 +16,6 @@ class TorrentStripper(parser.GenericParser):
         self.fields = frozenset(['announce', 'info', 'name', 'path', 'piece length', 'pieces',
                                  'length', 'files', 'announce-list', 'nodes', 'httpseeds', 'private', 'root hash'])
 
-    def __get_key_recursively(self, dictionary):
-        """ Get recursively all keys from a dict and
-            its subdicts
-        """
-        for i, j in list(dictionary.items()):
-            if isinstance(j, dict):
-                return {i}.union(self.__get_key_recursively(j))
-            return {i}
-
-    def is_clean(self):
-        """ Check if the file is clean from harmful metadata
-        """
-        with open(self.filename, 'r') as f:
-            decoded = bencode.bdecode(f.read())
-        return self.fields.issuperset(self.__get_key_recursively(decoded))
-
     def __get_meta_recursively(self, dictionary):
         """ Get recursively all harmful metadata
         """
@@ -43,7 +27,7 @@ class TorrentStripper(parser.GenericParser):
                 d = dict(d.items() + list(self.__get_meta_recursively(j).items()))
         return d
 
-    def get_meta(self):
+    def _scan(self):
         """ Return a dict with all the meta of the file
         """
         with open(self.filename, 'r') as f:
@@ -19,10 +19,6 @@ class MutagenStripper(parser.GenericParser):
         """ This method must be overridden to instantiate the `mfile` attribute."""
         raise NotImplementedError
 
-    def is_clean(self):
-        """ Check if the file is clean. """
-        return not self.mfile.tags
-
     def remove_all(self):
         """ Remove all harmful metadata. """
         if self.backup:
@@ -32,9 +28,10 @@ class MutagenStripper(parser.GenericParser):
             self.mfile.save()
         except ValueError:
             pass
+        self._invalidate_scan()
         return True
 
-    def get_meta(self):
+    def _scan(self):
         """
             Return the content of the metadata block is present
         """
@@ -51,7 +48,7 @@ class MpegAudioStripper(MutagenStripper):
     def _create_mfile(self):
         self.mfile = MP3(self.filename)
 
-    def get_meta(self):
+    def _scan(self):
         """
             Return the content of the metadata block is present
         """
@@ -87,17 +84,13 @@ class FlacStripper(MutagenStripper):
         super(FlacStripper, self).remove_all()
         self.mfile.clear_pictures()
         self.mfile.save()
+        self._invalidate_scan()
         return True
 
-    def is_clean(self):
-        """ Check if the "metadata" block is present in the file
-        """
-        return super(FlacStripper, self).is_clean() and not self.mfile.pictures
-
-    def get_meta(self):
+    def _scan(self):
         """ Return the content of the metadata block if present
         """
-        metadata = super(FlacStripper, self).get_meta()
+        metadata = super(FlacStripper, self)._scan()
         if self.mfile.pictures:
             metadata['picture:'] = 'yes'
         return metadata
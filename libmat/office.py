@@ -4,10 +4,8 @@
 
 import logging
 import os
-import shutil
 import tempfile
 import xml.dom.minidom as minidom
-import zipfile
 
 try:
     import cairo
@@ -17,54 +15,136 @@ try:
 except ImportError:
     logging.info('office.py loaded without PDF support')
 
+import mat
 import parser
+import pdfscan
 import archive
 
+# Minimal number of pages rendered by each process
+PDF_PAGES_PER_JOB = 16
+
+
+def page_ranges(pages, jobs):
+    """ Split $pages pages in at most $jobs contiguous ranges,
+        of at least PDF_PAGES_PER_JOB pages each but the last one.
+        Return a list of (first, last) tuples, last excluded.
+    """
+    size = max(PDF_PAGES_PER_JOB, -(-pages // max(1, jobs)))
+    return [(first, min(first + size, pages)) for first in range(0, pages, size)] or [(0, 0)]
+
+
+def _render_pages(uri, password, first, last, quality):
+    """ Render the pages $first to $last (excluded) of the PDF at $uri
+        on a cairo pdfsurface, and return the path of the produced file.
+        Poppler's documents can't be shared between processes,
+        so each worker opens its own.
+    """
+    document = Poppler.Document.new_from_file(uri, password)
+    fd, output = tempfile.mkstemp()
+    os.close(fd)
+
+    # Size doesn't matter (pun intended),
+    # since the surface will be resized before
+    # being rendered
+    surface = cairo.PDFSurface(output, 10, 10)
+    context = cairo.Context(surface)  # context draws on the surface
+
+    for pagenum in range(first, last):
+        page = document.get_page(pagenum)
+        page_width, page_height = page.get_size()
+        surface.set_size(page_width, page_height)
+        context.save()
+        if quality:  # this may reduce the produced PDF size
+            page.render(context)
+        else:
+            page.render_for_printing(context)
+        context.restore()
+        context.show_page()  # draw context on surface
+    surface.finish()
+    return output
+
+
+# What the structural PDF cleaning leaves in the document, by kind
+PDF_RESIDUAL_RISKS = {
+    'annotations': 'annotations, which may hold the names of their authors and dates',
+    'attachments': 'files attached to annotations',
+    'forms': 'form fields and their values',
+    'images': 'images, copied with their own metadata (eg. exif)',
+    'javascript': 'javascript',
+    'content': 'text and drawings, including hidden ones, since nothing is re-rendered',
+}
+
+
+def _pdf_residual_risks(trailer):
+    """ Return the description of what could still be harmful
+        in the PDF $trailer, once its metadata structures are removed.
+    """
+    import pdfrw
+
+    risks = set(['content'])
+    root = trailer.Root
+    if root.AcroForm is not None:
+        risks.add('forms')
+    if root.Names is not None and root.Names.JavaScript is not None:
+        risks.add('javascript')
+    if root.OpenAction is not None and not isinstance(root.OpenAction, list) and \
+            root.OpenAction.S == pdfrw.PdfName.JavaScript:
+        risks.add('javascript')
+    for page in trailer.pages:
+        for annotation in page.Annots or []:
+            risks.add('annotations')
+            if annotation.Subtype == pdfrw.PdfName.FileAttachment:
+                risks.add('attachments')
+        resources = page.inheritable.Resources
+        if resources is not None and resources.XObject is not None:
+            for xobject in resources.XObject.values():
+                if xobject.Subtype == pdfrw.PdfName.Image:
+                    risks.add('images')
+    return [PDF_RESIDUAL_RISKS[risk] for risk in sorted(risks)]
+
 
 class OpenDocumentStripper(archive.TerminalZipStripper):
     """ An open document file is a zip, with xml file into.
         The one that interest us is meta.xml
     """
 
-    def get_meta(self):
-        """ Return a dict with all the meta of the file by
-            trying to read the meta.xml file.
+    def _check_headers(self, zipin, plan):
+        """ Check the archive's headers, and look for a meta.xml file.
         """
-        metadata = super(OpenDocumentStripper, self).get_meta()
-        zipin = zipfile.ZipFile(self.filename, 'r')
+        super(OpenDocumentStripper, self)._check_headers(zipin, plan)
+        if 'meta.xml' in zipin.namelist():
+            plan.clean = False
+
+    def _is_scrubbed(self, name):
+        """ The content, styles and settings can hold the authors of
+            the tracked changes and comments, and the printer used.
+        """
+        return name in ('content.xml', 'styles.xml', 'settings.xml')
+
+    def _scan(self, stop_early=False):
+        """ Analyse the archive, and the meta.xml file if present.
+        """
+        scan = super(OpenDocumentStripper, self)._scan(stop_early)
+        if not scan.complete:
+            return scan
         try:
-            content = zipin.read('meta.xml')
+            content = self._get_index().read('meta.xml')
+            scan.clean = False
             dom1 = minidom.parseString(content)
             elements = dom1.getElementsByTagName('office:meta')
             for i in elements[0].childNodes:
                 if i.tagName != 'meta:document-statistic':
                     nodename = ''.join(i.nodeName.split(':')[1:])
-                    metadata[nodename] = ''.join([j.data for j in i.childNodes])
+                    scan.meta[nodename] = ''.join([j.data for j in i.childNodes])
         except KeyError:  # no meta.xml file found
             logging.debug('%s has no opendocument metadata', self.filename)
-        zipin.close()
-        return metadata
+        return scan
 
     def remove_all(self):
         """ Removes metadata
         """
         return super(OpenDocumentStripper, self).remove_all(ending_blacklist=['meta.xml'])
 
-    def is_clean(self):
-        """ Check if the file is clean from harmful metadatas
-        """
-        clean_super = super(OpenDocumentStripper, self).is_clean()
-        if clean_super is False:
-            return False
-
-        zipin = zipfile.ZipFile(self.filename, 'r')
-        try:
-            zipin.getinfo('meta.xml')
-        except KeyError:  # no meta.xml in the file
-            return True
-        zipin.close()
-        return False
-
 
 class OpenXmlStripper(archive.TerminalZipStripper):
     """ Represent an office openxml document, which is like
@@ -79,33 +159,20 @@ class OpenXmlStripper(archive.TerminalZipStripper):
         return super(OpenXmlStripper, self).remove_all(
             beginning_blacklist=['docProps/'], whitelist=['.rels'])
 
-    def is_clean(self):
-        """ Check if the file is clean from harmful metadatas.
-            This implementation is faster than something like
-            "return this.get_meta() == {}".
+    def _is_scrubbed(self, name):
+        """ The parts of the document itself can hold the authors and dates of
+            the tracked changes and comments, and the revision identifiers.
         """
-        clean_super = super(OpenXmlStripper, self).is_clean()
-        if clean_super is False:
-            return False
-
-        zipin = zipfile.ZipFile(self.filename)
-        for item in zipin.namelist():
-            if item.startswith('docProps/'):
-                return False
-        zipin.close()
-        return True
+        return name.endswith('.xml') and name.split('/', 1)[0] in ('word', 'xl', 'ppt')
 
-    def get_meta(self):
-        """ Return a dict with all the meta of the file
+    def _check_headers(self, zipin, plan):
+        """ Check the archive's headers, and look for the docProps folder.
         """
-        metadata = super(OpenXmlStripper, self).get_meta()
-
-        zipin = zipfile.ZipFile(self.filename)
+        super(OpenXmlStripper, self)._check_headers(zipin, plan)
         for item in zipin.namelist():
             if item.startswith('docProps/'):
-                metadata[item] = 'harmful content'
-        zipin.close()
-        return metadata
+                plan.clean = False
+                plan.meta[item] = 'harmful content'
 
 
 class PdfStripper(parser.GenericParser):
@@ -120,19 +187,20 @@ class PdfStripper(parser.GenericParser):
             self.pdf_quality = kwargs['low_pdf_quality']
         except KeyError:
             self.pdf_quality = False
+        self.jobs = kwargs.get('jobs') or 1
+        # Only remove the metadata structures, without re-rendering
+        self.structural = kwargs.get('structural_pdf', False)
+        self.residual_risks = []
 
         self.meta_list = frozenset(['title', 'author', 'subject',
                                     'keywords', 'creator', 'producer', 'metadata'])
 
-    def is_clean(self):
-        """ Check if the file is clean from harmful metadatas
-        """
-        document = Poppler.Document.new_from_file(self.uri, self.password)
-        return not any(document.get_property(key) for key in self.meta_list)
-
     def remove_all(self):
         """ Opening the PDF with poppler, then doing a render
-            on a cairo pdfsurface for each pages.
+            on a cairo pdfsurface for each pages. With several jobs,
+            ranges of pages are rendered in the processes shared with
+            the archives (see archive.start_processes), and merged
+            back with pdfrw.
 
             http://cairographics.org/documentation/pycairo/2/
 
@@ -140,32 +208,28 @@ class PdfStripper(parser.GenericParser):
             python-cairo segfaults on unicode.
             See http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=699457
         """
-        document = Poppler.Document.new_from_file(self.uri, self.password)
+        if self.structural:
+            return self.__remove_structural()
+        parts = []
         try:
-            output = tempfile.mkstemp()[1]
-
-            # Size doesn't matter (pun intended),
-            # since the surface will be resized before
-            # being rendered
-            surface = cairo.PDFSurface(output, 10, 10)
-            context = cairo.Context(surface)  # context draws on the surface
-
-            logging.debug('PDF rendering of %s', self.filename)
-            for pagenum in range(document.get_n_pages()):
-                page = document.get_page(pagenum)
-                page_width, page_height = page.get_size()
-                surface.set_size(page_width, page_height)
-                context.save()
-                if self.pdf_quality:  # this may reduce the produced PDF size
-                    page.render(context)
-                else:
-                    page.render_for_printing(context)
-                context.restore()
-                context.show_page()  # draw context on surface
-            surface.finish()
-            shutil.move(output, self.output)
+            document = Poppler.Document.new_from_file(self.uri, self.password)
+            ranges = page_ranges(document.get_n_pages(), self.jobs)
+            del document
+
+            processes = archive.get_processes(self.jobs) if len(ranges) > 1 else None
+            if processes is None:  # everything is rendered here, in a single part
+                logging.debug('PDF rendering of %s', self.filename)
+                parts.append(_render_pages(self.uri, self.password, 0, ranges[-1][1], self.pdf_quality))
+            else:
+                logging.debug('PDF rendering of %s, in %d parts', self.filename, len(ranges))
+                results = [processes.apply_async(_render_pages, (self.uri, self.password, first, last,
+                                                                 self.pdf_quality)) for first, last in ranges]
+                for result in results:
+                    parts.append(result.get())
         except:
             logging.error('Something went wrong when cleaning %s.', self.filename)
+            for part in parts:
+                mat.secure_remove(part)
             return False
 
         try:
@@ -174,24 +238,87 @@ class PdfStripper(parser.GenericParser):
             import pdfrw
 
             logging.debug('Removing %s\'s superficial metadata', self.filename)
-            trailer = pdfrw.PdfReader(self.output)
-            trailer.Info.Producer = None
-            trailer.Info.Creator = None
-            writer = pdfrw.PdfWriter()
-            writer.trailer = trailer
+            if len(parts) == 1:
+                trailer = pdfrw.PdfReader(parts[0])
+                trailer.Info.Producer = None
+                trailer.Info.Creator = None
+                writer = pdfrw.PdfWriter()
+                writer.trailer = trailer
+            else:  # the merged document doesn't get any Info dict
+                writer = pdfrw.PdfWriter()
+                for part in parts:
+                    writer.addpages(pdfrw.PdfReader(part).pages)
             writer.write(self.output)
             self.do_backup()
         except:
             logging.error('Unable to remove all metadata from %s, please install pdfrw', self.output)
             return False
+        finally:
+            for part in parts:
+                mat.secure_remove(part)
         return True
 
-    def get_meta(self):
-        """ Return a dict with all the meta of the file
+    def __remove_structural(self):
+        """ Remove the Info dict, the document ID, the xmp metadata and the
+            private data of the document and of its pages, and the names of
+            the embedded files, then rewrite the document with pdfrw, without
+            rendering it. Text stays searchable, but the content isn't
+            sanitised: what could still be harmful is kept in `residual_risks`.
+        """
+        try:
+            import pdfrw
+        except ImportError:
+            logging.error('Unable to clean %s without rendering it, please install pdfrw', self.filename)
+            return False
+
+        try:
+            trailer = pdfrw.PdfReader(self.filename, decompress=False)
+            trailer.Info = None
+            trailer.ID = None
+            root = trailer.Root
+            root.Metadata = None
+            root.PieceInfo = None
+            if root.Names is not None:
+                root.Names.EmbeddedFiles = None
+            for page in trailer.pages:
+                page.Metadata = None
+                page.PieceInfo = None
+            self.residual_risks = _pdf_residual_risks(trailer)
+            writer = pdfrw.PdfWriter()
+            writer.trailer = trailer
+            writer.write(self.output)
+        except:
+            logging.error('Something went wrong when cleaning %s.', self.filename)
+            return False
+
+        for risk in self.residual_risks:
+            logging.warning('%s may still contain %s', self.filename, risk)
+        self.do_backup()
+        return True
+
+    def _scan(self):
+        """ Return a dict with all the meta of the file, found by
+            pdfscan without loading the document. Poppler is only used
+            for the files pdfscan can't handle (eg. encrypted ones).
+        """
+        try:
+            found = pdfscan.scan(self.filename)
+        except (EnvironmentError, ValueError) as e:  # mmap.error is an EnvironmentError
+            logging.debug('%s, using Poppler', e)
+            return self.__poppler_scan()
+        metadata = {}
+        for key, value in found.items():
+            if key.lower() in self.meta_list and value:
+                metadata[key.lower()] = value
+        return metadata
+
+    def __poppler_scan(self):
+        """ Return a dict with all the meta of the file, according to Poppler
         """
         document = Poppler.Document.new_from_file(self.uri, self.password)
         metadata = {}
         for key in self.meta_list:
-            if document.get_property(key):
-                metadata[key] = document.get_property(key)
+            value = document.get_property(key)
+            if value:
+                metadata[key] = value
         return metadata
@@ -7,6 +7,7 @@ import tempfile
 
 
 import mat
+import workspace
 
 NOMETA = frozenset((
     '.bmp',   # "raw" image
@@ -22,6 +23,10 @@ FIELD = object()
 class GenericParser(object):
     """ Parent class of all parsers
     """
+    # Set to True when the stripper mostly waits on external processes,
+    # so that archive members it handles are cleaned in threads
+    io_bound = False
+
     def __init__(self, filename, mime, backup, is_writable, **kwargs):
         self.filename = ''
         self.mime = mime
@@ -29,19 +34,106 @@ class GenericParser(object):
         self.is_writable = is_writable
         self.filename = filename
         self.basename = os.path.basename(filename)
-        self.output = tempfile.mkstemp()[1]
+        # Members of archives are cleaned in the workspace: their output is
+        # created next to them, and they aren't shredded if it's in RAM.
+        self.in_workspace = kwargs.get('in_workspace', False)
+        self.__output = None
+        self.__scan = None
+        self.__scan_key = None
 
     def __del__(self):
         """ Remove tempfile if it was not used
         """
-        if os.path.exists(self.output):
-            mat.secure_remove(self.output)
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def output(self):
+        """ Path of the tempfile in which the cleaned file is written.
+            It is only created when a stripper actually needs it.
+        """
+        if self.__output is None:
+            directory = os.path.dirname(os.path.abspath(self.filename)) if self.in_workspace else None
+            fd, self.__output = tempfile.mkstemp(dir=directory)
+            os.close(fd)
+        return self.__output
+
+    def close(self):
+        """ Release the resources used by the parser:
+            remove the output tempfile if it was not used
+        """
+        if self.__output is not None:
+            if os.path.exists(self.__output):
+                self._remove(self.__output)
+            self.__output = None
+
+    def _remove(self, path):
+        """ Remove $path securely, unless it's a file of a workspace
+            placed in RAM, where overwriting it would be useless
+        """
+        if self.in_workspace and workspace.is_in_ram(path):
+            os.remove(path)
+        else:
+            mat.secure_remove(path)
+
+    def _stat_key(self):
+        """ Identify the current version of the file
+        """
+        stat = os.stat(self.filename)
+        return stat.st_dev, stat.st_ino, stat.st_size, getattr(stat, 'st_mtime_ns', stat.st_mtime)
+
+    def _scan(self):
+        """ Virtual method. Analyse the file, and return the result
+            shared by is_clean and get_meta: by default, a dict with
+            all the harmful metadata of the file.
+        """
+        raise NotImplementedError
+
+    def _get_scan(self):
+        """ Return the result of `_scan`, which is only computed
+            once for each version of the file.
+        """
+        key = self._stat_key()
+        if self.__scan is None or self.__scan_key != key:
+            self.__scan = self._scan()
+            self.__scan_key = key
+        return self.__scan
+
+    def _peek_scan(self):
+        """ Return the result of the last scan if it is still valid,
+            or None, without scanning the file.
+        """
+        if self.__scan is not None and self.__scan_key == self._stat_key():
+            return self.__scan
+        return None
+
+    def _set_scan(self, scan):
+        """ Store the result of a scan done by someone else (eg. in batch)
+        """
+        self.__scan = scan
+        self.__scan_key = self._stat_key()
+
+    def _invalidate_scan(self):
+        """ Forget the result of the last scan, since the file changed
+        """
+        self.__scan = None
+        self.__scan_key = None
 
     def is_clean(self):
         """
             Check if the file is clean from harmful metadatas
         """
-        raise NotImplementedError
+        return not self._get_scan()
+
+    def get_meta(self):
+        """ Return a dict with all the harmful metadata of the file
+        """
+        return dict(self._get_scan())
 
     def remove_all(self):
         """ Remove all compromising fields
@@ -62,5 +154,7 @@ class GenericParser(object):
         if self.backup:
             shutil.move(self.filename, os.path.join(self.filename, '.bak'))
         else:
-            mat.secure_remove(self.filename)
+            self._remove(self.filename)
         shutil.move(self.output, self.filename)
+        self.__output = None
+        self._invalidate_scan()
@@ -0,0 +1,407 @@
+""" Lightweight scanner of the structure of PDF files, over a mmap:
+    only the trailers, the cross-reference sections, and the few
+    objects holding the metadata of the document are read.
+    The page tree and the content are never loaded.
+"""
+
+import collections
+import mmap
+import re
+import zlib
+
+# How far from the end of the file "startxref" is looked for
+TAIL_SIZE = 4096
+
+# Maximal number of cross-reference sections followed through /Prev
+MAX_XREF_SECTIONS = 1024
+
+_SKIP = re.compile(r'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*')
+_NAME = re.compile(r'/([^\x00\t\n\x0c\r ()<>\[\]{}/%]*)')
+_REF = re.compile(r'(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+_NUMBER = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)')
+_KEYWORD = re.compile(r'[A-Za-z]+')
+_OBJ = re.compile(r'[\x00\t\n\x0c\r ]*(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj')
+_STREAM = re.compile(r'[\x00\t\n\x0c\r ]*stream\r?\n')
+_STARTXREF = re.compile(r'startxref[\x00\t\n\x0c\r ]+(\d+)')
+_XREF_SUBSECTION = re.compile(r'[\x00\t\n\x0c\r ]*(\d+)[ ]+(\d+)[ ]*\r?\n?')
+_XREF_ENTRY = re.compile(r'(\d{10}) (\d{5}) ([nf])')
+
+_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'f': '\f',
+            '(': '(', ')': ')', '\\': '\\'}
+
+# Reference to an indirect object
+Ref = collections.namedtuple('Ref', ('num', 'gen'))
+
+
+class Name(str):
+    """ A PDF name, as opposed to a string
+    """
+    pass
+
+
+class Stream(dict):
+    """ The dictionary of a stream, along with its raw data
+    """
+
+    def __init__(self, dictionary, data):
+        super(Stream, self).__init__(dictionary)
+        self.data = data
+
+
+class _Lexer(object):
+    """ Parse PDF objects out of $data, starting at $pos
+    """
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def skip(self):
+        self.pos = _SKIP.match(self.data, self.pos).end()
+
+    def parse(self):
+        """ Return the next object
+        """
+        self.skip()
+        data, pos = self.data, self.pos
+        char = data[pos:pos + 1]
+        if char == '/':
+            match = _NAME.match(data, pos)
+            self.pos = match.end()
+            return Name(re.sub('#([0-9A-Fa-f]{2})', lambda m: chr(int(m.group(1), 16)), match.group(1)))
+        elif char == '<':
+            if data[pos + 1:pos + 2] == '<':
+                return self.__parse_dict()
+            end = data.find('>', pos)
+            if end == -1:
+                raise ValueError('Unterminated hex string')
+            self.pos = end + 1
+            digits = re.sub('[^0-9A-Fa-f]', '', data[pos + 1:end])
+            return (digits + '0' * (len(digits) % 2)).decode('hex')
+        elif char == '[':
+            self.pos += 1
+            array = []
+            while True:
+                self.skip()
+                if self.data[self.pos:self.pos + 1] == ']':
+                    self.pos += 1
+                    return array
+                array.append(self.parse())
+        elif char == '(':
+            return self.__parse_string()
+
+        match = _REF.match(data, pos)
+        if match:
+            self.pos = match.end()
+            return Ref(int(match.group(1)), int(match.group(2)))
+        match = _NUMBER.match(data, pos)
+        if match:
+            self.pos = match.end()
+            number = match.group(0)
+            return float(number) if '.' in number else int(number)
+        match = _KEYWORD.match(data, pos)
+        if match is not None and match.group(0) in ('true', 'false', 'null'):
+            self.pos = match.end()
+            return {'true': True, 'false': False, 'null': None}[match.group(0)]
+        raise ValueError('Unexpected token at offset %d' % pos)
+
+    def __parse_dict(self):
+        self.pos += 2
+        dictionary = {}
+        while True:
+            self.skip()
+            if self.data[self.pos:self.pos + 2] == '>>':
+                self.pos += 2
+                return dictionary
+            key = self.parse()
+            if not isinstance(key, Name):
+                raise ValueError('Invalid dictionary key at offset %d' % self.pos)
+            dictionary[key] = self.parse()
+
+    def __parse_string(self):
+        """ Parse a literal string, with its escapes and nested parentheses
+        """
+        data, pos = self.data, self.pos + 1
+        chunks, depth = [], 1
+        while True:
+            char = data[pos:pos + 1]
+            if char == '':
+                raise ValueError('Unterminated string')
+            pos += 1
+            if char == '\\':
+                char = data[pos:pos + 1]
+                pos += 1
+                if char in _ESCAPES:
+                    chunks.append(_ESCAPES[char])
+                elif char.isdigit():
+                    octal = re.match('[0-7]{1,3}', data[pos - 1:pos + 2]).group(0)
+                    chunks.append(chr(int(octal, 8) & 0xff))
+                    pos += len(octal) - 1
+                elif char == '\r':  # line continuation
+                    if data[pos:pos + 1] == '\n':
+                        pos += 1
+                elif char != '\n':
+                    chunks.append(char)
+                continue
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+                if depth == 0:
+                    self.pos = pos
+                    return ''.join(chunks)
+            chunks.append(char)
+
+
+def _unpredict(data, columns):
+    """ Undo the PNG predictors applied to the rows of $data
+    """
+    rows, previous = [], [0] * columns
+    for start in xrange(0, len(data), columns + 1):
+        predictor = ord(data[start])
+        row = [ord(c) for c in data[start + 1:start + 1 + columns]]
+        row += [0] * (columns - len(row))
+        for i in xrange(columns):
+            left = row[i - 1] if i else 0
+            up_left = previous[i - 1] if i else 0
+            if predictor == 1:
+                row[i] = (row[i] + left) & 0xff
+            elif predictor == 2:
+                row[i] = (row[i] + previous[i]) & 0xff
+            elif predictor == 3:
+                row[i] = (row[i] + (left + previous[i]) // 2) & 0xff
+            elif predictor == 4:
+                estimate = left + previous[i] - up_left
+                distances = abs(estimate - left), abs(estimate - previous[i]), abs(estimate - up_left)
+                if distances[0] <= distances[1] and distances[0] <= distances[2]:
+                    row[i] = (row[i] + left) & 0xff
+                elif distances[1] <= distances[2]:
+                    row[i] = (row[i] + previous[i]) & 0xff
+                else:
+                    row[i] = (row[i] + up_left) & 0xff
+        rows.append(''.join(chr(c) for c in row))
+        previous = row
+    return ''.join(rows)
+
+
+class PdfScanner(object):
+    """ Index of the objects of a mmaped PDF file, built from its
+        cross-reference tables and streams. Objects are only parsed
+        when they are asked for.
+    """
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.sections = []  # newest first: ('table', subsections) or ('stream', ranges, widths, data)
+        self.trailer = {}
+        self.object_streams = {}
+        self.__read_xref()
+
+    def __read_xref(self):
+        tail_start = max(0, len(self.mapping) - TAIL_SIZE)
+        tail = self.mapping[tail_start:]
+        position = tail.rfind('startxref')
+        if position == -1:
+            raise ValueError('No startxref')
+        offsets = [int(_STARTXREF.match(tail, position).group(1))]
+        seen = set()
+        while offsets:
+            offset = offsets.pop(0)
+            if offset in seen or len(seen) >= MAX_XREF_SECTIONS:
+                continue
+            seen.add(offset)
+            pos = _SKIP.match(self.mapping, offset).end()
+            if self.mapping[pos:pos + 4] == 'xref':
+                trailer = self.__read_xref_table(pos + 4)
+                if isinstance(trailer.get('XRefStm'), int):  # hybrid file
+                    offsets.insert(0, trailer['XRefStm'])
+            else:
+                trailer = self.__read_xref_stream(offset)
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            if isinstance(trailer.get('Prev'), int):
+                offsets.append(trailer['Prev'])
+
+    def __read_xref_table(self, pos):
+        """ Record a cross-reference table, whose subsections start at $pos,
+            without parsing its entries, and return its trailer dictionary
+        """
+        subsections = []
+        while True:
+            match = _XREF_SUBSECTION.match(self.mapping, pos)
+            if match is None:
+                break
+            first, count = int(match.group(1)), int(match.group(2))
+            subsections.append((first, count, match.end()))
+            pos = match.end() + 20 * count
+        self.sections.append(('table', subsections))
+        lexer = _Lexer(self.mapping, pos)
+        lexer.skip()
+        if self.mapping[lexer.pos:lexer.pos + 7] != 'trailer':
+            raise ValueError('No trailer after the xref table')
+        lexer.pos += 7
+        return lexer.parse()
+
+    def __read_xref_stream(self, offset):
+        """ Record a cross-reference stream, and return its dictionary
+        """
+        stream = self.read_object(offset)
+        if not isinstance(stream, Stream) or stream.get('Type') != 'XRef':
+            raise ValueError('Invalid xref stream')
+        widths = stream['W']
+        index = stream.get('Index', [0, stream['Size']])
+        ranges = [(index[i], index[i + 1]) for i in range(0, len(index) - 1, 2)]
+        self.sections.append(('stream', ranges, widths, self.decode(stream)))
+        return stream
+
+    def __lookup(self, num):
+        """ Return the cross-reference entry of object $num:
+            (1, offset) or (2, object stream, index), or None
+        """
+        for section in self.sections:
+            if section[0] == 'table':
+                for first, count, pos in section[1]:
+                    if first <= num < first + count:
+                        match = _XREF_ENTRY.match(self.mapping, pos + 20 * (num - first))
+                        if match is None:
+                            raise ValueError('Invalid xref entry')
+                        if match.group(3) == 'f':
+                            return None
+                        return 1, int(match.group(1))
+                continue
+            _, ranges, widths, data = section
+            entry_size = sum(widths)
+            row = 0
+            for first, count in ranges:
+                if first <= num < first + count:
+                    start = (row + num - first) * entry_size
+                    fields = []
+                    for width in widths:
+                        fields.append(reduce(lambda a, b: a << 8 | ord(b), data[start:start + width], 0))
+                        start += width
+                    entry_type = fields[0] if widths[0] else 1
+                    if entry_type == 0:
+                        return None
+                    return entry_type, fields[1], fields[2]
+                row += count
+        return None
+
+    def read_object(self, offset):
+        """ Return the indirect object at $offset
+        """
+        match = _OBJ.match(self.mapping, offset)
+        if match is None:
+            raise ValueError('No object at offset %d' % offset)
+        lexer = _Lexer(self.mapping, match.end())
+        value = lexer.parse()
+        if isinstance(value, dict):
+            stream = _STREAM.match(self.mapping, lexer.pos)
+            if stream is not None:
+                length = self.resolve(value.get('Length'))
+                if not isinstance(length, int) or length < 0:
+                    raise ValueError('Invalid stream length')
+                value = Stream(value, self.mapping[stream.end():stream.end() + length])
+        return value
+
+    def get(self, num):
+        """ Return the object number $num, or None if it doesn't exist
+        """
+        entry = self.__lookup(num)
+        if entry is None:
+            return None
+        elif entry[0] == 1:
+            return self.read_object(entry[1])
+        elif entry[0] == 2:
+            return self.__get_compressed(entry[1], entry[2])
+        return None
+
+    def __get_compressed(self, stream_num, index):
+        """ Return the object at $index in the object stream $stream_num
+        """
+        if stream_num not in self.object_streams:
+            stream = self.get(stream_num)
+            if not isinstance(stream, Stream) or stream.get('Type') != 'ObjStm':
+                raise ValueError('Invalid object stream')
+            self.object_streams[stream_num] = (stream, self.decode(stream))
+        stream, data = self.object_streams[stream_num]
+        lexer = _Lexer(data)
+        header = [lexer.parse() for _ in range(2 * stream['N'])]
+        if index >= stream['N']:
+            raise ValueError('Invalid object stream index')
+        return _Lexer(data, stream['First'] + header[2 * index + 1]).parse()
+
+    def resolve(self, value):
+        """ Return the object $value refers to, if it is a reference
+        """
+        seen = set()
+        while isinstance(value, Ref) and value.num not in seen:
+            seen.add(value.num)
+            value = self.get(value.num)
+        return None if isinstance(value, Ref) else value
+
+    def decode(self, stream):
+        """ Return the decoded data of $stream
+            (only FlateDecode, and its PNG predictors, are supported)
+        """
+        filters = self.resolve(stream.get('Filter'))
+        params = self.resolve(stream.get('DecodeParms'))
+        if not isinstance(filters, list):
+            filters, params = [filters] if filters else [], [params]
+        elif not isinstance(params, list):
+            params = [params] * len(filters)
+        data = stream.data[:]
+        for name, param in zip(filters, params):
+            if name != 'FlateDecode':
+                raise ValueError('Unsupported filter %s' % name)
+            data = zlib.decompress(data)
+            param = self.resolve(param) or {}
+            if param.get('Predictor', 1) >= 10:
+                data = _unpredict(data, param.get('Columns', 1) * param.get('Colors', 1) *
+                                  param.get('BitsPerComponent', 8) // 8)
+            elif param.get('Predictor', 1) != 1:
+                raise ValueError('Unsupported predictor')
+        return data
+
+
+def decode_text(value):
+    """ Return a PDF text string as utf-8
+    """
+    if value.startswith('\xfe\xff'):
+        return value[2:].decode('utf-16-be', 'replace').encode('utf-8')
+    return value.decode('latin-1').encode('utf-8')
+
+
+def scan(filename):
+    """ Return a dict with the entries of the Info dictionary of the PDF
+        $filename, and its xmp metadata as 'Metadata', if it has some.
+
+        :raise ValueError: If the file can't be scanned this way (broken,
+                           encrypted, or using unsupported features)
+    """
+    with open(filename, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        scanner = PdfScanner(mapping)
+        if 'Encrypt' in scanner.trailer:
+            raise ValueError('Encrypted document')
+        metadata = {}
+        info = scanner.resolve(scanner.trailer.get('Info'))
+        if isinstance(info, dict):
+            for key, value in info.items():
+                value = scanner.resolve(value)
+                if isinstance(value, str) and not isinstance(value, Name):
+                    metadata[key] = decode_text(value)
+        root = scanner.resolve(scanner.trailer.get('Root'))
+        if not isinstance(root, dict):
+            raise ValueError('No document catalog')
+        xmp = scanner.resolve(root.get('Metadata'))
+        if isinstance(xmp, Stream):
+            try:
+                metadata['Metadata'] = scanner.decode(xmp)
+            except (ValueError, zlib.error):
+                metadata['Metadata'] = '%d bytes' % len(xmp.data)
+        return metadata
+    except (IndexError, KeyError, TypeError, AttributeError, zlib.error) as e:
+        raise ValueError('Unable to scan %s: %s' % (filename, e))
+    finally:
+        mapping.close()
@@ -2,12 +2,13 @@
 """
 
 import archive
+import compression
+import images
 import mutagenstripper
 import logging
 import mat
 import misc
 import office
-import subprocess
 
 STRIPPERS = {
     'application/x-tar': archive.TarStripper,
@@ -18,6 +19,9 @@ STRIPPERS = {
     'application/torrent': misc.TorrentStripper,
     'application/opendocument': office.OpenDocumentStripper,
     'application/officeopenxml': office.OpenXmlStripper,
+    'image/jpeg': images.JpegStripper,
+    'image/png': images.PngStripper,
+    'image/tiff': images.TiffStripper,
 }
 
 logging.basicConfig(level=mat.LOGGING_LEVEL)
@@ -49,6 +53,18 @@ if pdfSupport:
     STRIPPERS['application/pdf'] = office.PdfStripper
 
 
+# xz and zstd tarballs support, through their command-line tools
+if compression.is_available('xz'):
+    STRIPPERS['application/x-xz'] = archive.XzStripper
+else:
+    logging.error('Unable to find xz: no tar.xz support')
+
+if compression.is_available('zst'):
+    STRIPPERS['application/x-zstd-compressed-tar'] = archive.ZstdStripper
+else:
+    logging.error('Unable to find zstd: no tar.zst support')
+
+
 # audio format support with mutagen-python
 try:
     import mutagen
@@ -59,13 +75,3 @@ try:
     STRIPPERS['audio/mpeg'] = mutagenstripper.MpegAudioStripper
 except ImportError:
     logging.error('Unable to import python-mutagen: no audio format support')
-
-# exiftool
-try:
-    subprocess.check_output(['exiftool', '-ver'])
-    import exiftool
-    STRIPPERS['image/jpeg'] = exiftool.JpegStripper
-    STRIPPERS['image/png'] = exiftool.PngStripper
-    STRIPPERS['image/tiff'] = exiftool.TiffStripper
-except OSError:
-    logging.error('Unable to find exiftool: no images support')
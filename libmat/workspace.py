@@ -0,0 +1,365 @@
+""" Scratch space used to extract the members of archives
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import libmat.exceptions
+import mat
+
+# RAM-backed filesystem used for small members, if it's really one
+RAM_ROOT = '/dev/shm'
+
+# Members bigger than this (in bytes) are extracted on disk instead of in RAM
+SPILL_THRESHOLD = 16 * 1024 * 1024
+
+# Where to create the on-disk scratch space (None means the system's default)
+SCRATCH_ROOT = None
+
+# Limits for an archive along with all the archives nested in it:
+# how deep they can be nested, how many bytes can be extracted,
+# and how many members.
+MAX_DEPTH = 8
+MAX_BYTES = 16 * 1024 * 1024 * 1024
+MAX_MEMBERS = 100000
+
+# Maximal number of bytes placed on the RAM-backed filesystem by an archive
+# and every archive nested in it, before spilling to disk.
+# None means half of the space available on the filesystem.
+MAX_RAM_BYTES = None
+
+# Members whose size isn't known in advance reserve RAM,
+# and are charged to the budget, by steps of this many bytes
+RESERVATION_STEP = 1024 * 1024
+
+RAM_FILESYSTEMS = frozenset(('tmpfs', 'ramfs'))
+
+
+def is_in_ram(path):
+    """ Check if $path is on a RAM-backed filesystem, according to /proc/mounts
+
+    :param str path: Path to check
+    """
+    try:
+        with open('/proc/mounts', 'r') as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) > 2]
+    except IOError:
+        return False
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    for mountpoint, mount_fstype in mounts:
+        mountpoint = mountpoint.replace('\\040', ' ')
+        prefix = mountpoint.rstrip('/') + '/'
+        if (path == mountpoint or path.startswith(prefix)) and len(mountpoint) >= len(best):
+            best, fstype = mountpoint, mount_fstype
+    return fstype in RAM_FILESYSTEMS
+
+
+class Budget(object):
+    """ What is left to extract, shared by a workspace
+        and every workspace nested in it
+    """
+
+    def __init__(self, max_depth=None, max_bytes=None, max_members=None, max_ram_bytes=None):
+        self.max_depth = MAX_DEPTH if max_depth is None else max_depth
+        self.max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        self.max_members = MAX_MEMBERS if max_members is None else max_members
+        self.max_ram_bytes = MAX_RAM_BYTES if max_ram_bytes is None else max_ram_bytes
+        self.bytes = 0
+        self.members = 0
+        self.ram_bytes = 0
+        self.lock = threading.Lock()
+
+    def charge(self, size, members):
+        """ Account for $members more members, and $size more bytes
+
+            :raise libmat.exceptions.ArchiveLimitExceeded: If a limit is exceeded
+        """
+        with self.lock:
+            self.bytes += size
+            self.members += members
+            if self.bytes > self.max_bytes:
+                raise libmat.exceptions.ArchiveLimitExceeded(
+                    'More than %d bytes to extract' % self.max_bytes)
+            if self.members > self.max_members:
+                raise libmat.exceptions.ArchiveLimitExceeded(
+                    'More than %d members to extract' % self.max_members)
+
+    def reserve_ram(self, size):
+        """ Account for $size more bytes on the RAM-backed filesystem.
+            Return False, without accounting for anything, if it would
+            be more than max_ram_bytes.
+        """
+        with self.lock:
+            if self.max_ram_bytes is not None and self.ram_bytes + size > self.max_ram_bytes:
+                return False
+            self.ram_bytes += size
+            return True
+
+    def release_ram(self, size):
+        """ Account for $size bytes freed on the RAM-backed filesystem
+        """
+        with self.lock:
+            self.ram_bytes = max(0, self.ram_bytes - size)
+
+
+class Workspace(object):
+    """ Scratch directories in which the members of an archive are extracted.
+        Small members are placed on a RAM-backed filesystem: they never
+        touch persistent storage, and are simply deleted on cleanup.
+        Bigger ones (or every member, if no such filesystem is available)
+        spill to disk, and are securely removed.
+
+        Nested archives use a child of their parent's workspace: it lives
+        in subdirectories of the parent's ones, and shares its Budget,
+        which also caps what the whole tree places in RAM.
+    """
+
+    def __init__(self, scratch_root=None, ram_root=None, spill_threshold=None, budget=None):
+        self.scratch_root = SCRATCH_ROOT if scratch_root is None else scratch_root
+        self.ram_root = RAM_ROOT if ram_root is None else ram_root
+        self.spill_threshold = SPILL_THRESHOLD if spill_threshold is None else spill_threshold
+        self.budget = Budget() if budget is None else budget
+        self.parent = None
+        self.depth = 0
+        self.ramdir = None
+        self.diskdir = None
+        self.ram_bytes = 0  # reserved in the budget by this workspace
+        self.children = []
+        self.lock = threading.Lock()
+
+    def child(self):
+        """ Return the workspace of an archive nested in this one
+
+            :raise libmat.exceptions.ArchiveLimitExceeded: If archives are nested too deeply
+        """
+        if self.depth >= self.budget.max_depth:
+            raise libmat.exceptions.ArchiveLimitExceeded(
+                'More than %d levels of nested archives' % self.budget.max_depth)
+        child = Workspace(self.scratch_root, self.ram_root, self.spill_threshold, self.budget)
+        child.parent = self
+        child.depth = self.depth + 1
+        with self.lock:
+            self.children.append(child)
+        return child
+
+    def charge(self, size, members=1):
+        """ Account for the extraction of $members members of $size bytes
+        """
+        self.budget.charge(size, members)
+
+    def __get_ramdir(self):
+        """ Return the RAM-backed scratch directory, or None if unavailable
+        """
+        with self.lock:
+            if self.ramdir is None and self.ram_root:
+                if self.parent is not None:
+                    root = self.parent.__get_ramdir()
+                    if root is None:
+                        self.ram_root = None
+                        return None
+                    self.ramdir = tempfile.mkdtemp(dir=root)
+                elif os.path.isdir(self.ram_root) and os.access(self.ram_root, os.W_OK) and is_in_ram(self.ram_root):
+                    self.ramdir = tempfile.mkdtemp(dir=self.ram_root)
+                    if self.budget.max_ram_bytes is None:
+                        stat = os.statvfs(self.ram_root)
+                        self.budget.max_ram_bytes = stat.f_bavail * stat.f_frsize // 2
+                else:
+                    logging.debug('%s is not a usable RAM-backed filesystem', self.ram_root)
+                    self.ram_root = None
+            return self.ramdir
+
+    def __get_diskdir(self):
+        """ Return the on-disk scratch directory
+        """
+        with self.lock:
+            if self.diskdir is None:
+                if self.parent is not None:
+                    self.diskdir = tempfile.mkdtemp(dir=self.parent.__get_diskdir())
+                else:
+                    self.diskdir = tempfile.mkdtemp(dir=self.scratch_root)
+            return self.diskdir
+
+    def in_ram(self, path):
+        """ Check if $path is in the RAM-backed scratch directory
+        """
+        return self.ramdir is not None and path.startswith(self.ramdir + os.sep)
+
+    def reserve_ram(self, size):
+        """ Reserve $size more bytes on the RAM-backed filesystem for
+            this workspace. Return False if the budget can't have them.
+        """
+        if not self.budget.reserve_ram(size):
+            return False
+        with self.lock:
+            self.ram_bytes += size
+        return True
+
+    def disk_directory(self):
+        """ Return the on-disk scratch directory, for members that
+            can't, or can no longer, stay in RAM
+        """
+        return self.__get_diskdir()
+
+    def create(self, size, name=None):
+        """ Create a file for a member announcing $size bytes,
+            whose real size will only be known once written,
+            and return it as a MemberFile.
+
+        :param int size: Size of the member, according to the archive
+        :param str name: Relative path of the file, or None for a temporary name
+        """
+        return MemberFile(self, size, name)
+
+    def directory_for(self, size):
+        """ Return the directory in which a member of $size bytes should be
+            extracted: in RAM if it's small, and if the RAM-backed filesystem
+            isn't already filled up to the budget's cap.
+
+        :param int size: Size of the member
+        """
+        if size <= self.spill_threshold:
+            ramdir = self.__get_ramdir()
+            if ramdir is not None and self.budget.reserve_ram(size):
+                with self.lock:
+                    self.ram_bytes += size
+                return ramdir
+        return self.__get_diskdir()
+
+    def release_ram(self, size):
+        """ Give back to the budget up to $size bytes reserved in RAM
+        """
+        with self.lock:
+            size = min(size, self.ram_bytes)
+            self.ram_bytes -= size
+        self.budget.release_ram(size)
+
+    def release(self, path):
+        """ Remove a single file of the workspace right away,
+            securely if it is on disk.
+
+            :param str path: Path of the file
+        """
+        if self.in_ram(path):
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.release_ram(size)
+        else:
+            mat.secure_remove(path)
+
+    def cleanup(self):
+        """ Remove every extracted member, securely for the ones on disk,
+            then the scratch directories themselves. The workspaces of the
+            nested archives are cleaned up first, to give back their RAM.
+        """
+        with self.lock:
+            children, self.children = self.children, []
+        for child in children:
+            child.cleanup()
+        # The directories of nested workspaces may already be gone with their parent's
+        if self.ramdir is not None:
+            shutil.rmtree(self.ramdir, ignore_errors=True)
+            self.ramdir = None
+        self.release_ram(self.ram_bytes)
+        if self.diskdir is not None and os.path.isdir(self.diskdir):
+            remover = mat.SecureRemover()
+            for root, _, files in os.walk(self.diskdir):
+                for item in files:
+                    remover.remove(os.path.join(root, item))
+            remover.wait()
+            shutil.rmtree(self.diskdir)
+        self.diskdir = None
+
+
+class MemberFile(object):
+    """ A file written in a workspace, whose size can't be trusted until
+        it is written: archives can lie about the size of their members.
+        Each chunk is charged to the budget, and, while the file is in
+        RAM, reserved on the RAM-backed filesystem before being written.
+        Once the file outgrows its reservation and the budget can't
+        extend it, or goes past the spill threshold, it is moved to disk.
+    """
+
+    def __init__(self, ws, size, name=None):
+        self.workspace = ws
+        self.name = name
+        directory = ws.directory_for(size)
+        self.reserved = size if directory == ws.ramdir else 0
+        self.written = 0
+        self.pending = 0  # written, but not charged to the budget yet
+        self.path = self.__open(directory)
+
+    def __open(self, directory):
+        """ Create the file in $directory, and return its path
+        """
+        if self.name is None:
+            fd, path = tempfile.mkstemp(dir=directory)
+            self.fileobj = os.fdopen(fd, 'wb')
+            return path
+        path = os.path.join(directory, self.name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.fileobj = open(path, 'wb')
+        return path
+
+    def __spill(self):
+        """ Move what was written so far to disk, and give
+            back the RAM that was reserved for it
+        """
+        logging.debug('%s is bigger than announced, moving it to disk', self.path)
+        self.fileobj.close()
+        ram_path = self.path
+        with open(ram_path, 'rb') as source:
+            self.path = self.__open(self.workspace.disk_directory())
+            shutil.copyfileobj(source, self.fileobj, RESERVATION_STEP)
+        os.remove(ram_path)
+        self.workspace.release_ram(self.reserved)
+        self.reserved = 0
+
+    def write(self, data):
+        """ Write $data, once accounted for
+
+            :raise libmat.exceptions.ArchiveLimitExceeded: If the budget is exceeded
+        """
+        self.written += len(data)
+        self.pending += len(data)
+        if self.pending >= RESERVATION_STEP:
+            self.flush()
+        if self.workspace.in_ram(self.path) and self.written > self.reserved:
+            # Reserve by steps, not to take the budget's lock for every small write
+            extra = max(self.written - self.reserved, RESERVATION_STEP)
+            if self.written > self.workspace.spill_threshold or not self.workspace.reserve_ram(extra):
+                self.__spill()
+            else:
+                self.reserved += extra
+        self.fileobj.write(data)
+
+    def flush(self):
+        """ Charge the budget for what was written since the last time
+        """
+        pending, self.pending = self.pending, 0
+        self.workspace.charge(pending, members=0)
+
+    def close(self):
+        """ Close the file, charge what remains, and give back
+            the RAM reserved in excess
+        """
+        self.fileobj.close()
+        if self.reserved > self.written:
+            self.workspace.release_ram(self.reserved - self.written)
+            self.reserved = self.written
+        self.flush()
+
+    def discard(self):
+        """ Close and remove the file, after an error
+        """
+        self.fileobj.close()
+        if self.workspace.in_ram(self.path):
+            os.remove(self.path)
+            self.workspace.release_ram(self.reserved)
+        else:
+            mat.secure_remove(self.path)
+        self.reserved = 0
@@ -0,0 +1,204 @@
+""" Streaming removal of the authors, dates and revision identifiers
+    scattered in the xml parts of office documents
+"""
+
+import xml.sax
+import xml.sax.handler
+import xml.sax.saxutils
+import xml.sax.xmlreader
+
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+W15 = 'http://schemas.microsoft.com/office/word/2012/wordml'
+P = 'http://schemas.openxmlformats.org/presentationml/2006/main'
+S = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+TC = 'http://schemas.microsoft.com/office/spreadsheetml/2018/threadedcomments'
+DC = 'http://purl.org/dc/elements/1.1/'
+CONFIG = 'urn:oasis:names:tc:opendocument:xmlns:config:1.0'
+
+# Elements removed with their whole content (revision save identifiers)
+REMOVED_ELEMENTS = frozenset(((W, 'rsids'),))
+
+# Attributes removed from every element. Every attribute
+# of the W namespace starting with "rsid" is removed too.
+REMOVED_ATTRIBUTES = frozenset(((W, 'date'),))
+
+# Attributes removed from specific elements only
+REMOVED_ELEMENT_ATTRIBUTES = {
+    (P, 'cm'): frozenset(((None, 'dt'),)),  # date of a comment
+    (TC, 'threadedComment'): frozenset(((None, 'dT'),)),
+}
+
+# Attributes emptied on every element, since they are mandatory
+BLANKED_ATTRIBUTES = frozenset(((W, 'author'), (W, 'initials'),
+                                (W15, 'author'), (W15, 'providerId'), (W15, 'userId')))
+
+# Attributes emptied on specific elements only
+BLANKED_ELEMENT_ATTRIBUTES = {
+    (P, 'cmAuthor'): frozenset(((None, 'name'), (None, 'initials'))),
+    (S, 'header'): frozenset(((None, 'userName'),)),  # revision headers
+    (S, 'userInfo'): frozenset(((None, 'name'),)),  # users of a shared workbook
+    (TC, 'person'): frozenset(((None, 'displayName'), (None, 'userId'), (None, 'providerId'))),
+}
+
+# Mandatory dates, that must stay valid xsd:dateTime, replaced by the epoch
+EPOCH = '1970-01-01T00:00:00Z'
+REPLACED_ELEMENT_ATTRIBUTES = {
+    (S, 'header'): {(None, 'dateTime'): EPOCH},
+    (S, 'userInfo'): {(None, 'dateTime'): EPOCH},
+}
+
+# Elements whose text is emptied
+BLANKED_TEXTS = frozenset(((DC, 'creator'), (DC, 'date'), (S, 'author')))
+
+# Opendocument settings leaking the printer
+BLANKED_CONFIG_ITEMS = frozenset(('PrinterName', 'PrinterSetup'))
+
+
+class XmlScrubber(xml.sax.handler.ContentHandler):
+    """ Sax handler forwarding the events it receives to $downstream,
+        without the harmful elements and attributes. What was
+        removed is recorded in `found`, by local name.
+        The document is never fully loaded: memory use only
+        depends on the nesting depth.
+    """
+
+    def __init__(self, downstream=None):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.downstream = downstream
+        self.found = {}
+        self.skipped_depth = 0  # >0 when inside a removed element
+        self.blanked_depth = 0  # >0 when inside an element whose text is emptied
+        self.blanked_name = None
+
+    def __found(self, name, value):
+        self.found.setdefault(name[1], set()).add(value)
+
+    def __is_removed_attribute(self, name, element):
+        if name in REMOVED_ATTRIBUTES or name in REMOVED_ELEMENT_ATTRIBUTES.get(element, ()):
+            return True
+        return name[0] == W and name[1].startswith('rsid')
+
+    def startPrefixMapping(self, prefix, uri):
+        if self.downstream is not None:
+            self.downstream.startPrefixMapping(prefix, uri)
+
+    def endPrefixMapping(self, prefix):
+        if self.downstream is not None:
+            self.downstream.endPrefixMapping(prefix)
+
+    def startElementNS(self, name, qname, attrs):
+        if self.skipped_depth:
+            self.skipped_depth += 1
+            return
+        if name in REMOVED_ELEMENTS:
+            self.__found(name, 'present')
+            self.skipped_depth = 1
+            return
+        if self.blanked_depth:
+            self.blanked_depth += 1
+
+        blanked = BLANKED_ELEMENT_ATTRIBUTES.get(name, frozenset())
+        replaced = REPLACED_ELEMENT_ATTRIBUTES.get(name, {})
+        values, qnames = {}, {}
+        for attr_name, value in attrs.items():
+            if self.__is_removed_attribute(attr_name, name):
+                self.__found(attr_name, value)
+                continue
+            if (attr_name in BLANKED_ATTRIBUTES or attr_name in blanked) and value:
+                self.__found(attr_name, value)
+                value = ''
+            elif attr_name in replaced and value != replaced[attr_name]:
+                self.__found(attr_name, value)
+                value = replaced[attr_name]
+            values[attr_name] = value
+            qnames[attr_name] = attrs.getQNameByName(attr_name)
+
+        if not self.blanked_depth:
+            if name in BLANKED_TEXTS:
+                self.blanked_depth, self.blanked_name = 1, name
+            elif name == (CONFIG, 'config-item') and \
+                    attrs.get((CONFIG, 'name')) in BLANKED_CONFIG_ITEMS:
+                self.blanked_depth, self.blanked_name = 1, (CONFIG, attrs.get((CONFIG, 'name')))
+
+        if self.downstream is not None:
+            self.downstream.startElementNS(name, qname, xml.sax.xmlreader.AttributesNSImpl(values, qnames))
+
+    def endElementNS(self, name, qname):
+        if self.skipped_depth:
+            self.skipped_depth -= 1
+            return
+        if self.blanked_depth:
+            self.blanked_depth -= 1
+        if self.downstream is not None:
+            self.downstream.endElementNS(name, qname)
+
+    def characters(self, content):
+        if self.skipped_depth:
+            return
+        if self.blanked_depth:
+            if content.strip():
+                self.__found(self.blanked_name, content)
+            return
+        if self.downstream is not None:
+            self.downstream.characters(content)
+
+    def ignorableWhitespace(self, whitespace):
+        if not self.skipped_depth and self.downstream is not None:
+            self.downstream.ignorableWhitespace(whitespace)
+
+    def processingInstruction(self, target, data):
+        if not self.skipped_depth and self.downstream is not None:
+            self.downstream.processingInstruction(target, data)
+
+    def startDocument(self):
+        if self.downstream is not None:
+            self.downstream.startDocument()
+
+    def endDocument(self):
+        if self.downstream is not None:
+            self.downstream.endDocument()
+
+
+def _parse(source, handler):
+    """ Feed the xml file object $source to $handler, without
+        resolving any external entity
+    """
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, True)
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    parser.setFeature(xml.sax.handler.feature_external_pes, False)
+    parser.setContentHandler(handler)
+    parser.parse(source)
+
+
+def scan(source):
+    """ Return what `scrub` would remove from the xml file object $source,
+        as a dict of sets of values, by local name
+    """
+    scrubber = XmlScrubber()
+    _parse(source, scrubber)
+    return scrubber.found
+
+
+def scrub(source, destination):
+    """ Write the xml file object $source to the file object
+        $destination, without its harmful elements and attributes.
+        Return what was removed, like `scan`.
+    """
+    scrubber = XmlScrubber(xml.sax.saxutils.XMLGenerator(destination, 'UTF-8'))
+    _parse(source, scrubber)
+    return scrubber.found
+
+
+def describe(found):
+    """ Return a human-readable summary of what `scan` found
+    """
+    summary = {}
+    for name, values in found.items():
+        if name.startswith('rsid'):
+            summary['rsid'] = summary.get('rsid', 0) + len(values)
+        else:
+            summary[name] = ', '.join(sorted(values))
+    if 'rsid' in summary:
+        summary['rsid'] = '%d revision identifiers' % summary['rsid']
+    return summary
@@ -18,6 +18,7 @@ except:
 
 from gi.repository import Nautilus, GObject, Gtk
 
+import libmat.exceptions
 import libmat.mat
 import libmat.strippers
 
@@ -83,13 +84,16 @@ class MatExtension(GObject.GObject, Nautilus.MenuProvider):
         # files url in nautilus are starting with 'file://', of length 7
         file_path = urllib.unquote(current_file.get_uri()[7:])
 
-        class_file = libmat.mat.create_class_file(file_path,
-                                                  backup=True,
-                                                  add2archive=False)
-        if class_file:
-            if class_file.is_clean():
-                self.show_message(_("%s is already clean") % file_path)
-            elif not class_file.remove_all():
-                self.show_message(_("Unable to clean %s") % file_path, Gtk.MessageType.ERROR)
-        else:
-            self.show_message(_("Unable to process %s") % file_path, Gtk.MessageType.ERROR)
+        try:
+            class_file = libmat.mat.create_class_file(file_path,
+                                                      backup=True,
+                                                      add2archive=False)
+            if class_file:
+                if class_file.is_clean():
+                    self.show_message(_("%s is already clean") % file_path)
+                elif not class_file.remove_all():
+                    self.show_message(_("Unable to clean %s") % file_path, Gtk.MessageType.ERROR)
+            else:
+                self.show_message(_("Unable to process %s") % file_path, Gtk.MessageType.ERROR)
+        except libmat.exceptions.ArchiveLimitExceeded as e:
+            self.show_message(_("Unable to process %s: %s") % (file_path, e), Gtk.MessageType.ERROR)
@@ -14,7 +14,6 @@ import glob
 import sys
 import tempfile
 import unittest
-import subprocess
 
 VERBOSITY = 15
 
@@ -42,11 +41,6 @@ except ImportError:
     FILE_LIST.remove(('clean é.mp3', 'dirty é.mp3'))
     FILE_LIST.remove(('clean é.flac', 'dirty é.flac'))
 
-try:  # exiftool
-    subprocess.check_output(['exiftool', '-ver'])
-except OSError:
-    FILE_LIST.remove(('clean é.tif', 'dirty é.tif'))
-
 
 class MATTest(unittest.TestCase):
     """
@@ -5,15 +5,32 @@
     Unit test for the CLI interface
 """
 
+import distutils.spawn
 import os
 import unittest
 import subprocess
 import sys
 import tarfile
 import stat
+import zipfile
 
 import test
 from libmat import mat
+from libmat import archive
+
+
+def run_traced(setup, args):
+    """ Run the cli with the arguments `args` in a new process, after
+        the python statements `setup` (that can import libmat and
+        patch it), and return this process.
+    """
+    code = ('import sys\n'
+            'from libmat import mat\n' + setup +
+            'cli = sys.argv[1]\n'
+            'sys.argv = ["mat"] + sys.argv[2:]\n'
+            'execfile(cli, {"__name__": "__main__"})\n')
+    return subprocess.Popen([sys.executable, '-c', code, distutils.spawn.find_executable('mat')] + args,
+                            stdout=subprocess.PIPE)
 
 
 class TestRemovecli(test.MATTest):
@@ -89,6 +106,26 @@ class TestisCleancli(test.MATTest):
             stdout, _ = proc.communicate()
             self.assertEqual(str(stdout).strip('\n'), '[+] %s is not clean' % dirty)
 
+    def test_batch(self):
+        """test that the images of a folder are analysed at once"""
+        folder = os.path.join(self.tmpdir, 'images')
+        os.mkdir(folder)
+        for i in range(3):
+            with open(os.path.join(folder, 'broken%d.jpg' % i), 'wb') as f:
+                f.write('not a jpeg')
+        # Tell how many images are analysed together
+        proc = run_traced('from libmat import images\n'
+                          'scan_batch = images.scan_batch\n'
+                          'def traced(strippers):\n'
+                          '    sys.stdout.write("[batch] %d\\n" % len(strippers))\n'
+                          '    return scan_batch(strippers)\n'
+                          'images.scan_batch = traced\n', ['-c', folder])
+        stdout, _ = proc.communicate()
+        self.assertIn('[batch] 3\n', str(stdout))
+        self.assertEqual(str(stdout).count('[batch]'), 1)
+        for i in range(3):
+            self.assertIn('[+] %s is not clean' % os.path.join(folder, 'broken%d.jpg' % i), str(stdout))
+
 
 class TestFileAttributes(unittest.TestCase):
     """
@@ -140,6 +177,45 @@ class TestUnsupported(test.MATTest):
                         '\n- test_lib.py\n- test.py\n- test_cli.py\n'
                         in str(stdout))
 
+    def test_streamed_tarball(self):
+        """ test if the cli cleans a tarball without nested archives in a single pass
+        """
+        tarpath = os.path.join(self.tmpdir, "stream.tar")
+        tar = tarfile.open(tarpath, "w")
+        for _, dirty in self.file_list:
+            if not issubclass(mat.get_stripper_class(dirty)[1], archive.GenericArchiveStripper):
+                tar.add(dirty, os.path.basename(dirty))
+        tar.close()
+        # Tell when a tarball is cleaned in a single pass
+        proc = run_traced('from libmat import archive\n'
+                          'stream_clean = archive.TarStripper._stream_clean\n'
+                          'def traced(self, *args):\n'
+                          '    sys.stdout.write("[streamed] %s\\n" % self.filename)\n'
+                          '    return stream_clean(self, *args)\n'
+                          'archive.TarStripper._stream_clean = traced\n', [tarpath])
+        stdout, _ = proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+        self.assertIn('[streamed] %s' % tarpath, str(stdout))
+        self.assertIn('[+] %s cleaned!' % tarpath, str(stdout))
+        current_file = mat.create_class_file(tarpath, False, add2archive=False)
+        self.assertTrue(current_file.is_clean())
+
+    def test_abort_unscrubbable(self):
+        """ test if the cli refuses to clean an office document with a broken xml part
+        """
+        docpath = os.path.join(self.tmpdir, 'broken.docx')
+        zipout = zipfile.ZipFile(docpath, 'w')
+        zipout.writestr('[Content_Types].xml', '<Types/>')
+        zipout.writestr('word/document.xml', '<w:document w:author="John Doe">')
+        zipout.close()
+        proc = subprocess.Popen(['mat', docpath], stdout=subprocess.PIPE)
+        stdout, _ = proc.communicate()
+        self.assertEqual(proc.returncode, 1)
+        self.assertIn('[-] Unable to clean %s' % docpath, str(stdout))
+        zipin = zipfile.ZipFile(docpath)
+        self.assertIn('word/document.xml', zipin.namelist())
+        zipin.close()
+
 
 class TestHelp(test.MATTest):
     """ Test the different ways to trigger help """
@@ -5,16 +5,33 @@
     Unit test for the library
 """
 
+import distutils.spawn
+import json
+import multiprocessing
+import multiprocessing.pool
 import os
 import sys
 import stat
 import shutil
+import struct
+import subprocess
 import tarfile
 import tempfile
 import unittest
+import zipfile
+import zlib
 
 import test
 import libmat
+import libmat.mat  # first: it loads the strippers, which import each other
+import libmat.archive
+import libmat.compression
+import libmat.exceptions
+import libmat.exiftool
+import libmat.images
+import libmat.office
+import libmat.pdfscan
+import libmat.workspace
 
 
 class TestRemovelib(test.MATTest):
@@ -38,6 +55,16 @@ class TestRemovelib(test.MATTest):
                 current_file = libmat.mat.create_class_file(dirty, False, add2archive=True, low_pdf_quality=True)
                 self.assertTrue(current_file.is_clean())
 
+    def test_remove_structural_pdf(self):
+        """ test the removal of PDF metadata without re-rendering """
+        for _, dirty in self.file_list:
+            if dirty.endswith('pdf'):
+                current_file = libmat.mat.create_class_file(dirty, False, add2archive=True, structural_pdf=True)
+                self.assertTrue(current_file.remove_all())
+                self.assertIn(libmat.office.PDF_RESIDUAL_RISKS['content'], current_file.residual_risks)
+                current_file = libmat.mat.create_class_file(dirty, False, add2archive=True)
+                self.assertTrue(current_file.is_clean())
+
     def test_remove_empty(self):
         """Test removal with clean files"""
         for clean, _ in self.file_list:
@@ -81,6 +108,42 @@ class TestisCleanlib(test.MATTest):
             self.assertTrue(current_file.is_clean())
 
 
+class TestScanCache(test.MATTest):
+    """ Test the memoisation of the metadata scan
+    """
+
+    def test_scan_once(self):
+        """ make sure that a file is only analysed once, until it changes """
+        for _, dirty in self.file_list:
+            current_file = libmat.mat.create_class_file(dirty, False, add2archive=True)
+            # Patch the class, not the instance: a bound method stored in
+            # the instance would make a cycle, that __del__ prevents to collect.
+            cls = type(current_file)
+            original, scan = cls.__dict__.get('_scan'), cls._scan
+            calls = []
+
+            def counted_scan(parser, *args, **kwargs):
+                result = scan(parser, *args, **kwargs)
+                if getattr(result, 'complete', True):  # archives may stop early
+                    calls.append(True)
+                return result
+            cls._scan = counted_scan
+            try:
+                self.assertFalse(current_file.is_clean())
+                self.assertTrue(current_file.get_meta())
+                self.assertTrue(current_file.get_meta())
+                self.assertEqual(len(calls), 1)
+                current_file.remove_all()
+                self.assertTrue(current_file.is_clean())
+                self.assertEqual(len(calls), 2)
+            finally:
+                if original is None:
+                    del cls._scan
+                else:
+                    cls._scan = original
+                current_file.close()
+
+
 class TestFileAttributes(unittest.TestCase):
     """
         test various stuffs about files (readable, writable, exist, ...)
@@ -123,6 +186,442 @@ class TestSecureRemove(unittest.TestCase):
         """
         self.assertRaises(libmat.exceptions.UnableToWriteFile, libmat.mat.secure_remove, '/NOTREMOVABLE')
 
+    def test_remove_pattern(self):
+        """ test the secure removal of a file with a custom pattern
+        """
+        fd, file_to_remove = tempfile.mkstemp()
+        os.write(fd, 'harmful content' * 1000)
+        os.close(fd)
+        self.assertTrue(libmat.mat.secure_remove(file_to_remove, passes=1, pattern='\x00'))
+        self.assertFalse(os.path.exists(file_to_remove))
+
+    def test_remove_batch(self):
+        """ test the secure removal of several files from a worker thread
+        """
+        files_to_remove = [tempfile.mkstemp()[1] for _ in range(5)]
+        self.assertTrue(libmat.mat.secure_remove_batch(files_to_remove))
+        self.assertFalse(any(os.path.exists(f) for f in files_to_remove))
+        self.assertFalse(libmat.mat.secure_remove_batch(['/NOTREMOVABLE']))
+
+
+class TestWorkspace(unittest.TestCase):
+    """ Test the scratch space used to extract archives
+    """
+
+    def test_spill_to_disk(self):
+        """ test that big members are extracted on disk, and that everything is removed
+        """
+        scratch_root = tempfile.mkdtemp()
+        workspace = libmat.workspace.Workspace(scratch_root, spill_threshold=10)
+        self.assertTrue(workspace.directory_for(1000).startswith(scratch_root))
+        if libmat.workspace.is_in_ram(libmat.workspace.RAM_ROOT):
+            self.assertFalse(workspace.directory_for(1).startswith(scratch_root))
+        for size in (1, 1000):
+            with open(os.path.join(workspace.directory_for(size), 'member'), 'w') as f:
+                f.write('content')
+        workspace.cleanup()
+        self.assertEqual(os.listdir(scratch_root), [])
+        os.rmdir(scratch_root)
+
+    def test_ram_cap(self):
+        """ test that members spill to disk once the RAM cap is reached,
+            for the whole tree of workspaces
+        """
+        if not libmat.workspace.is_in_ram(libmat.workspace.RAM_ROOT):
+            return
+        scratch_root = tempfile.mkdtemp()
+        budget = libmat.workspace.Budget(max_ram_bytes=100)
+        workspace = libmat.workspace.Workspace(scratch_root, budget=budget)
+        child = workspace.child()
+        path = os.path.join(child.directory_for(60), 'member')
+        self.assertFalse(path.startswith(scratch_root))
+        with open(path, 'w') as f:
+            f.write('x' * 60)
+        self.assertTrue(workspace.directory_for(60).startswith(scratch_root))
+        child.release(path)
+        self.assertFalse(workspace.directory_for(60).startswith(scratch_root))
+        child.cleanup()
+        workspace.cleanup()
+        self.assertEqual(budget.ram_bytes, 0)
+        os.rmdir(scratch_root)
+
+    def test_nested_cleanup(self):
+        """ test that cleaning up a workspace gives back the RAM of its children
+        """
+        if not libmat.workspace.is_in_ram(libmat.workspace.RAM_ROOT):
+            return
+        scratch_root = tempfile.mkdtemp()
+        budget = libmat.workspace.Budget(max_ram_bytes=100)
+        workspace = libmat.workspace.Workspace(scratch_root, budget=budget)
+        child = workspace.child().child()
+        self.assertFalse(child.directory_for(60).startswith(scratch_root))
+        self.assertEqual(budget.ram_bytes, 60)
+        workspace.cleanup()
+        self.assertEqual(budget.ram_bytes, 0)
+        child.cleanup()  # when the nested archive is closed after its parent
+        self.assertEqual(budget.ram_bytes, 0)
+        os.rmdir(scratch_root)
+
+    def test_member_output(self):
+        """ test that members are cleaned next to them, without shredding RAM
+        """
+        scratch_root = tempfile.mkdtemp()
+        workspace = libmat.workspace.Workspace(scratch_root)
+        directory = workspace.directory_for(1024)
+        path = os.path.join(directory, 'dirty.png')
+        shutil.copy2('dirty \xc3\xa9.png', path)
+        current_file = libmat.mat.create_class_file(path, False, in_workspace=True)
+        self.assertEqual(os.path.dirname(current_file.output), directory)
+        secure_remove = libmat.mat.secure_remove
+        if workspace.in_ram(path):
+            libmat.mat.secure_remove = None  # shredding would raise a TypeError
+        try:
+            self.assertTrue(current_file.remove_all())
+        finally:
+            libmat.mat.secure_remove = secure_remove
+        self.assertEqual(os.listdir(directory), ['dirty.png'])
+        current_file.close()
+        workspace.cleanup()
+        os.rmdir(scratch_root)
+
+
+class TestNativeImages(unittest.TestCase):
+    """ Test the images that can't be parsed natively
+    """
+
+    def __check_unparseable(self, suffix, content):
+        """ Check that a broken image is reported as harmful,
+            without crashing, and isn't cleaned without exiftool
+        """
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.write(fd, content)
+        os.close(fd)
+        current_file = libmat.mat.create_class_file(path, False, add2archive=False)
+        self.assertFalse(current_file.is_clean())
+        if not libmat.exiftool.is_available():
+            self.assertEqual(current_file.get_meta(), {'error': 'unparseable'})
+            self.assertFalse(current_file.remove_all())
+        current_file.close()
+        os.remove(path)
+
+    def test_unparseable_jpeg(self):
+        """ test broken jpeg files
+        """
+        self.__check_unparseable('.jpg', 'not a jpeg')
+        self.__check_unparseable('.jpg', '\xff\xd8\xff\xe1\x10\x00Exif')
+
+    def test_unparseable_png(self):
+        """ test broken and empty png files
+        """
+        self.__check_unparseable('.png', '')
+        self.__check_unparseable('.png', '\x89PNG\r\n\x1a\n\x00\x00\x01\x00tEXt')
+
+    def test_unparseable_tiff(self):
+        """ test broken tiff files
+        """
+        self.__check_unparseable('.tif', 'not a tiff')
+        self.__check_unparseable('.tif', 'II*\x00\x08\x00\x00\x00\x05\x00')
+
+    def test_unparseable_member(self):
+        """ test an archive containing a broken image
+        """
+        zippath = os.path.join(tempfile.mkdtemp(), 'broken.zip')
+        zipout = zipfile.ZipFile(zippath, 'w')
+        zipout.writestr('broken.jpg', 'not a jpeg')
+        zipout.close()
+        current_file = libmat.mat.create_class_file(zippath, False, add2archive=False, jobs=2)
+        self.assertFalse(current_file.is_clean())
+        self.assertIn('broken.jpg', current_file.get_meta())
+        current_file.close()
+        shutil.rmtree(os.path.dirname(zippath))
+
+    def test_scan_batch(self):
+        """ test that the broken images are handed to exiftool all at once
+        """
+        tmpdir = tempfile.mkdtemp()
+        broken = [os.path.join(tmpdir, 'broken%d.jpg' % i) for i in range(3)]
+        for path in broken:
+            with open(path, 'wb') as f:
+                f.write('not a jpeg')
+        dirty = os.path.join(tmpdir, 'dirty.jpg')
+        shutil.copy2('dirty \xc3\xa9.jpg', dirty)
+        pool = FakeExiftoolPool()
+        is_available, libmat.exiftool.is_available = libmat.exiftool.is_available, lambda: True
+        libmat.exiftool._POOL, real_pool = pool, libmat.exiftool._POOL
+        try:
+            strippers = [libmat.mat.create_class_file(path, False, add2archive=False) for path in broken + [dirty]]
+            libmat.images.scan_batch(strippers)
+            self.assertEqual(pool.calls, [['-j', '-G'] + broken])
+            for stripper in strippers[:-1]:
+                self.assertEqual(stripper.get_meta(), {'EXIF:Artist': stripper.filename})
+            self.assertNotEqual(strippers[-1].get_meta(), {})  # parsed natively
+            self.assertEqual(len(pool.calls), 1)
+            for stripper in strippers:
+                stripper.close()
+        finally:
+            libmat.exiftool.is_available = is_available
+            libmat.exiftool._POOL = real_pool
+            shutil.rmtree(tmpdir)
+
+
+class FakeExiftoolPool(object):
+    """ Answer `exiftool -j -G` commands with an Artist tag for every file,
+        except the ones in `skipped` when several files are asked
+    """
+
+    def __init__(self, skipped=(), size=1):
+        self.calls = []
+        self.skipped = skipped
+        self.size = size
+
+    def execute(self, args):
+        self.calls.append(args)
+        return json.dumps([{'SourceFile': name, 'File:FileName': os.path.basename(name), 'EXIF:Artist': name}
+                           for name in args[2:] if len(args) == 3 or name not in self.skipped])
+
+
+class TestExiftool(unittest.TestCase):
+    """ Test the handling of exiftool's json output
+    """
+
+    def test_filter_meta(self):
+        """ test that only the harmful fields are kept, whatever their group
+        """
+        fields = libmat.exiftool.parse_json('[{"SourceFile": "a.jpg", "ExifTool:ExifToolVersion": 10.1,'
+                                            ' "File:FileName": "a.jpg", "File:ImageWidth": 1,'
+                                            ' "EXIF:ModifyDate": "2016:01:01 10:00:00",'
+                                            ' "XMP:Subject": ["a: b", "c"], "JFIF:JFIFVersion": "1.01"}]')
+        stripper = libmat.exiftool.JpegStripper('a.jpg', 'image/jpeg', False, False)
+        self.assertEqual(stripper.filter_meta(fields), {'EXIF:ModifyDate': '2016:01:01 10:00:00',
+                                                        'XMP:Subject': 'a: b, c'})
+
+    def test_missing_file(self):
+        """ test that a file missing from the output isn't reported as clean
+        """
+        for output in ('', '[]', '[{"SourceFile": "a.jpg"}, {"SourceFile": "b.jpg"}]'):
+            self.assertRaises(ValueError, libmat.exiftool.parse_json, output)
+        self.assertRaises(ValueError, libmat.exiftool.parse_json, 'Error: not json')
+
+    def test_get_meta_batch(self):
+        """ test that the metadata of several files are read at once,
+            and that the files missing from the output are scanned on their own
+        """
+        names = ['a.jpg', 'b.jpg', 'c.jpg']
+        pool = FakeExiftoolPool(skipped=('b.jpg',))
+        libmat.exiftool._POOL, real_pool = pool, libmat.exiftool._POOL
+        try:
+            strippers = [libmat.exiftool.JpegStripper(name, 'image/jpeg', False, False) for name in names]
+            stat_key = libmat.exiftool.JpegStripper._stat_key
+            libmat.exiftool.JpegStripper._stat_key = lambda stripper: stripper.filename
+            try:
+                libmat.exiftool.get_meta_batch(strippers)
+                self.assertEqual(pool.calls, [['-j', '-G'] + names])
+                self.assertEqual(strippers[0].get_meta(), {'EXIF:Artist': 'a.jpg'})
+                self.assertIsNone(strippers[1]._peek_scan())
+                self.assertEqual(strippers[1].get_meta(), {'EXIF:Artist': 'b.jpg'})
+                self.assertEqual(pool.calls[1:], [['-j', '-G', 'b.jpg']])
+                self.assertEqual(strippers[2].get_meta(), {'EXIF:Artist': 'c.jpg'})
+                self.assertEqual(len(pool.calls), 2)
+            finally:
+                libmat.exiftool.JpegStripper._stat_key = stat_key
+        finally:
+            libmat.exiftool._POOL = real_pool
+
+    def test_batch_split(self):
+        """ test that a batch is split between the processes of the pool
+        """
+        names = ['%d.jpg' % i for i in range(7)]
+        pool = FakeExiftoolPool(size=3)
+        libmat.exiftool._POOL, real_pool = pool, libmat.exiftool._POOL
+        stat_key = libmat.exiftool.JpegStripper._stat_key
+        libmat.exiftool.JpegStripper._stat_key = lambda stripper: stripper.filename
+        try:
+            strippers = [libmat.exiftool.JpegStripper(name, 'image/jpeg', False, False) for name in names]
+            libmat.exiftool.get_meta_batch(strippers)
+            self.assertEqual(sorted(pool.calls), [['-j', '-G'] + names[:3], ['-j', '-G'] + names[3:6],
+                                                  ['-j', '-G'] + names[6:]])
+            for stripper in strippers:
+                self.assertEqual(stripper._peek_scan(), {'EXIF:Artist': stripper.filename})
+        finally:
+            libmat.exiftool.JpegStripper._stat_key = stat_key
+            libmat.exiftool._POOL = real_pool
+
+    @unittest.skipUnless(libmat.exiftool.is_available(), 'exiftool is not installed')
+    def test_pool_batch(self):
+        """ test that batches are read by the long-lived processes of the pool
+        """
+        tmpdir = tempfile.mkdtemp()
+        names = [os.path.join(tmpdir, '%d.jpg' % i) for i in range(5)]
+        for name in names:
+            shutil.copy2('dirty \xc3\xa9.jpg', name)
+        libmat.exiftool._POOL, real_pool = libmat.exiftool.ExiftoolPool(2), libmat.exiftool._POOL
+        try:
+            strippers = [libmat.exiftool.JpegStripper(name, 'image/jpeg', False, False) for name in names]
+            libmat.exiftool.get_meta_batch(strippers)
+            for stripper in strippers:
+                self.assertNotEqual(stripper._peek_scan(), None)
+                self.assertNotEqual(stripper.get_meta(), {})
+            self.assertEqual(libmat.exiftool._POOL.spawned, 2)
+        finally:
+            libmat.exiftool.close_pool()
+            libmat.exiftool._POOL = real_pool
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(libmat.exiftool.is_available(), 'exiftool is not installed')
+    def test_process(self):
+        """ test that the output of each command is delimited by its {ready} line
+        """
+        process = libmat.exiftool.ExiftoolProcess()
+        try:
+            self.assertNotIn('{ready', process.execute(['-ver']))
+            self.assertEqual(process.execute(['-echo', 'first']), 'first\n')
+            self.assertEqual(process.execute(['-echo', 'second']), 'second\n')
+        finally:
+            process.close()
+        self.assertIsNone(process.process)
+
+    @unittest.skipUnless(libmat.exiftool.is_available(), 'exiftool is not installed')
+    def test_pool_restart(self):
+        """ test that a process of the pool that died is restarted
+        """
+        pool = libmat.exiftool.ExiftoolPool(1)
+        try:
+            self.assertEqual(pool.execute(['-echo', 'first']), 'first\n')
+            worker = pool.idle.get()
+            worker.process.kill()
+            worker.process.wait()
+            pool.idle.put(worker)
+            self.assertEqual(pool.execute(['-echo', 'second']), 'second\n')
+            self.assertTrue(worker.is_alive())
+        finally:
+            pool.close()
+
+    @unittest.skipUnless(libmat.exiftool.is_available(), 'exiftool is not installed')
+    def test_pool_size(self):
+        """ test that the pool never runs more processes than its size
+        """
+        pool = libmat.exiftool.ExiftoolPool(2)
+        outputs = multiprocessing.pool.ThreadPool(6).map(
+            lambda i: pool.execute(['-echo', str(i)]), range(12))
+        try:
+            self.assertEqual(outputs, ['%d\n' % i for i in range(12)])
+            self.assertLessEqual(pool.spawned, 2)
+            self.assertEqual(pool.idle.qsize(), pool.spawned)
+        finally:
+            pool.close()
+        self.assertEqual(pool.spawned, 0)
+
+    @unittest.skipUnless(libmat.exiftool.is_available(), 'exiftool is not installed')
+    def test_argfile_names(self):
+        """ test the names that can't be written in an argfile as is
+        """
+        tmpdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        names = ['#dirty.jpg', ' dirty.jpg', 'dirty\n.jpg']
+        for name in names:
+            shutil.copy2('dirty \xc3\xa9.jpg', os.path.join(tmpdir, name))
+        os.chdir(tmpdir)
+        try:
+            for name in names:
+                fields = libmat.exiftool.parse_json(libmat.exiftool.get_pool().execute(['-j', '-G', name]))
+                self.assertEqual(fields['SourceFile'], name)
+                stripper = libmat.exiftool.JpegStripper(name, 'image/jpeg', False, True)
+                self.assertNotEqual(stripper.get_meta(), {})
+                self.assertTrue(stripper.remove_all())
+                self.assertEqual(stripper.get_meta(), {})
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+
+
+class TestPdfRendering(unittest.TestCase):
+    """ Test the split of PDF rendering between processes
+    """
+
+    def test_page_ranges(self):
+        """ test that every page is rendered once, by contiguous ranges
+        """
+        self.assertEqual(libmat.office.page_ranges(0, 4), [(0, 0)])
+        self.assertEqual(libmat.office.page_ranges(10, 4), [(0, 10)])
+        self.assertEqual(libmat.office.page_ranges(500, 1), [(0, 500)])
+        ranges = libmat.office.page_ranges(500, 4)
+        self.assertEqual(ranges, [(0, 125), (125, 250), (250, 375), (375, 500)])
+        ranges = libmat.office.page_ranges(40, 8)
+        self.assertEqual(ranges, [(0, 16), (16, 32), (32, 40)])
+
+    def test_shared_processes(self):
+        """ test that pages are only rendered by the processes shared with
+            the archives, and never by processes forked from a thread
+        """
+        libmat.archive.close_processes()
+        threads = multiprocessing.pool.ThreadPool(1)
+        try:
+            self.assertIsNone(threads.apply(libmat.archive.get_processes, (2,)))
+            processes = libmat.archive.get_processes(2)
+            self.assertIs(processes, libmat.archive.start_processes())
+            self.assertIs(threads.apply(libmat.archive.get_processes, (2,)), processes)
+            self.assertIsNone(processes.apply(libmat.archive.get_processes, (2,)))
+        finally:
+            threads.close()
+            threads.join()
+            libmat.archive.close_processes()
+
+
+class TestPdfScan(unittest.TestCase):
+    """ Test the scan of PDF structures, without Poppler
+    """
+
+    def test_xref_table(self):
+        """ test the scan of PDF with a classic xref table
+        """
+        self.assertEqual(libmat.pdfscan.scan('clean é.pdf'), {})
+        meta = libmat.pdfscan.scan('dirty é.pdf')
+        self.assertEqual(meta['Author'], 'jvoisin ')
+        self.assertEqual(meta['Producer'], 'LibreOffice 3.3')
+
+    def test_xref_stream(self):
+        """ test the scan of PDF whose objects are in object streams,
+            indexed by a compressed xref stream
+        """
+        objects = '<</Type/Catalog/Pages 3 0 R/Metadata 4 0 R>> <</Author(J. \\(Doe\\))/Title<FEFF00E9>>>'
+        header = '1 0 2 %d ' % (objects.index('<</Author'))
+        pdf = '%PDF-1.5\n'
+        offsets = [len(pdf)]
+        pdf += '5 0 obj\n<</Type/ObjStm/N 2/First %d/Length %d>>\nstream\n%s%s\nendstream\nendobj\n' % (
+            len(header), len(header + objects), header, objects)
+        offsets.append(len(pdf))
+        pdf += '3 0 obj\n<</Type/Pages/Kids[]/Count 0>>\nendobj\n'
+        offsets.append(len(pdf))
+        xmp = '<x:xmpmeta>John Doe</x:xmpmeta>'
+        pdf += '4 0 obj\n<</Type/Metadata/Subtype/XML/Length %d>>\nstream\n%s\nendstream\nendobj\n' % (len(xmp), xmp)
+        # type, offset or object stream, index (with the "up" png predictor)
+        entries = [(2, 5, 0), (2, 5, 1), (1, offsets[1], 0), (1, offsets[2], 0), (1, offsets[0], 0)]
+        rows, previous = [], '\x00' * 4
+        for entry in entries:
+            row = struct.pack('>BHB', *entry)
+            rows.append('\x02' + ''.join(chr((ord(a) - ord(b)) & 0xff) for a, b in zip(row, previous)))
+            previous = row
+        data = zlib.compress(''.join(rows))
+        xref = len(pdf)
+        pdf += ('6 0 obj\n<</Type/XRef/Size 7/Index[1 5]/W[1 2 1]/Root 1 0 R/Info 2 0 R/Filter/FlateDecode'
+                '/DecodeParms<</Predictor 12/Columns 4>>/Length %d>>\nstream\n%s\nendstream\nendobj\n'
+                'startxref\n%d\n%%%%EOF\n' % (len(data), data, xref))
+        fd, path = tempfile.mkstemp()
+        os.write(fd, pdf)
+        os.close(fd)
+        meta = libmat.pdfscan.scan(path)
+        os.remove(path)
+        self.assertEqual(meta, {'Author': 'J. (Doe)', 'Title': '\xc3\xa9', 'Metadata': xmp})
+
+    def test_invalid(self):
+        """ test that unusual files are left to Poppler
+        """
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '%PDF-1.4\nnot really a pdf\n')
+        os.close(fd)
+        self.assertRaises(ValueError, libmat.pdfscan.scan, path)
+        os.remove(path)
+
 
 class TestArchiveProcessing(test.MATTest):
     """ Test archives processing
@@ -170,6 +669,573 @@ class TestArchiveProcessing(test.MATTest):
         current_file = libmat.mat.create_class_file(tarpath, False, add2archive=False)
         self.assertTrue(current_file.is_clean())
 
+    def test_remove_parallel(self):
+        """ Test that members cleaned concurrently are written in their original order
+        """
+        tarpath = os.path.join(self.tmpdir, "parallel.tar")
+        tar = tarfile.open(tarpath, "w")
+        for clean, dirty in self.file_list:
+            tar.add(dirty)
+            tar.add(clean)
+        tar.close()
+        tar = tarfile.open(tarpath)
+        names = tar.getnames()
+        tar.close()
+        current_file = libmat.mat.create_class_file(tarpath, False, add2archive=True, jobs=4)
+        current_file.remove_all()
+        current_file = libmat.mat.create_class_file(tarpath, False, add2archive=False)
+        self.assertTrue(current_file.is_clean())
+        tar = tarfile.open(tarpath)
+        self.assertEqual(tar.getnames(), names)
+        tar.close()
+
+    def test_shared_processes(self):
+        """ Test that every archive of a run is handled by the same worker processes
+        """
+        libmat.archive.start_processes(2)
+        pool = multiprocessing.Pool
+        multiprocessing.Pool = None  # forking another pool would raise a TypeError
+        try:
+            for clean, dirty in self.file_list:
+                if dirty.endswith(('.zip', '.docx', '.odt')):
+                    with libmat.mat.create_class_file(dirty, False, add2archive=True, jobs=2) as current_file:
+                        self.assertFalse(current_file.is_clean())
+                        current_file.remove_all()
+        finally:
+            multiprocessing.Pool = pool
+
+    def test_single_scan(self):
+        """ Test that cleaning an archive reuses the members extracted to display its metadata
+        """
+        tarpath = os.path.join(self.tmpdir, "plan.tar")
+        tar = tarfile.open(tarpath, "w")
+        for clean, dirty in self.file_list:
+            tar.add(dirty)
+        tar.close()
+        current_file = libmat.mat.create_class_file(tarpath, False, add2archive=True)
+        extracted = []
+        extract = current_file._extract
+        current_file._extract = lambda *args: extracted.append(args[2]) or extract(*args)
+        try:
+            current_file.get_meta()
+            current_file.remove_all()
+        finally:
+            del current_file._extract  # the lambda would keep the file alive
+            current_file.close()
+        self.assertEqual(len(extracted), len(self.file_list))
+        current_file = libmat.mat.create_class_file(tarpath, False, add2archive=False)
+        self.assertTrue(current_file.is_clean())
+
+    def test_unsupported_headers(self):
+        """ Test that listing the unsupported members of a tarball doesn't extract them,
+            unless it contains nested archives
+        """
+        tarpath = os.path.join(self.tmpdir, "headers.tar")
+        tar = tarfile.open(tarpath, "w")
+        tar.add('test.py', 'test.py')
+        for clean, dirty in self.file_list:
+            if not issubclass(libmat.mat.get_stripper_class(clean)[1], libmat.archive.GenericArchiveStripper):
+                tar.add(clean, os.path.basename(clean))
+        tar.close()
+        with libmat.mat.create_class_file(tarpath, False, add2archive=False) as current_file:
+            current_file._extract = None  # extracting would raise a TypeError
+            self.assertEqual(current_file.list_unsupported(), ['test.py'])
+            self.assertIsNone(current_file._peek_scan())
+
+        nestedpath = os.path.join(self.tmpdir, "nested.tar")
+        tar = tarfile.open(nestedpath, "w")
+        tar.add(tarpath, 'headers.tar')
+        tar.close()
+        with libmat.mat.create_class_file(nestedpath, False, add2archive=False) as current_file:
+            self.assertEqual(current_file.list_unsupported(), ['headers.tar'])
+            self.assertIsNotNone(current_file._peek_scan())
+
+    def test_nested_single_scan(self):
+        """ Test that nested archives are cleaned with the plan of their analysis
+        """
+        innerpath = os.path.join(self.tmpdir, "inner.zip")
+        zipout = zipfile.ZipFile(innerpath, 'w')
+        for clean, dirty in self.file_list:
+            zipout.write(dirty, os.path.basename(dirty))
+        zipout.close()
+        for jobs in (1, 2):
+            zippath = os.path.join(self.tmpdir, "outer%d.zip" % jobs)
+            zipout = zipfile.ZipFile(zippath, 'w')
+            zipout.write(innerpath, 'inner.zip')
+            zipout.close()
+            scans = []
+            cls = libmat.archive.ZipStripper
+            scan = cls.__dict__['_scan']
+
+            def counted_scan(parser, stop_early=False):
+                plan = scan(parser, stop_early)
+                if plan.complete:
+                    scans.append(parser.filename)
+                return plan
+            cls._scan = counted_scan
+            try:
+                with libmat.mat.create_class_file(zippath, False, add2archive=True, jobs=jobs) as current_file:
+                    self.assertFalse(current_file.is_clean())
+                    current_file.remove_all()
+            finally:
+                cls._scan = scan
+            self.assertEqual(len(scans), len(set(scans)))  # at every level
+            with libmat.mat.create_class_file(zippath, False, add2archive=True) as current_file:
+                self.assertTrue(current_file.is_clean())
+
+    def test_member_options(self):
+        """ Test that the PDF options reach the members of nested archives
+        """
+        innerpath = os.path.join(self.tmpdir, "options.zip")
+        zipout = zipfile.ZipFile(innerpath, 'w')
+        zipout.writestr('notes.txt', 'harmless content')
+        zipout.close()
+        tarpath = os.path.join(self.tmpdir, "options.tar")
+        tar = tarfile.open(tarpath, "w")
+        tar.add(innerpath, 'options.zip')
+        tar.close()
+        with libmat.mat.create_class_file(tarpath, False, add2archive=True,
+                                          low_pdf_quality=True, structural_pdf=True) as current_file:
+            current_file.list_unsupported()
+            nested = current_file._get_scan().members['options.zip'].stripper
+            self.assertTrue(nested.low_pdf_quality)
+            self.assertTrue(nested.structural_pdf)
+            self.assertTrue(nested._member_kwargs()['low_pdf_quality'])
+            self.assertTrue(nested._member_kwargs()['structural_pdf'])
+
+    def test_headers_early_exit(self):
+        """ Test that an archive with dirty headers is rejected without extracting anything
+        """
+        tarpath = os.path.join(self.tmpdir, "headers.tar")
+        tar = tarfile.open(tarpath, "w")
+        for clean, dirty in self.file_list:
+            tar.add(dirty)
+        tar.close()
+        current_file = libmat.mat.create_class_file(tarpath, False, add2archive=False)
+        current_file._extract = None  # extracting would raise a TypeError
+        self.assertFalse(current_file.is_clean())
+
+    def test_headers_single_pass(self):
+        """ Test that an archive with clean headers is read only once by is_clean
+        """
+        tarpath = os.path.join(self.tmpdir, "pass.tar")
+        tar = tarfile.open(tarpath, "w")
+        for clean, dirty in self.file_list:
+            tar.add(clean, filter=libmat.archive.TarStripper._remove_tar_added)
+        tar.close()
+        cls = libmat.archive.TarStripper
+        members = cls.__dict__['_members']
+        passes = []
+        cls._members = lambda parser: passes.append(parser.filename) or members(parser)
+        try:
+            with libmat.mat.create_class_file(tarpath, False, add2archive=False) as current_file:
+                self.assertTrue(current_file.is_clean())
+                current_file.get_meta()
+                current_file.list_unsupported()
+        finally:
+            cls._members = members
+        self.assertEqual(passes.count(tarpath), 1)
+
+    def test_parallel_gzip(self):
+        """ Test that tar.gz are compressed in parallel blocks, without any date or name
+        """
+        tarpath = os.path.join(self.tmpdir, "parallel.tar.gz")
+        tar = tarfile.open(tarpath, "w:gz")
+        for clean, dirty in self.file_list:
+            tar.add(clean)
+        tar.close()
+        libmat.compression.GZIP_BLOCK_SIZE = 4096
+        try:
+            current_file = libmat.mat.create_class_file(tarpath, False, add2archive=True)
+            current_file.remove_all()
+        finally:
+            libmat.compression.GZIP_BLOCK_SIZE = 128 * 1024
+        with open(tarpath, 'rb') as f:
+            self.assertEqual(f.read(10), libmat.compression.GZIP_HEADER)
+        tar = tarfile.open(tarpath, "r:gz")
+        self.assertEqual(len(tar.getnames()), len(self.file_list))
+        tar.close()
+
+    def test_compression_jobs(self):
+        """ Test that tarballs are compressed with the number of jobs they were given
+        """
+        tarpath = os.path.join(self.tmpdir, "jobs.tar.gz")
+        tarfile.open(tarpath, "w:gz").close()
+        for jobs in (1, 2):
+            current_file = libmat.mat.create_class_file(tarpath, False, add2archive=True, jobs=jobs)
+            with open(os.devnull, 'wb') as fileobj_out:
+                tarout, writer = current_file._open_output(fileobj_out)
+                self.assertEqual(writer.jobs, jobs)
+                self.assertEqual(writer.pool is None, jobs == 1)
+                tarout.close()
+                writer.close()
+            current_file.close()
+
+    def test_zip_compression_policy(self):
+        """ Test that already compressed members are stored, and the mimetype too
+        """
+        zippath = os.path.join(self.tmpdir, 'policy.zip')
+        zipout = zipfile.ZipFile(zippath, 'w', zipfile.ZIP_DEFLATED)
+        zipout.write('dirty \xc3\xa9.jpg', 'picture.jpg')
+        zipout.writestr('mimetype', 'application/zip')
+        zipout.writestr('notes.txt', 'harmless content ' * 100)
+        zipout.close()
+        current_file = libmat.mat.create_class_file(zippath, False, add2archive=False)
+        current_file.remove_all()
+        zipin = zipfile.ZipFile(zippath)
+        self.assertEqual(zipin.getinfo('picture.jpg').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(zipin.getinfo('mimetype').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(zipin.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+        zipin.close()
+
+    def test_zip_index(self):
+        """ Test that the central directory of an office document is parsed only once
+        """
+        for clean, dirty in self.file_list:
+            if dirty.endswith(('.docx', '.odt')):
+                current_file = libmat.mat.create_class_file(dirty, False, add2archive=False)
+                self.assertFalse(current_file.is_clean())
+                index = current_file.index
+                current_file.get_meta()
+                current_file.list_unsupported()
+                self.assertIs(current_file.index, index)
+                current_file.close()
+
+    def test_zip_passthrough(self):
+        """ Test that members without metadata are copied without being recompressed
+        """
+        zippath = os.path.join(self.tmpdir, 'passthrough.zip')
+        zipout = zipfile.ZipFile(zippath, 'w', zipfile.ZIP_DEFLATED)
+        zipout.writestr('notes.txt', 'harmless content ' * 100)
+        zipout.comment = 'harmful comment'
+        zipout.close()
+        zipin = zipfile.ZipFile(zippath)
+        original = zipin.getinfo('notes.txt')
+        zipin.close()
+        current_file = libmat.mat.create_class_file(zippath, False, add2archive=False)
+        current_file.remove_all()
+        current_file = libmat.mat.create_class_file(zippath, False, add2archive=False)
+        self.assertTrue(current_file.is_clean())
+        zipin = zipfile.ZipFile(zippath)
+        item = zipin.getinfo('notes.txt')
+        self.assertEqual((item.CRC, item.compress_size), (original.CRC, original.compress_size))
+        self.assertEqual(zipin.read('notes.txt'), 'harmless content ' * 100)
+        zipin.close()
+
+    @unittest.skipUnless(distutils.spawn.find_executable('zip'), 'zip is not installed')
+    def test_zip_passthrough_encrypted(self):
+        """ Test that encrypted members with a data descriptor can still be decrypted
+        """
+        path = os.path.join(self.tmpdir, 'notes.txt')
+        with open(path, 'w') as f:
+            f.write('harmless content ' * 100)
+        os.utime(path, (1462455420, 1462455420))
+        zippath = os.path.join(self.tmpdir, 'encrypted.zip')
+        subprocess.check_call(['zip', '-q', '-P', 'password', zippath, 'notes.txt'], cwd=self.tmpdir)
+        zipin = zipfile.ZipFile(zippath)
+        original = zipin.getinfo('notes.txt')
+        zipin.close()
+        self.assertEqual(original.flag_bits & 0x9, 0x9)
+        current_file = libmat.mat.create_class_file(zippath, False, add2archive=False)
+        self.assertFalse(current_file.is_clean())
+        current_file.remove_all()
+        current_file = libmat.mat.create_class_file(zippath, False, add2archive=False)
+        self.assertTrue(current_file.is_clean())
+        zipin = zipfile.ZipFile(zippath)
+        item = zipin.getinfo('notes.txt')
+        self.assertEqual(item.date_time[:3], libmat.archive.ZIP_EPOCH[:3])
+        self.assertEqual(item.date_time[3:5], (original.date_time[3], original.date_time[4] & ~7))
+        self.assertEqual(zipin.read('notes.txt', pwd='password'), 'harmless content ' * 100)
+        zipin.close()
+
+    def test_office_parallel_media(self):
+        """ Test that the media of an office document are analysed
+            and cleaned concurrently, with the same outcome
+        """
+        docpath = os.path.join(self.tmpdir, 'slides.docx')
+        zipout = zipfile.ZipFile(docpath, 'w')
+        zipout.writestr('[Content_Types].xml', '<Types/>')
+        media = []
+        for clean, dirty in self.file_list:
+            if dirty.endswith(('.jpg', '.png')):
+                for i in range(3):
+                    name = 'word/media/image%d%s' % (len(media), os.path.splitext(dirty)[1])
+                    zipout.write(dirty, name)
+                    media.append(name)
+        zipout.close()
+
+        metas = []
+        for jobs in (1, 4):
+            current_file = libmat.mat.create_class_file(docpath, False, add2archive=False, jobs=jobs)
+            self.assertFalse(current_file.is_clean())
+            metas.append(current_file.get_meta())
+            current_file.close()
+        self.assertEqual(metas[0], metas[1])
+        self.assertTrue(all(name in metas[0] for name in media))
+
+        current_file = libmat.mat.create_class_file(docpath, False, add2archive=False, jobs=4)
+        self.assertTrue(current_file.remove_all())
+        current_file.close()
+        current_file = libmat.mat.create_class_file(docpath, False, add2archive=False)
+        self.assertTrue(current_file.is_clean())
+        current_file.close()
+        zipin = zipfile.ZipFile(docpath)
+        self.assertEqual(zipin.namelist(), ['[Content_Types].xml'] + media)
+        zipin.close()
+
+    def test_office_xml_scrub(self):
+        """ Test that the authors, dates and revision identifiers
+            are removed from the xml parts of an office document
+        """
+        namespace = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+        docpath = os.path.join(self.tmpdir, 'tracked.docx')
+        zipout = zipfile.ZipFile(docpath, 'w')
+        zipout.writestr('[Content_Types].xml', '<Types/>')
+        zipout.writestr('word/document.xml', '<w:document %s><w:body><w:p w:rsidR="00A1B2C3">'
+                        '<w:ins w:id="1" w:author="John Doe" w:date="2016-01-01T00:00:00Z">'
+                        '<w:r><w:t>text</w:t></w:r></w:ins></w:p></w:body></w:document>' % namespace)
+        zipout.writestr('word/settings.xml', '<w:settings %s><w:rsids><w:rsidRoot w:val="00A1B2C3"/>'
+                        '</w:rsids><w:zoom w:percent="100"/></w:settings>' % namespace)
+        zipout.close()
+
+        current_file = libmat.mat.create_class_file(docpath, False, add2archive=False)
+        self.assertFalse(current_file.is_clean())
+        self.assertIn('John Doe', current_file.get_meta()['word/document.xml'])
+        self.assertTrue(current_file.remove_all())
+        current_file.close()
+
+        current_file = libmat.mat.create_class_file(docpath, False, add2archive=False)
+        self.assertTrue(current_file.is_clean())
+        current_file.close()
+        zipin = zipfile.ZipFile(docpath)
+        document = zipin.read('word/document.xml')
+        self.assertNotIn('John Doe', document)
+        self.assertNotIn('rsid', document)
+        self.assertNotIn('2016', document)
+        self.assertIn('w:author=""', document)
+        self.assertIn('<w:t>text</w:t>', document)
+        self.assertNotIn('rsid', zipin.read('word/settings.xml'))
+        self.assertIn('w:zoom', zipin.read('word/settings.xml'))
+        zipin.close()
+
+    def test_office_xml_scrub_comments(self):
+        """ Test that the comments of presentations, and the revisions
+            and people of spreadsheets, lose their authors and dates
+        """
+        p = 'xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main"'
+        s = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+        tc = 'xmlns="http://schemas.microsoft.com/office/spreadsheetml/2018/threadedcomments"'
+        documents = {
+            'slides.pptx': {
+                'ppt/comments/comment1.xml': '<p:cmLst %s><p:cm authorId="0" dt="2016-01-01T00:00:00.000"'
+                                             ' idx="1"><p:text>comment</p:text></p:cm></p:cmLst>' % p,
+            },
+            'sheets.xlsx': {
+                'xl/revisions/revisionHeaders.xml': '<headers %s guid="{0}"><header guid="{1}" dateTime='
+                                                    '"2016-01-01T00:00:00" userName="John Doe"/></headers>' % s,
+                'xl/revisions/userNames.xml': '<users %s count="1"><userInfo guid="{2}" name="John Doe"'
+                                              ' id="1" dateTime="2016-01-01T00:00:00"/></users>' % s,
+                'xl/persons/person.xml': '<personList %s><person displayName="John Doe" id="{3}"'
+                                         ' userId="john@example.com" providerId="AD"/></personList>' % tc,
+                'xl/threadedComments/threadedComment1.xml': '<ThreadedComments %s><threadedComment ref="A1"'
+                                                            ' dT="2016-01-01T00:00:00" personId="{3}" id="{4}">'
+                                                            '<text>comment</text></threadedComment>'
+                                                            '</ThreadedComments>' % tc,
+            },
+        }
+        for name, parts in documents.items():
+            docpath = os.path.join(self.tmpdir, name)
+            zipout = zipfile.ZipFile(docpath, 'w')
+            zipout.writestr('[Content_Types].xml', '<Types/>')
+            for part, content in parts.items():
+                zipout.writestr(part, content)
+            zipout.close()
+
+            current_file = libmat.mat.create_class_file(docpath, False, add2archive=False)
+            self.assertFalse(current_file.is_clean())
+            self.assertEqual(set(parts) - set(current_file.get_meta()), set())
+            self.assertTrue(current_file.remove_all())
+            current_file.close()
+
+            current_file = libmat.mat.create_class_file(docpath, False, add2archive=False)
+            self.assertTrue(current_file.is_clean())
+            current_file.close()
+            zipin = zipfile.ZipFile(docpath)
+            for part in parts:
+                content = zipin.read(part)
+                for leak in ('John Doe', 'john@example.com', '2016'):
+                    self.assertNotIn(leak, content)
+                self.assertNotIn('providerId="AD"', content)
+                if part.startswith('xl/revisions/'):  # mandatory, must stay valid
+                    self.assertIn('dateTime="1970-01-01T00:00:00Z"', content)
+            zipin.close()
+
+    def test_office_xml_unparseable(self):
+        """ Test that an xml part that can't be parsed isn't reported as clean
+        """
+        docpath = os.path.join(self.tmpdir, 'broken.docx')
+        zipout = zipfile.ZipFile(docpath, 'w')
+        zipout.writestr('[Content_Types].xml', '<Types/>')
+        zipout.writestr('word/document.xml', '<w:document w:author="John Doe">')
+        zipout.close()
+        current_file = libmat.mat.create_class_file(docpath, False, add2archive=False)
+        self.assertFalse(current_file.is_clean())
+        self.assertIn('word/document.xml', current_file.list_unsupported())
+        current_file.close()
+
+        # It can't be scrubbed, and the document can't be cleaned without it
+        with open(docpath, 'rb') as f:
+            content = f.read()
+        current_file = libmat.mat.create_class_file(docpath, False, add2archive=False)
+        self.assertFalse(current_file.remove_all())
+        current_file.close()
+        with open(docpath, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def __remove_external(self, extension, command, magic):
+        """ Clean a tarball compressed with $command, and check that
+            the result is clean and compressed the same way.
+        """
+        tarpath = os.path.join(self.tmpdir, "test.tar")
+        tar = tarfile.open(tarpath, "w")
+        for clean, dirty in self.file_list:
+            tar.add(dirty)
+            tar.add(clean)
+        tar.close()
+        subprocess.check_call(command + [tarpath])
+        tarpath += extension
+        current_file = libmat.mat.create_class_file(tarpath, False, add2archive=False, compression_level=1)
+        current_file.remove_all()
+        current_file = libmat.mat.create_class_file(tarpath, False, add2archive=False)
+        self.assertTrue(current_file.is_clean())
+        with open(tarpath, 'rb') as f:
+            self.assertEqual(f.read(len(magic)), magic)
+
+    @unittest.skipUnless(libmat.compression.is_available('xz'), 'xz is not installed')
+    def test_remove_xz(self):
+        """ Test MAT on tar.xz files
+        """
+        self.__remove_external('.xz', ['xz', '-q'], '\xfd7zXZ\x00')
+
+    @unittest.skipUnless(libmat.compression.is_available('zst'), 'zstd is not installed')
+    def test_remove_zst(self):
+        """ Test MAT on tar.zst files
+        """
+        self.__remove_external('.zst', ['zstd', '-q', '--rm'], '\x28\xb5\x2f\xfd')
+
+    @unittest.skipUnless(libmat.compression.is_available('xz'), 'xz is not installed')
+    def test_pipes_reaped(self):
+        """ Test that the (de)compressors don't outlive a failed cleaning
+        """
+        def children():
+            found = []
+            for pid in os.listdir('/proc'):
+                try:
+                    with open(os.path.join('/proc', pid, 'stat')) as f:
+                        fields = f.read().rsplit(')', 1)[1].split()
+                except (IOError, IndexError):
+                    continue
+                if int(fields[1]) == os.getpid():
+                    found.append(pid)
+            return found
+
+        tarpath = os.path.join(self.tmpdir, "pipes.tar")
+        tar = tarfile.open(tarpath, "w")
+        tar.add('dirty \xc3\xa9.png', 'first.png')
+        tar.add('dirty \xc3\xa9.png', 'second.png')
+        tar.close()
+        subprocess.check_call(['xz', '-q', tarpath])
+        before = children()
+        max_bytes = libmat.workspace.MAX_BYTES
+        libmat.workspace.MAX_BYTES = os.path.getsize('dirty \xc3\xa9.png') + 1
+        try:
+            for jobs in (1, 2):
+                current_file = libmat.mat.create_class_file(tarpath + '.xz', False, add2archive=True, jobs=jobs)
+                self.assertRaises(libmat.exceptions.ArchiveLimitExceeded, current_file.remove_all)
+                current_file.close()
+                self.assertEqual(children(), before)
+        finally:
+            libmat.workspace.MAX_BYTES = max_bytes
+
+    def test_limits(self):
+        """ Test that nested archives and extracted bytes are bounded
+        """
+        tarpath = os.path.join(self.tmpdir, "limits.tar")
+        tar = tarfile.open(tarpath, "w")
+        for clean, dirty in self.file_list:
+            tar.add(dirty)
+        tar.close()
+        max_depth, max_bytes = libmat.workspace.MAX_DEPTH, libmat.workspace.MAX_BYTES
+        try:
+            libmat.workspace.MAX_DEPTH = 0
+            current_file = libmat.mat.create_class_file(tarpath, False, add2archive=True)
+            self.assertRaises(libmat.exceptions.ArchiveLimitExceeded, current_file.remove_all)
+            libmat.workspace.MAX_DEPTH, libmat.workspace.MAX_BYTES = max_depth, 1024
+            current_file = libmat.mat.create_class_file(tarpath, False, add2archive=True)
+            self.assertRaises(libmat.exceptions.ArchiveLimitExceeded, current_file.get_meta)
+        finally:
+            libmat.workspace.MAX_DEPTH, libmat.workspace.MAX_BYTES = max_depth, max_bytes
+
+    def test_zip_bomb(self):
+        """ Test that a zip member bigger than its headers say is stopped
+            while it is extracted, and doesn't stay in the workspace
+        """
+        zippath = os.path.join(self.tmpdir, "bomb.zip")
+        zipout = zipfile.ZipFile(zippath, 'w', zipfile.ZIP_DEFLATED)
+        zipout.writestr('bomb.png', '\0' * (4 * 1024 * 1024))
+        zipout.filelist[0].file_size = 10  # written in the central directory
+        zipout.close()
+        max_bytes = libmat.workspace.MAX_BYTES
+        libmat.workspace.MAX_BYTES = 1024 * 1024
+        try:
+            current_file = libmat.mat.create_class_file(zippath, False, add2archive=False)
+            self.assertRaises(libmat.exceptions.ArchiveLimitExceeded, current_file.get_meta)
+            for directory in (current_file.workspace.ramdir, current_file.workspace.diskdir):
+                if directory is not None:
+                    self.assertEqual(os.listdir(directory), [])
+            current_file.close()
+
+            # Same for the xml parts scrubbed on the fly
+            docpath = os.path.join(self.tmpdir, "bomb.docx")
+            zipout = zipfile.ZipFile(docpath, 'w', zipfile.ZIP_DEFLATED)
+            zipout.writestr('word/document.xml', '<w:document xmlns:w="http://schemas.openxmlformats.org/'
+                            'wordprocessingml/2006/main" w:rsidR="00A1"><w:t>%s</w:t></w:document>' %
+                            ('x' * (4 * 1024 * 1024)))
+            zipout.close()
+            current_file = libmat.mat.create_class_file(docpath, False, add2archive=False)
+            self.assertRaises(libmat.exceptions.ArchiveLimitExceeded, current_file.remove_all)
+            for directory in (current_file.workspace.ramdir, current_file.workspace.diskdir):
+                if directory is not None:
+                    self.assertEqual(os.listdir(directory), [])
+            current_file.close()
+        finally:
+            libmat.workspace.MAX_BYTES = max_bytes
+
+    def test_zip_bomb_ram(self):
+        """ Test that a zip member bigger than its headers say
+            doesn't fill up the RAM, but is moved to disk
+        """
+        if not libmat.workspace.is_in_ram(libmat.workspace.RAM_ROOT):
+            return
+        zippath = os.path.join(self.tmpdir, "bomb.zip")
+        zipout = zipfile.ZipFile(zippath, 'w', zipfile.ZIP_DEFLATED)
+        zipout.writestr('bomb.png', '\0' * (8 * 1024 * 1024))
+        zipout.filelist[0].file_size = 10  # written in the central directory
+        zipout.close()
+        max_ram_bytes = libmat.workspace.MAX_RAM_BYTES
+        libmat.workspace.MAX_RAM_BYTES = 1024 * 1024
+        try:
+            current_file = libmat.mat.create_class_file(zippath, False, add2archive=False)
+            current_file.get_meta()
+            member = current_file._get_scan().extracted('bomb.png')
+            self.assertTrue(member.path.startswith(current_file.workspace.diskdir))
+            self.assertEqual(os.path.getsize(member.path), 8 * 1024 * 1024)
+            self.assertEqual(os.listdir(current_file.workspace.ramdir), [])
+            self.assertEqual(current_file.workspace.budget.ram_bytes, 0)
+            current_file.close()
+        finally:
+            libmat.workspace.MAX_RAM_BYTES = max_ram_bytes
+
     def test_get_unsupported(self):
         """ Test the get_unsupported feature, used by the GUI
         """
@@ -197,7 +1263,13 @@ def get_tests():
     suite.addTest(unittest.makeSuite(TestRemovelib))
     suite.addTest(unittest.makeSuite(TestListlib))
     suite.addTest(unittest.makeSuite(TestisCleanlib))
+    suite.addTest(unittest.makeSuite(TestScanCache))
     suite.addTest(unittest.makeSuite(TestFileAttributes))
     suite.addTest(unittest.makeSuite(TestSecureRemove))
+    suite.addTest(unittest.makeSuite(TestWorkspace))
+    suite.addTest(unittest.makeSuite(TestNativeImages))
+    suite.addTest(unittest.makeSuite(TestExiftool))
+    suite.addTest(unittest.makeSuite(TestPdfRendering))
+    suite.addTest(unittest.makeSuite(TestPdfScan))
     suite.addTest(unittest.makeSuite(TestArchiveProcessing))
     return suite